@@ -1,6 +1,5 @@
 import os
 import time
-import torch
 
 class BaseAlgorithm:
     def __init__(self, env, device="cpu"):
@@ -22,6 +21,7 @@ class BaseAlgorithm:
             nameBase = f"{self.env.metadata['name']}_{self.__class__.__name__}_{timestamp}.pt"
             path = os.path.join(nameDir, "..", "models", nameBase)
 
+        import torch
         torch.save(
             {
                 'model_state_dict': self.learner.state_dict(),
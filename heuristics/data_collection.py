@@ -2,9 +2,6 @@ from IPython.display import clear_output
 from sdzoo.sdzoo_v0 import SDGraph, parallel_env
 from sdzoo.env.communication_model import CommunicationModel
 import numpy as np
-import networkx as nx
-from torch_geometric.utils import to_networkx
-import matplotlib.pyplot as plt 
 import pandas as pd
 
 from algos.random import RandomChoice
@@ -20,7 +17,7 @@ RENDER_TERMINAL = False
 sdg = SDGraph("../sdzoo/env/9nodes.graph")
 env = parallel_env(sdg, 4,
                     speed = 40, 
-                    observe_method="pyg", 
+                    observe_method="none", 
                     alpha=1.0,
                     beta=10.0,
                     load_reward=1.0,
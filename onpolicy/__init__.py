@@ -1,4 +1,4 @@
-from onpolicy import algorithms, envs, runner, scripts, utils, config
+import importlib
 
 
 __version__ = "0.1.0"
@@ -10,4 +10,11 @@ __all__ = [
     "scripts",
     "utils",
     "config",
-]
\ No newline at end of file
+]
+
+
+def __getattr__(name):
+    # The subpackages are imported on first use, so that importing e.g. the environments does not import torch.
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
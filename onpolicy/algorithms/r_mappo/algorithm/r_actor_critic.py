@@ -10,6 +10,7 @@ from onpolicy.algorithms.utils.rnn import RNNLayer
 from onpolicy.algorithms.utils.act import ACTLayer
 from onpolicy.algorithms.utils.popart import PopArt
 from onpolicy.utils.util import get_shape_from_obs_space, get_graph_obs_space, strip_graph_obs_space, get_graph_obs_space_idx
+from onpolicy.utils.collated_graphs import CollatedObs, unique_graphs
 
 from torch_geometric.data import Batch
 from torch_geometric.utils import to_dense_batch
@@ -36,6 +37,8 @@ class R_Actor(nn.Module):
         self._use_recurrent_policy = args.use_recurrent_policy
         self._use_gnn = args.use_gnn_policy
         self._use_gnn_mlp = args.use_gnn_mlp_policy
+        self._use_gnn_dedup = args.use_gnn_dedup
+        self._gnn_dropout_rate = args.gnn_dropout_rate
         self._recurrent_N = args.recurrent_N
         self.tpdv = dict(dtype=torch.float32, device=device)
         self.device = device
@@ -88,6 +91,76 @@ class R_Actor(nn.Module):
 
         self.to(device)
 
+    def _gatherScores(self, graphs, scores, load_drop_scores):
+        """
+        Gather the neighbor and load/drop scores for every graph in the batch at once.
+        :param graphs: (torch_geometric.data.Batch) batched observation graphs carrying neighbor_idx and agent_idx.
+        :param scores: (torch.Tensor) per-node neighbor scores of shape [batch_size, MAX_NODES, 1].
+        :param load_drop_scores: (torch.Tensor) per-node load/drop scores of shape [batch_size, MAX_NODES, 2].
+
+        :return scores_shifted: (torch.Tensor) neighbor scores in action order, zero-padded to MAX_NEIGHBORS.
+        :return ld_scores_shifted: (torch.Tensor) load/drop scores of the node representing each agent.
+        """
+        nbrIdx = torch.as_tensor(graphs.neighbor_idx, device=self.device)
+        if nbrIdx.shape[1] < self.MAX_NEIGHBORS:
+            nbrIdx = F.pad(nbrIdx, (0, self.MAX_NEIGHBORS - nbrIdx.shape[1]), mode='constant', value=-1)
+        nbrIdx = nbrIdx[:, :self.MAX_NEIGHBORS]
+
+        # Padding entries (-1) gather node 0 and are zeroed out afterwards.
+        valid = nbrIdx >= 0
+        scores_shifted = scores[:, :, 0].gather(1, nbrIdx.clamp(min=0))
+        scores_shifted = torch.where(valid, scores_shifted, 0.0)
+
+        agent_idx = torch.as_tensor(graphs.agent_idx, device=self.device).long().reshape(-1)
+        ld_scores_shifted = load_drop_scores[torch.arange(agent_idx.shape[0], device=self.device), agent_idx]
+
+        return scores_shifted, ld_scores_shifted
+
+    def _splitGraphObs(self, obs):
+        """
+        Split observations into their batched graphs and their non-graph features.
+        :param obs: (np.ndarray / CollatedObs) observations, whose graphs may already have been batched by the buffer.
+
+        :return graphs: (torch_geometric.data.Batch) batched observation graphs.
+        :return obs_nongraph: (torch.Tensor) non-graph observation features.
+        """
+        if isinstance(obs, CollatedObs):
+            graphs = obs.graphs
+            obs = obs.obs
+        else:
+            graphs = Batch.from_data_list(obs[:, self.obs_space_graph_idx])
+
+        nonGraphIdx = [i for i in range(obs.shape[1]) if i != self.obs_space_graph_idx]
+        obs_nongraph = check(obs[:, nonGraphIdx].astype(np.float32)).to(**self.tpdv)
+
+        return graphs, obs_nongraph
+
+    def _encodeGraphs(self, graphs):
+        """
+        Pass batched graphs through the GNN.
+        If enabled, identical graphs (e.g. those of agents that share all observations) are only encoded once. This is
+        skipped while dropout is active, since each copy of a graph would otherwise draw its own dropout mask.
+        :param graphs: (torch_geometric.data.Batch) batched observation graphs.
+
+        :return node_feats: (torch.Tensor) GNN node features of shape [batch_size, num_nodes, num_feats].
+        """
+        inverse = None
+        if self._use_gnn_dedup and (not self.training or self._gnn_dropout_rate == 0):
+            unique, inverse = unique_graphs(graphs)
+            if unique.num_graphs < graphs.num_graphs:
+                graphs = unique
+            else:
+                inverse = None
+
+        graphs = graphs.to(self.device, "x", "edge_attr", "edge_index")
+        node_feats = self.base(graphs.x, graphs.edge_attr, graphs.edge_index)
+
+        # Restore the shape of [batch_size, num_nodes, num_feats] from [batch_size*num_nodes, num_feats], copying the features of repeated graphs.
+        node_feats, _ = to_dense_batch(node_feats, graphs.batch.to(self.device))
+        if inverse is not None:
+            node_feats = node_feats[inverse.to(self.device)]
+        return node_feats
+
     def forward(self, obs, rnn_states, masks, available_actions=None, deterministic=False):
         """
         Compute actions from the given inputs.
@@ -109,17 +182,10 @@ class R_Actor(nn.Module):
 
         if self._use_gnn:
             # Split observation into graph and non-graph components.
-            obs_graph = obs[:, self.obs_space_graph_idx]
-            nonGraphIdx = [i for i in range(obs.shape[1]) if i != self.obs_space_graph_idx]
-            obs_nongraph = obs[:, nonGraphIdx]
-            obs_nongraph = check(obs_nongraph.astype(np.float32)).to(**self.tpdv)
+            graphs, obs_nongraph = self._splitGraphObs(obs)
 
-            # Batch the graphs and pass through GNN.
-            graphs = Batch.from_data_list(obs_graph).to(self.device, "x", "edge_attr", "edge_index")
-            actor_features = self.base(graphs.x, graphs.edge_attr, graphs.edge_index)
-
-            # Restore the original shape of [batch_size, num_nodes (including agents), num_feats] from [batch_size*num_nodes, num_feats]
-            actor_features, _ = to_dense_batch(actor_features, graphs.batch.to(self.device))
+            # Pass the batched graphs through GNN, with node features of shape [batch_size, num_nodes (including agents), num_feats].
+            actor_features = self._encodeGraphs(graphs)
 
             aggr = self.base.graphAggr(actor_features, aggr="add")
         
@@ -140,23 +206,7 @@ class R_Actor(nn.Module):
                 load_drop_masked = torch.where(agent_mask, actor_features, 0.0)
                 load_drop_scores = self.load_drop_scorer(load_drop_masked)
                 
-                # Shift the scores to the correct position.
-                scores_shifted = torch.zeros((actor_features.shape[0], self.MAX_NEIGHBORS), **self.tpdv)
-                for i in range(actor_features.shape[0]):
-                    if graphs.agent_edge[i][0] is not None:
-                        nbrs = check(np.array(graphs.neighbors[i])).to(**self.tpdv).int()
-                    else:
-                        # If the agent is on a node, the first neighbor is the current node, so ignore its score.
-                        nbrs = check(np.array(graphs.neighbors[i][1:])).to(**self.tpdv).int()
-                    scores_shifted[i, :nbrs.shape[0]] = scores[i, nbrs, 0]
-
-                actor_features = scores_shifted
-
-                # Shift the load drop scores to the correct position
-                ld_scores_shifted = torch.zeros((actor_features.shape[0], 2), **self.tpdv)
-                for i in range(actor_features.shape[0]):
-                    ld = check(np.array(graphs.agent_idx[i])).to(**self.tpdv).int()
-                    ld_scores_shifted[i, :] = load_drop_scores[i, ld, :]
+                actor_features, ld_scores_shifted = self._gatherScores(graphs, scores, load_drop_scores)
 
             elif hasattr(graphs, "agent_idx"):
                 agent_idx = torch.from_numpy(np.array(graphs.agent_idx)).reshape(-1, 1).to(self.device)
@@ -207,17 +257,10 @@ class R_Actor(nn.Module):
 
         if self._use_gnn:
             # Split observation into graph and non-graph components.
-            obs_graph = obs[:, self.obs_space_graph_idx]
-            nonGraphIdx = [i for i in range(obs.shape[1]) if i != self.obs_space_graph_idx]
-            obs_nongraph = obs[:, nonGraphIdx]
-            obs_nongraph = check(obs_nongraph.astype(np.float32)).to(**self.tpdv)
-
-            # Batch the graphs and pass through GNN.
-            graphs = Batch.from_data_list(obs_graph).to(self.device, "x", "edge_attr", "edge_index")
-            actor_features = self.base(graphs.x, graphs.edge_attr, graphs.edge_index)
+            graphs, obs_nongraph = self._splitGraphObs(obs)
 
-            # Restore the original shape of [batch_size, num_agents, num_feats] from [batch_size*num_agents, num_feats]
-            actor_features, _ = to_dense_batch(actor_features, graphs.batch.to(self.device))
+            # Pass the batched graphs through GNN, with node features of shape [batch_size, num_nodes (including agents), num_feats].
+            actor_features = self._encodeGraphs(graphs)
 
             aggr = self.base.graphAggr(actor_features, aggr="add")
         
@@ -238,23 +281,7 @@ class R_Actor(nn.Module):
                 load_drop_masked = torch.where(agent_mask, actor_features, 0.0)
                 load_drop_scores = self.load_drop_scorer(load_drop_masked)
                 
-                # Shift the scores to the correct position.
-                scores_shifted = torch.zeros((actor_features.shape[0], self.MAX_NEIGHBORS), **self.tpdv)
-                for i in range(actor_features.shape[0]):
-                    if graphs.agent_edge[i][0] is not None:
-                        nbrs = check(np.array(graphs.neighbors[i])).to(**self.tpdv).int()
-                    else:
-                        # If the agent is on a node, the first neighbor is the current node, so ignore its score.
-                        nbrs = check(np.array(graphs.neighbors[i][1:])).to(**self.tpdv).int()
-                    scores_shifted[i, :nbrs.shape[0]] = scores[i, nbrs, 0]
-
-                actor_features = scores_shifted
-
-                # Shift the load drop scores to the correct position
-                ld_scores_shifted = torch.zeros((actor_features.shape[0], 2), **self.tpdv)
-                for i in range(actor_features.shape[0]):
-                    ld = check(np.array(graphs.agent_idx[i])).to(**self.tpdv).int()
-                    ld_scores_shifted[i, :] = load_drop_scores[i, ld, :]
+                actor_features, ld_scores_shifted = self._gatherScores(graphs, scores, load_drop_scores)
 
             elif hasattr(graphs, "agent_idx"):
                 agent_idx = torch.from_numpy(np.array(graphs.agent_idx)).reshape(-1, 1).to(self.device)
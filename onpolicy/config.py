@@ -228,6 +228,8 @@ def get_config():
                         help="Number of node types.")  
     parser.add_argument("--gnn_skip_connections", action='store_true',
                         default=False, help='Whether to use a GNN-based critic')
+    parser.add_argument("--use_gnn_dedup", action='store_true',
+                        default=False, help='Whether to encode identical observation graphs in a batch only once (skipped while GNN dropout is active)')
     parser.add_argument("--gnn_max_nodes", type=int, default=50,
                         help="Maximum number of nodes that the GNN can support.")
     parser.add_argument("--gnn_max_neighbors", type=int, default=15,
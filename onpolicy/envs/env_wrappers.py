@@ -1,9 +1,10 @@
 """
 Modified from OpenAI Baselines code to work with multi-agent envs
 """
+import os
 import numpy as np
-import torch
-from multiprocessing import Process, Pipe
+from collections import deque
+from multiprocessing import Process, Pipe, shared_memory, resource_tracker
 from abc import ABC, abstractmethod
 from onpolicy.utils.util import tile_images
 
@@ -106,6 +107,21 @@ class ShareVecEnv(ABC):
         self.step_async(actions)
         return self.step_wait()
 
+    def step_async_subset(self, actions, indices):
+        """
+        Tell the environments at the given indices to start taking a step with the given actions.
+        Call step_wait_subset() with the same indices to get the results. Several disjoint subsets
+        may be pending at once, which lets the caller overlap stepping with other work.
+        """
+        raise NotImplementedError
+
+    def step_wait_subset(self, indices):
+        """
+        Wait for the step taken with step_async_subset() by the environments at the given indices.
+        Returns (obs, rews, dones, infos) for those environments, as step_wait() does for all of them.
+        """
+        raise NotImplementedError
+
     def render(self, mode='human'):
         imgs = self.get_images()
         bigimg = tile_images(imgs)
@@ -253,6 +269,7 @@ class SubprocVecEnv(ShareVecEnv):
         observation_space, share_observation_space, action_space = self.remotes[0].recv()
         ShareVecEnv.__init__(self, len(env_fns), observation_space,
                              share_observation_space, action_space)
+        self.pending = set()
 
     def step_async(self, actions):
         for remote, action in zip(self.remotes, actions):
@@ -265,6 +282,17 @@ class SubprocVecEnv(ShareVecEnv):
         obs, rews, dones, infos = zip(*results)
         return np.stack(obs), np.stack(rews), np.stack(dones), infos
 
+    def step_async_subset(self, actions, indices):
+        for i, action in zip(indices, actions):
+            self.remotes[i].send(('step', action))
+        self.pending.update(indices)
+
+    def step_wait_subset(self, indices):
+        results = [self.remotes[i].recv() for i in indices]
+        self.pending.difference_update(indices)
+        obs, rews, dones, infos = zip(*results)
+        return np.stack(obs), np.stack(rews), np.stack(dones), infos
+
     def reset(self):
         for remote in self.remotes:
             remote.send(('reset', None))
@@ -283,6 +311,8 @@ class SubprocVecEnv(ShareVecEnv):
         if self.waiting:
             for remote in self.remotes:
                 remote.recv()
+        for i in self.pending:
+            self.remotes[i].recv()
         for remote in self.remotes:
             remote.send(('close', None))
         for p in self.ps:
@@ -297,6 +327,336 @@ class SubprocVecEnv(ShareVecEnv):
             return np.stack(frame) 
 
 
+def default_envs_per_worker(num_envs):
+    """
+    Returns the number of environments each worker process should host so that there is about one worker per CPU core.
+    """
+    return max(1, -(-num_envs // (os.cpu_count() or 1)))
+
+
+def multiworker(remote, parent_remote, env_fn_wrapper):
+    parent_remote.close()
+    envs = [env_fn() for env_fn in env_fn_wrapper.x]
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            # data holds (local env index, action) pairs, which are all stepped before replying once.
+            results = []
+            for i, action in data:
+                ob, reward, done, info = envs[i].step(action)
+                if 'bool' in done.__class__.__name__:
+                    if done:
+                        ob = envs[i].reset()
+                else:
+                    if np.all(done):
+                        ob = envs[i].reset()
+                results.append((ob, reward, done, info))
+            remote.send(results)
+        elif cmd == 'reset':
+            remote.send([env.reset() for env in envs])
+        elif cmd == 'render':
+            if data == "rgb_array":
+                remote.send([env.render(mode=data) for env in envs])
+            elif data == "human":
+                for env in envs:
+                    env.render(mode=data)
+        elif cmd == 'reset_task':
+            remote.send([env.reset_task() for env in envs])
+        elif cmd == 'close':
+            for env in envs:
+                env.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send((envs[0].observation_space, envs[0].share_observation_space, envs[0].action_space))
+        else:
+            raise NotImplementedError
+
+
+class MultiEnvSubprocVecEnv(ShareVecEnv):
+    """
+    A variant of SubprocVecEnv in which each worker process hosts several consecutive environments and steps
+    them in a loop, resetting each one when it is done. A step then costs one message per worker instead of
+    one per environment, and there need not be more processes than CPU cores.
+    Returns the same structures as SubprocVecEnv.
+    """
+    def __init__(self, env_fns, spaces=None, envs_per_worker=None):
+        """
+        envs: list of gym environments to run in subprocesses
+        envs_per_worker: number of environments hosted by each worker, by default about n_envs / n_cores
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        if envs_per_worker is None:
+            envs_per_worker = default_envs_per_worker(nenvs)
+        self.worker_envs = [list(range(i, min(i + envs_per_worker, nenvs))) for i in range(0, nenvs, envs_per_worker)]
+        self.env_workers = [(w, i) for w, envs in enumerate(self.worker_envs) for i in range(len(envs))]
+        nworkers = len(self.worker_envs)
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nworkers)])
+        self.ps = [Process(target=multiworker, args=(work_remote, remote, CloudpickleWrapper([env_fns[i] for i in envs])))
+                   for (work_remote, remote, envs) in zip(self.work_remotes, self.remotes, self.worker_envs)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, share_observation_space, action_space = self.remotes[0].recv()
+        ShareVecEnv.__init__(self, len(env_fns), observation_space,
+                             share_observation_space, action_space)
+
+        # The subsets each worker has been asked to step, in order, and replies received ahead of their turn.
+        self.pending = [deque() for _ in range(nworkers)]
+        self.early_replies = {}
+
+    def step_async(self, actions):
+        self.step_async_subset(actions, list(range(self.num_envs)))
+        self.waiting = True
+
+    def step_wait(self):
+        results = self.step_wait_subset(list(range(self.num_envs)))
+        self.waiting = False
+        return results
+
+    def step_async_subset(self, actions, indices):
+        key = tuple(indices)
+        requests = {}
+        for i, action in zip(indices, actions):
+            w, j = self.env_workers[i]
+            requests.setdefault(w, []).append((j, action))
+        for w, data in requests.items():
+            self.remotes[w].send(('step', data))
+            self.pending[w].append(key)
+
+    def step_wait_subset(self, indices):
+        key = tuple(indices)
+        results = {}
+        for w in sorted(set(self.env_workers[i][0] for i in indices)):
+            # The worker replies for its environments in the order in which they were given.
+            reply = self._recv_step(w, key)
+            results.update(zip([i for i in indices if self.env_workers[i][0] == w], reply))
+        obs, rews, dones, infos = zip(*[results[i] for i in indices])
+        return np.stack(obs), np.stack(rews), np.stack(dones), infos
+
+    def _recv_step(self, w, key):
+        # Replies arrive in the order in which the subsets were sent, which may differ from the order they are waited for.
+        if (w, key) in self.early_replies:
+            return self.early_replies.pop((w, key))
+        while True:
+            pending_key = self.pending[w].popleft()
+            reply = self.remotes[w].recv()
+            if pending_key == key:
+                return reply
+            self.early_replies[(w, pending_key)] = reply
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        obs = [ob for remote in self.remotes for ob in remote.recv()]
+        return np.stack(obs)
+
+    def reset_task(self):
+        for remote in self.remotes:
+            remote.send(('reset_task', None))
+        return np.stack([ob for remote in self.remotes for ob in remote.recv()])
+
+    def close(self):
+        if self.closed:
+            return
+        for remote, pending in zip(self.remotes, self.pending):
+            for _ in pending:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
+
+    def render(self, mode="rgb_array"):
+        for remote in self.remotes:
+            remote.send(('render', mode))
+        if mode == "rgb_array":
+            frame = [fr for remote in self.remotes for fr in remote.recv()]
+            return np.stack(frame)
+
+
+def _attach_shared_buffers(specs):
+    """
+    Attaches to the shared memory blocks described by specs, a dict mapping each key to (name, shape, dtype, index).
+    Returns the attached blocks and a dict of array views, each restricted to the given row index.
+    """
+    blocks, buffers = [], {}
+    for key, (name, shape, dtype, index) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        buffers[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)[index]
+    return blocks, buffers
+
+
+def shmworker(remote, parent_remote, env_fn_wrapper):
+    parent_remote.close()
+    env = env_fn_wrapper.x()
+    blocks, buffers = [], {}
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            ob, reward, done, info = env.step(data)
+            if 'bool' in done.__class__.__name__:
+                if done:
+                    ob = env.reset()
+            else:
+                if np.all(done):
+                    ob = env.reset()
+
+            for k, v in ob.items():
+                buffers[k][...] = v
+            buffers['rewards'][...] = np.reshape(reward, buffers['rewards'].shape)
+            buffers['dones'][...] = np.reshape(done, buffers['dones'].shape)
+            remote.send(info)
+        elif cmd == 'reset':
+            ob = env.reset()
+            if buffers:
+                for k, v in ob.items():
+                    buffers[k][...] = v
+                remote.send(None)
+            else:
+                # The shared buffers are allocated based on the first observation.
+                remote.send(ob)
+        elif cmd == 'attach':
+            blocks, buffers = _attach_shared_buffers(data)
+            remote.send(None)
+        elif cmd == 'close':
+            env.close()
+            buffers = {}
+            for block in blocks:
+                block.close()
+            remote.close()
+            break
+        elif cmd == 'get_spaces':
+            remote.send((env.observation_space, env.share_observation_space, env.action_space))
+        else:
+            raise NotImplementedError
+
+
+class SharedMemorySubprocVecEnv(ShareVecEnv):
+    """
+    A variant of SubprocVecEnv for environments whose observations are dicts of fixed-shape arrays,
+    such as SDEnv with flattened observations. Workers write observations, rewards and dones straight
+    into preallocated shared memory, so only the (small) infos are sent over the pipes.
+    The buffers are allocated from the observations returned by the first reset.
+    Returns the same structures as SubprocVecEnv.
+    """
+    def __init__(self, env_fns, spaces=None):
+        """
+        envs: list of gym environments to run in subprocesses
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
+        self.ps = [Process(target=shmworker, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
+                   for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        # Start the resource tracker before the workers, so that they share it and the shared blocks are only unlinked by close().
+        resource_tracker.ensure_running()
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, share_observation_space, action_space = self.remotes[0].recv()
+        ShareVecEnv.__init__(self, len(env_fns), observation_space,
+                             share_observation_space, action_space)
+
+        self.blocks = {}
+        self.buffers = {}
+        self.pending = set()
+
+    def _allocate_buffers(self, obs):
+        # Allocate one shared block per array for all environments, laid out like the given observations.
+        specs = {k: (np.shape(v), np.asarray(v).dtype) for k, v in obs[0].items()}
+        for k, (shape, dtype) in specs.items():
+            if dtype == object:
+                raise ValueError(f"Observation {k} does not have a fixed shape, which SharedMemorySubprocVecEnv requires.")
+        num_agents = len(self.action_space)
+        specs['rewards'] = ((num_agents, 1), np.dtype(np.float32))
+        specs['dones'] = ((num_agents,), np.dtype(bool))
+
+        for k, (shape, dtype) in specs.items():
+            shape = (self.num_envs,) + tuple(shape)
+            block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+            self.blocks[k] = block
+            self.buffers[k] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        for i, remote in enumerate(self.remotes):
+            remote.send(('attach', {k: (self.blocks[k].name, self.buffers[k].shape, self.buffers[k].dtype, i) for k in self.buffers}))
+        for remote in self.remotes:
+            remote.recv()
+        self.obs_keys = list(specs)[:-2]
+
+        for i, ob in enumerate(obs):
+            for k, v in ob.items():
+                self.buffers[k][i] = v
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self.waiting = True
+
+    def step_wait(self):
+        infos = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        return self._combined_obs(), self.buffers['rewards'].copy(), self.buffers['dones'].copy(), infos
+
+    def step_async_subset(self, actions, indices):
+        for i, action in zip(indices, actions):
+            self.remotes[i].send(('step', action))
+        self.pending.update(indices)
+
+    def step_wait_subset(self, indices):
+        infos = [self.remotes[i].recv() for i in indices]
+        self.pending.difference_update(indices)
+        return self._combined_obs(indices), self.buffers['rewards'][indices], self.buffers['dones'][indices], infos
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        obs = [remote.recv() for remote in self.remotes]
+        if not self.buffers:
+            self._allocate_buffers(obs)
+        return self._combined_obs()
+
+    def _combined_obs(self, indices=None):
+        # Copy out of shared memory, since the workers overwrite it on the next step.
+        if indices is None:
+            indices = list(range(self.num_envs))
+        obs = {k: self.buffers[k][indices] for k in self.obs_keys}
+        combined_obs = np.empty((len(indices),), dtype=object)
+        for i in range(len(indices)):
+            combined_obs[i] = {k: v[i] for k, v in obs.items()}
+        return combined_obs
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for i in self.pending:
+            self.remotes[i].recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.buffers = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.closed = True
+
+
 def shareworker(remote, parent_remote, env_fn_wrapper):
     parent_remote.close()
     env = env_fn_wrapper.x()
@@ -684,6 +1044,22 @@ class DummyVecEnv(ShareVecEnv):
         self.actions = None
         return obs, rews, dones, infos
 
+    def step_async_subset(self, actions, indices):
+        if self.actions is None:
+            self.actions = {}
+        self.actions.update(zip(indices, actions))
+
+    def step_wait_subset(self, indices):
+        # The environments are stepped synchronously, so the subset is simply stepped now.
+        envs, actions = self.envs, self.actions
+        self.envs = [envs[i] for i in indices]
+        self.actions = [actions.pop(i) for i in indices]
+        try:
+            return self.step_wait()
+        finally:
+            self.envs = envs
+            self.actions = actions if actions else None
+
     def reset(self):
         obs = [env.reset() for env in self.envs]
         return np.array(obs)
@@ -3,10 +3,12 @@ import random
 from sdzoo.env.sdzoo import parallel_env
 from sdzoo.env.sd_graph import SDGraph
 from sdzoo.env.communication_model import CommunicationModel
-from gymnasium.spaces.utils import flatten, flatten_space
+from gymnasium.spaces.utils import flatten, flatten_space, flatdim
 from gymnasium.spaces import Dict, Graph
 import numpy as np
 
+from onpolicy.utils.util import FlattenPlan
+
 
 class SDEnv(object): 
     '''Wrapper to make the Patrolling Zoo environment compatible'''
@@ -76,6 +78,7 @@ class SDEnv(object):
         # Set up observation space.
         if self.flatten_observations:
             self.observation_space = [flatten_space(self.env.observation_spaces[a]) for a in self.env.possible_agents]
+            self.obs_plan = FlattenPlan(self.env.observation_spaces)
         else:
             self.observation_space = [self.env.observation_spaces[a] for a in self.env.possible_agents]
         
@@ -86,6 +89,22 @@ class SDEnv(object):
         else:
             self.share_observation_space = [self.env.state_space for a in self.env.possible_agents]
 
+        # Flatten the global state of each agent into a row of a preallocated (num_agents, D) buffer.
+        # If the global state only differs between agents in a few ego entries, the shared part is flattened once per step.
+        self.share_obs_shared = self.flatten_observations_global and self.env.observe_method_global in parallel_env.SHARED_STATE_METHODS
+        if self.flatten_observations_global:
+            dtype = FlattenPlan(self.env.state_space).dtype
+            self.share_obs_buffer = np.zeros((self.num_agents, flatdim(self.env.state_space)), dtype=dtype)
+            self.share_obs_plans = [FlattenPlan(self.env.state_space, out=self.share_obs_buffer[i]) for i in range(self.num_agents)]
+        if self.share_obs_shared:
+            self.share_obs_slices = {}
+            self.share_obs_key_plans = {}
+            offset = 0
+            for k, space in self.env.state_space.spaces.items():
+                self.share_obs_slices[k] = slice(offset, offset + flatdim(space))
+                self.share_obs_key_plans[k] = [FlattenPlan(space, out=self.share_obs_buffer[i, self.share_obs_slices[k]]) for i in range(self.num_agents)]
+                offset += flatdim(space)
+
 
     def reset(self):
         self.ppoSteps = 0
@@ -95,7 +114,7 @@ class SDEnv(object):
 
         combined_obs = {
             "obs": self._obs_wrapper(obs),
-            "share_obs": self._share_obs_wrapper(self.env.state_all()),
+            "share_obs": self._share_obs(),
             "available_actions": self._available_actions_wrapper(self.env.available_actions)
         }
 
@@ -135,8 +154,14 @@ class SDEnv(object):
             # We want to determine if this is the last step when using syncronized step skipping.
             lastStep = last_step or (self.args.skip_steps_sync and self.ppoSteps >= self.args.episode_length - 1)
             
-            # Take a step.
-            obs, reward, done, trunc, info = self.env.step(actionPz, lastStep=lastStep)
+            # Take a step. The observations are only built once the (macro) step is over, below.
+            if self.args.skip_steps_event:
+                # Jump straight to the next step in which an agent is ready.
+                _, reward, done, trunc, info = self.env.stepToNextEvent(actionPz, lastStep=lastStep, observe=False)
+                steps = info.pop("steps")
+            else:
+                _, reward, done, trunc, info = self.env.step(actionPz, lastStep=lastStep, observe=False)
+                steps = 1
 
             # Convert the done dict to a list.
             done = [done[a] for a in self.env.possible_agents]
@@ -146,12 +171,6 @@ class SDEnv(object):
             # Consider the agent done if done OR truncated flags set.
             done = [d or t for d, t in zip(done, trunc)]
 
-            combined_obs = {
-                "obs": self._obs_wrapper(obs),
-                "share_obs": self._share_obs_wrapper(self.env.state_all()),
-                "available_actions": self._available_actions_wrapper(self.env.available_actions)
-            }
-
             # Increase reward.
             rewards += np.array([reward[a] for a in self.env.possible_agents]).reshape(-1, 1)
 
@@ -159,7 +178,7 @@ class SDEnv(object):
 
             # Increase the step count.
             for a in self.env.possible_agents:
-                self.deltaSteps[a] += 1
+                self.deltaSteps[a] += steps
 
             # Only run once if skip_steps_sync is false.
             if not self.args.skip_steps_sync:
@@ -168,6 +187,16 @@ class SDEnv(object):
             # Check if any agents are ready
             ready = any([info[a]["ready"] for a in self.env.agents])
 
+            # If the step continues, skip building the global state, but keep the belief updates that come with it.
+            if not ready and not all(done):
+                self.env.observeState()
+
+        combined_obs = {
+            "obs": self._obs_wrapper(self.env.observeDeferred()),
+            "share_obs": self._share_obs(),
+            "available_actions": self._available_actions_wrapper(self.env.available_actions)
+        }
+
         # If we are sharing the reward, then we need to sum the rewards.
         if self.share_reward:
             global_reward = np.sum(rewards)
@@ -202,25 +231,42 @@ class SDEnv(object):
 
     def _obs_wrapper(self, obs):
 
-        # Flatten the PZ observation.
+        # Flatten the PZ observation. The plan reuses its output array between calls, so return a copy.
         if self.flatten_observations:
-            obs = flatten(self.env.observation_spaces, obs)
-            obs = np.reshape(obs, (self.num_agents, -1))
+            obs = self.obs_plan(obs)
+            obs = np.reshape(obs, (self.num_agents, -1)).copy()
         else:
             obs = [obs[a] for a in self.env.possible_agents]
         
         return obs
     
+    def _share_obs(self):
+        # The flattened global state is built in a buffer reused between calls, so return a copy.
+        if self.share_obs_shared:
+            return self._shared_share_obs_wrapper(*self.env.state_all_shared()).copy()
+        return self._share_obs_wrapper(self.env.state_all()).copy()
+
+    def _shared_share_obs_wrapper(self, shared, ego):
+        """
+        Builds the flattened global state of every agent from the state shared by all agents and each agent's ego entries.
+        Note that the returned buffer is reused on the next call.
+        """
+        for k, plans in self.share_obs_key_plans.items():
+            if k in ego[self.env.possible_agents[0]]:
+                for plan, a in zip(plans, self.env.possible_agents):
+                    plan(ego[a][k])
+            else:
+                plans[0](shared[k])
+                self.share_obs_buffer[1:, self.share_obs_slices[k]] = self.share_obs_buffer[0, self.share_obs_slices[k]]
+        return self.share_obs_buffer
+
     def _share_obs_wrapper(self, obs):
 
         # Flatten the PZ observation.
         if self.flatten_observations_global:
-            res = []
-            for a in self.env.possible_agents:
-                res.append(flatten(self.env.state_space, obs[a]))
-            res = np.array(res)
-            res = np.reshape(res, (self.num_agents, -1))
-            return res
+            for plan, a in zip(self.share_obs_plans, self.env.possible_agents):
+                plan(obs[a])
+            return self.share_obs_buffer
 
             #This older code below is for use with the state() method. Above code is for the state_all() method.
             # Flatten the PZ observation.
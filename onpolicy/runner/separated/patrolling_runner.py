@@ -11,6 +11,7 @@ import wandb
 
 from onpolicy.utils.shared_buffer import SharedReplayBuffer
 from onpolicy.utils.separated_buffer import SeparatedReplayBuffer
+from onpolicy.utils.packed_buffer import PackedReplayBuffer
 from onpolicy.utils.util import update_linear_schedule
 from onpolicy.runner.separated.base_runner import Runner
 
@@ -41,44 +42,35 @@ class PatrollingRunner(Runner):
                     ta.value_normalizer = self.critic.v_out
             
             # Set up a shared replay buffer for the critic.
-            args = copy.deepcopy(self.all_args)
-            args.episode_length = self.all_args.episode_length * self.n_rollout_threads
-            if self.all_args.skip_steps_async:
-                args.episode_length *= self.num_agents
-            self.critic_buffer = SharedReplayBuffer(
-                args,
+            # With asynchronous skipping, the packed buffer below keeps the critic input instead.
+            if not self.all_args.skip_steps_async:
+                args = copy.deepcopy(self.all_args)
+                args.episode_length = self.all_args.episode_length * self.n_rollout_threads
+                self.critic_buffer = SharedReplayBuffer(
+                    args,
+                    self.num_agents,
+                    self.envs.observation_space[0],
+                    self.envs.share_observation_space[0],
+                    self.envs.action_space[0]
+                )
+            
+        
+        # Set up a single packed replay buffer for the asynchronous actors of every rollout thread.
+        if self.all_args.skip_steps_async:
+            share_observation_space = self.envs.share_observation_space[0] if self.use_centralized_V else self.envs.observation_space[0]
+            self.buffer = PackedReplayBuffer(
+                self.all_args,
                 self.num_agents,
                 self.envs.observation_space[0],
-                self.envs.share_observation_space[0],
+                share_observation_space,
                 self.envs.action_space[0]
             )
-            
-        
-        # Set up additional replay buffers for asynchronous actors.
-        if self.all_args.skip_steps_async:
-            self.buffer = [[] for i in range(self.n_rollout_threads)]
-            for i in range(self.n_rollout_threads):
-                for agent_id in range(self.num_agents):
-                    share_observation_space = self.envs.share_observation_space[agent_id] if self.use_centralized_V else self.envs.observation_space[agent_id]
-
-                    # make a copy of all_args but with n_rollout_threads = 1, since we are hacking this to use a separate buffer per rollout thread per agent.
-                    args = copy.deepcopy(self.all_args)
-                    args.n_rollout_threads = 1
-                    # Account for potentially all agents adding to critic buffer in last step...
-                    args.episode_length *= self.num_agents * self.n_rollout_threads
-                    bu = SeparatedReplayBuffer(
-                        args,
-                        self.envs.observation_space[agent_id],
-                        share_observation_space,
-                        self.envs.action_space[agent_id]
-                    )
-                    self.buffer[i].append(bu)
 
-                    # Use same actor for all.
-                    if self.all_args.sep_share_policy:
-                        for po in self.policy:
-                            po.actor = self.policy[0].actor
-                            po.actor_optimizer = self.policy[0].actor_optimizer
+            # Use same actor for all.
+            if self.all_args.sep_share_policy:
+                for po in self.policy:
+                    po.actor = self.policy[0].actor
+                    po.actor_optimizer = self.policy[0].actor_optimizer
 
         
         # Perform restoration.
@@ -115,13 +107,9 @@ class PatrollingRunner(Runner):
             # Set the delta steps to 1.
             delta_steps = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.int32)
 
-            # In async mode, reset the buffer for each rollout thread for each agent.
+            # In async mode, start a new episode in the packed buffer.
             if self.all_args.skip_steps_async:
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        self.buffer[i][agent_id].step = 0
-                if self.use_centralized_V:
-                    self.critic_buffer.step = 0
+                self.buffer.reset()
             
             # No previous data.
             data_critic_prev = None
@@ -133,43 +121,42 @@ class PatrollingRunner(Runner):
                     # If this is the last step, set all agents to ready.
                     self.ready = np.ones((self.n_rollout_threads, self.num_agents), dtype=bool)
 
-                # Sample actions, collect values and probabilities.
-                values, actions, action_log_probs, rnn_states, rnn_states_critic, actions_env = self.collect(step)
-                    
-                # Set up combined action and metadata structure to feed to the environment.
-                # We do this to avoid modifying the underlying MAPPO code to add another argument.
-                action_metadata = []
-                for i in range(self.n_rollout_threads):
-                    action_metadata.append({
-                        "action": actions_env[i],
-                        "metadata": {
-                            "last_step": last_step
-                        }
-                    })
-                
-                # Take the step and observe.
-                combined_obs, rewards, dones, infos = self.envs.step(action_metadata)
+                if self.all_args.pipelined_rollout:
+                    # Overlap policy inference on one half of the rollout threads with stepping the other half.
+                    values, actions, action_log_probs, rnn_states, rnn_states_critic, actions_env, \
+                        combined_obs, rewards, dones, infos = self._collect_and_step_pipelined(step, last_step)
+                else:
+                    # Sample actions, collect values and probabilities.
+                    values, actions, action_log_probs, rnn_states, rnn_states_critic, actions_env = self.collect(step)
+
+                    # Set up combined action and metadata structure to feed to the environment.
+                    # We do this to avoid modifying the underlying MAPPO code to add another argument.
+                    action_metadata = self._action_metadata(actions_env, last_step)
+
+                    # Take the step and observe.
+                    combined_obs, rewards, dones, infos = self.envs.step(action_metadata)
 
                 # Process information after taking the step.
                 obs, share_obs, available_actions = self._process_combined_obs(combined_obs)
-                for i in range(self.n_rollout_threads):
-                    for a in range(self.num_agents):
-                        # Pull agent ready state from the info message.
-                        self.ready[i, a] = infos[i]["ready"][a]
 
-                        # Get the number of steps taken by each agent since the agent was last ready.
-                        delta_steps = np.array([info["deltaSteps"] for info in infos])
+                # Pull agent ready state from the info messages.
+                self.ready[:] = np.array([info["ready"] for info in infos], dtype=bool)
 
-                        # Update the reward sums.
-                        rewardSums[i, a] = rewards[i][a]
+                # Get the number of steps taken by each agent since the agent was last ready.
+                delta_steps = np.array([info["deltaSteps"] for info in infos])
 
-                        # Update the temporary buffer.
-                        if actions[i][a] != None:
-                            tb_actions[i, a] = actions[i][a]
-                            tb_action_log_probs[i, a] = action_log_probs[i][a]
-                            tb_rnn_states[i, a] = rnn_states[i][a]
-                            tb_rnn_states_critic[i, a] = rnn_states_critic[i][a]
-                            tb_value_preds[i, a] = values[i][a]
+                # Update the reward sums.
+                rewardSums[:] = np.reshape(rewards, rewardSums.shape)
+
+                # Update the temporary buffer for the agents that were given an action.
+                acted = [(i, a) for i in range(self.n_rollout_threads) for a in range(self.num_agents) if actions[i][a] is not None]
+                if len(acted) > 0:
+                    idx = tuple(np.array(acted).T)
+                    tb_actions[idx] = [actions[i][a] for i, a in acted]
+                    tb_action_log_probs[idx] = [action_log_probs[i][a] for i, a in acted]
+                    tb_rnn_states[idx] = [rnn_states[i][a] for i, a in acted]
+                    tb_rnn_states_critic[idx] = [rnn_states_critic[i][a] for i, a in acted]
+                    tb_value_preds[idx] = [values[i][a] for i, a in acted]
 
                 # Combine into single data structure.
                 data = obs, share_obs, rewardSums, dones, infos, tb_value_preds, tb_actions, tb_action_log_probs, tb_rnn_states, tb_rnn_states_critic, delta_steps, available_actions
@@ -178,22 +165,19 @@ class PatrollingRunner(Runner):
                 data_critic_prev = self.insert(data, data_critic_prev)
 
                 # Reset the reward sums for any agents that are ready.
-                for i in range(self.n_rollout_threads):
-                    for a in range(self.num_agents):
-                        if self.ready[i, a]:
-                            rewardSums[i, a] = 0.0
+                rewardSums[self.ready] = 0.0
 
                 # Ensure that all buffers are at step 0.
-                if step == 0 and self.all_args.skip_steps_async:
-                    for i in range(self.n_rollout_threads):
-                        for agent_id in range(self.num_agents):
-                            if self.buffer[i][agent_id].step > 1:
-                                raise RuntimeError(f"Buffer {i}, agent {agent_id} has step {self.buffer[i][agent_id].step} at the start of an episode. Must be <= 1.")
-                if step == 0 and self.use_centralized_V and self.critic_buffer.step > 1:
-                    raise RuntimeError(f"Critic buffer has step {self.critic_buffer.step} at the start of an episode. Must be <= 1.")
+                if step == 0 and self.all_args.skip_steps_async and np.any(self.buffer.steps > 1):
+                    i, agent_id = np.argwhere(self.buffer.steps > 1)[0]
+                    raise RuntimeError(f"Buffer {i}, agent {agent_id} has step {self.buffer.steps[i, agent_id]} at the start of an episode. Must be <= 1.")
+                if step == 0 and self.use_centralized_V and self._critic_step() > 1:
+                    raise RuntimeError(f"Critic buffer has step {self._critic_step()} at the start of an episode. Must be <= 1.")
                 
                 # Check termination conditions.
                 if last_step:
+                    # Only the final infos of the episode are logged.
+                    self._update_env_infos(infos)
                     break
 
                 # Increase the step count.
@@ -224,7 +208,8 @@ class PatrollingRunner(Runner):
                                 int(total_num_steps / (end - start))))
                 
                 if self.all_args.skip_steps_async:
-                    avgEpRewards = np.mean([np.sum(self.buffer[i][a].rewards[:self.buffer[i][a].step]) for a in range(self.num_agents) for j in range(self.n_rollout_threads)])
+                    buf = self.buffer
+                    avgEpRewards = np.mean(np.bincount(buf.pair[:buf.size], weights=buf.rewards[:buf.size, 0], minlength=buf.steps.size))
                 else:
                     avgEpRewards = np.mean([np.sum(self.buffer[a].rewards[:self.buffer[a].step]) for a in range(self.num_agents)])
                 if self.use_wandb:
@@ -248,7 +233,7 @@ class PatrollingRunner(Runner):
         # Split the combined observations into obs and share_obs, then combine across environments.
         obs, share_obs, available_actions = self._process_combined_obs(combined_obs)
 
-        if self.use_centralized_V:
+        if self.use_centralized_V and not self.all_args.skip_steps_async:
             # c_share_obs = np.repeat(share_obs, self.num_agents, axis=1)
             # c_share_obs = np.reshape(c_share_obs, self.critic_buffer.share_obs[0].shape)
             # self.critic_buffer.share_obs[0] = c_share_obs.copy()
@@ -256,13 +241,13 @@ class PatrollingRunner(Runner):
             self.critic_buffer.obs[0] = obs.copy()
             self.critic_buffer.available_actions[0] = available_actions.copy()
 
-        # If using asynchronous skipping, warm-start the buffer for each rollout thread for each agent.
+        # If using asynchronous skipping, warm-start the current state of each rollout thread and agent.
         if self.all_args.skip_steps_async:
-            for i in range(self.n_rollout_threads):
-                for agent_id in range(self.num_agents):
-                    self.buffer[i][agent_id].share_obs[0] = share_obs[i][agent_id].copy()
-                    self.buffer[i][agent_id].obs[0] = obs[i, agent_id].copy()
-                    self.buffer[i][agent_id].available_actions[0] = available_actions[i, agent_id].copy()
+            self.buffer.cur_share_obs[:] = share_obs
+            self.buffer.cur_obs[:] = obs
+            self.buffer.cur_available_actions[:] = available_actions
+            if self.use_centralized_V:
+                self.buffer.critic_share_obs[:] = share_obs
         
         # Otherwise, warm-start the buffer for each agent.
         else:
@@ -272,7 +257,39 @@ class PatrollingRunner(Runner):
                 self.buffer[agent_id].available_actions[0] = available_actions[:, agent_id].copy()
 
     @torch.no_grad()
-    def collect(self, step):
+    def _collect_critic_values(self):
+        ''' Get the centralized critic values and RNN states for all threads and agents at once. '''
+        if self.all_args.skip_steps_async:
+            share_obs = self.buffer.critic_share_obs
+            rnn_states_critic = self.buffer.critic_rnn_states
+            masks = self.buffer.critic_masks
+        else:
+            share_obs = self.critic_buffer.share_obs[self.critic_buffer.step]
+            rnn_states_critic = self.critic_buffer.rnn_states_critic[self.critic_buffer.step]
+            masks = self.critic_buffer.masks[self.critic_buffer.step]
+        return self.trainer[0].policy.get_values_rnn_states(
+            np.concatenate(share_obs),
+            np.concatenate(rnn_states_critic),
+            np.concatenate(masks)
+        )
+
+    def _critic_step(self):
+        ''' Get the number of steps inserted for the centralized critic in this episode. '''
+        if self.all_args.skip_steps_async:
+            return self.buffer.critic_step
+        return self.critic_buffer.step
+
+    @torch.no_grad()
+    def collect(self, step, env_idx=None, critic_values=None):
+        '''
+        Sample actions for the rollout threads in env_idx (all threads by default).
+        Rows of the returned lists for other threads are left as None.
+        critic_values may hold the output of _collect_critic_values() to avoid recomputing it.
+        '''
+        if env_idx is None:
+            env_idx = range(self.n_rollout_threads)
+        rows = list(env_idx)
+
         values = [[None for a in range(self.num_agents)] for idx in range(self.n_rollout_threads)]
         actions = [[None for a in range(self.num_agents)] for idx in range(self.n_rollout_threads)]
         action_log_probs = [[None for a in range(self.num_agents)] for idx in range(self.n_rollout_threads)]
@@ -282,16 +299,63 @@ class PatrollingRunner(Runner):
 
         # If using centralized critic, get values once for all agents.
         if self.use_centralized_V:
-            value, rnn_state_critic = self.trainer[0].policy.get_values_rnn_states(
-                np.concatenate(self.critic_buffer.share_obs[self.critic_buffer.step]),
-                np.concatenate(self.critic_buffer.rnn_states_critic[self.critic_buffer.step]),
-                np.concatenate(self.critic_buffer.masks[self.critic_buffer.step])
-            )
+            if critic_values is None:
+                critic_values = self._collect_critic_values()
+            value, rnn_state_critic = critic_values
 
         # Get actions from the policy.
-        if self.all_args.skip_steps_async:
-            # In asynchronous skipping mode, we use individual buffers for each rollout thread and agent.
-            for i in range(self.n_rollout_threads):
+        if self.all_args.skip_steps_async and self.all_args.sep_share_policy:
+            # All agents share the actor, so sample actions for every ready (thread, agent) pair in one pass.
+            if self.use_centralized_V:
+                value_n = _t2n(value)[0]
+                rnn_state_critic_n = _t2n(rnn_state_critic)[0]
+                for i in rows:
+                    for agent_id in range(self.num_agents):
+                        values[i][agent_id] = value_n
+                        rnn_states_critic[i][agent_id] = rnn_state_critic_n
+
+            ready = [(i, agent_id) for i in rows for agent_id in range(self.num_agents) if self.ready[i, agent_id]]
+            if len(ready) > 0:
+                ti, ai = np.array(ready).T
+                self.trainer[0].prep_rollout()
+                action, action_log_prob, rnn_state = self.policy[0].actor(
+                    self.buffer.cur_obs[ti, ai],
+                    self.buffer.cur_rnn_states[ti, ai],
+                    self.buffer.cur_masks[ti, ai]
+                )
+                action = _t2n(action)
+                action_log_prob = _t2n(action_log_prob)
+                rnn_state = _t2n(rnn_state)
+
+                # Without a centralized critic, each agent has its own critic, so batch per agent instead.
+                if not self.use_centralized_V:
+                    value = np.empty((len(ready), 1), dtype=np.float32)
+                    rnn_state_critic = np.empty(rnn_state.shape, dtype=np.float32)
+                    for agent_id in range(self.num_agents):
+                        idx = np.flatnonzero(ai == agent_id)
+                        if len(idx) == 0:
+                            continue
+                        self.trainer[agent_id].prep_rollout()
+                        v, rsc = self.trainer[agent_id].policy.get_values_rnn_states(
+                            self.buffer.cur_share_obs[ti[idx], ai[idx]],
+                            self.buffer.cur_rnn_states_critic[ti[idx], ai[idx]],
+                            self.buffer.cur_masks[ti[idx], ai[idx]]
+                        )
+                        value[idx] = _t2n(v)
+                        rnn_state_critic[idx] = _t2n(rsc)
+
+                for k, (i, agent_id) in enumerate(ready):
+                    actions[i][agent_id] = action[k]
+                    actions_env[i][agent_id] = action[k][0]
+                    action_log_probs[i][agent_id] = action_log_prob[k]
+                    rnn_states[i][agent_id] = rnn_state[k]
+                    if not self.use_centralized_V:
+                        values[i][agent_id] = value[k]
+                        rnn_states_critic[i][agent_id] = rnn_state_critic[k]
+
+        elif self.all_args.skip_steps_async:
+            # In asynchronous skipping mode, each rollout thread and agent acts from its own current state.
+            for i in rows:
                 for agent_id in range(self.num_agents):
                     # If the agent is not ready, skip it.
                     if not self.ready[i, agent_id]:
@@ -303,13 +367,13 @@ class PatrollingRunner(Runner):
 
                     self.trainer[agent_id].prep_rollout()
 
-                    buf = self.buffer[i][agent_id]
+                    buf = self.buffer
                     v, action, action_log_prob, rnn_state, rsc = self.trainer[agent_id].policy.get_actions(
-                        buf.share_obs[buf.step],
-                        buf.obs[buf.step],
-                        buf.rnn_states[buf.step],
-                        buf.rnn_states_critic[buf.step],
-                        buf.masks[buf.step]
+                        buf.cur_share_obs[i:i + 1, agent_id],
+                        buf.cur_obs[i:i + 1, agent_id],
+                        buf.cur_rnn_states[i:i + 1, agent_id],
+                        buf.cur_rnn_states_critic[i:i + 1, agent_id],
+                        buf.cur_masks[i:i + 1, agent_id]
                     )
 
                     # Determine whether to use value from centralized critic.
@@ -331,11 +395,11 @@ class PatrollingRunner(Runner):
                 self.trainer[agent_id].prep_rollout()
 
                 v, action, action_log_prob, rnn_state, rsc = self.trainer[agent_id].policy.get_actions(
-                    self.buffer[agent_id].share_obs[step],
-                    self.buffer[agent_id].obs[step],
-                    self.buffer[agent_id].rnn_states[step],
-                    self.buffer[agent_id].rnn_states_critic[step],
-                    self.buffer[agent_id].masks[step]
+                    self.buffer[agent_id].share_obs[step][rows],
+                    self.buffer[agent_id].obs[step][rows],
+                    self.buffer[agent_id].rnn_states[step][rows],
+                    self.buffer[agent_id].rnn_states_critic[step][rows],
+                    self.buffer[agent_id].masks[step][rows]
                 )
 
                 # Determine whether to use value from centralized critic.
@@ -343,19 +407,68 @@ class PatrollingRunner(Runner):
                     value = v
                     rnn_state_critic = rsc
 
-                for i in range(self.n_rollout_threads):
-                    values[i][agent_id] = _t2n(value)[i]
-                    a = _t2n(action)[i]
+                for j, i in enumerate(rows):
+                    # The centralized critic was evaluated for all threads, the policy only for these rows.
+                    vi = i if self.use_centralized_V else j
+                    values[i][agent_id] = _t2n(value)[vi]
+                    a = _t2n(action)[j]
                     actions[i][agent_id] = a
                     actions_env[i][agent_id] = a[0]
-                    action_log_probs[i][agent_id] = _t2n(action_log_prob)[i]
-                    rnn_states[i][agent_id] = _t2n(rnn_state)[i]
-                    rnn_states_critic[i][agent_id] = _t2n(rnn_state_critic)[i]
+                    action_log_probs[i][agent_id] = _t2n(action_log_prob)[j]
+                    rnn_states[i][agent_id] = _t2n(rnn_state)[j]
+                    rnn_states_critic[i][agent_id] = _t2n(rnn_state_critic)[vi]
         
         actions_env = np.array(actions_env)
 
         return values, actions, action_log_probs, rnn_states, rnn_states_critic, actions_env
 
+    def _action_metadata(self, actions_env, last_step):
+        ''' Combine the actions for each rollout thread with the step metadata. '''
+        action_metadata = []
+        for action in actions_env:
+            action_metadata.append({
+                "action": action,
+                "metadata": {
+                    "last_step": last_step
+                }
+            })
+        return action_metadata
+
+    def _collect_and_step_pipelined(self, step, last_step):
+        '''
+        Sample actions and step the environments in two halves, so that the workers of the first half
+        step while the policy runs inference for the second half.
+        Returns the outputs of collect() followed by the outputs of envs.step() for all threads.
+        '''
+        half = self.n_rollout_threads // 2
+        groups = [list(range(half)), list(range(half, self.n_rollout_threads))]
+
+        # The centralized critic covers all threads, so evaluate it once for both halves.
+        critic_values = self._collect_critic_values() if self.use_centralized_V else None
+
+        collected = []
+        for group in groups:
+            outputs = self.collect(step, env_idx=group, critic_values=critic_values)
+            group_actions_env = np.array([list(outputs[-1][i]) for i in group])
+            self.envs.step_async_subset(self._action_metadata(group_actions_env, last_step), group)
+            collected.append(outputs)
+
+        results = [self.envs.step_wait_subset(group) for group in groups]
+
+        # Merge the per-thread rows of both halves.
+        merged = [list(lists) for lists in collected[0][:-1]]
+        for lists, other in zip(merged, collected[1][:-1]):
+            for i in groups[1]:
+                lists[i] = other[i]
+        actions_env = np.array([list(collected[g][-1][i]) for g, group in enumerate(groups) for i in group])
+
+        combined_obs = np.concatenate([r[0] for r in results])
+        rewards = np.concatenate([r[1] for r in results])
+        dones = np.concatenate([r[2] for r in results])
+        infos = list(results[0][3]) + list(results[1][3])
+
+        return (*merged, actions_env, combined_obs, rewards, dones, infos)
+
     def insert(self, data, data_critic):
 
         # Split data.
@@ -377,67 +490,48 @@ class PatrollingRunner(Runner):
             # c_share_obs = np.repeat(share_obs[:, np.newaxis, :], self.num_agents, axis=1)
             c_share_obs = share_obs.copy()
         
-        # Add the total state information to env infos.
-        self.env_infos["total_state"] = [i["total_state"] for i in infos]
-        self.env_infos["agent_count"] = [i["agent_count"] for i in infos]
-
-        # Add the number of nodes visited to env infos.
-        for n in range(len(infos[0]["node_visits"])):
-            self.env_infos[f"node_visits/node_{n}"] = [i["node_visits"][n] for i in infos]
-
         # Reset RNN and mask arguments for done agents/envs.
+        done_mask = np.asarray(dones, dtype=bool).reshape(self.n_rollout_threads, self.num_agents)
         masks = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
-        for i in range(self.n_rollout_threads):
-            for agent_id in range(self.num_agents):
-                if dones[i, agent_id]:
-                    rnn_states[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
-                    rnn_states_critic[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
-                    masks[i, agent_id] = np.zeros(1, dtype=np.float32)
+        rnn_states[done_mask] = 0.0
+        rnn_states_critic[done_mask] = 0.0
+        masks[done_mask] = 0.0
         
-        # If using asynchronous skipping, insert the data into a buffer for each agent for each rollout thread.
+        # If using asynchronous skipping, insert the data into the packed buffer.
         if self.all_args.skip_steps_async:
-            for i in range(self.n_rollout_threads):
-                for agent_id in range(self.num_agents):
-                    # Only insert if the agent is ready for a new action.
-                    if self.ready[i, agent_id]:
-                        if self.use_centralized_V:
-                            s_obs = share_obs[i][agent_id]
-                            c_insert_required = True
-                        else:
-                            s_obs = np.array(list(obs[i, agent_id]))
-
-                        # Insert the data into the agent's buffer.
-                        self.buffer[i][agent_id].insert(
-                            share_obs = s_obs,
-                            obs = obs[i, agent_id],
-                            rnn_states = rnn_states[i][agent_id],
-                            rnn_states_critic = rnn_states_critic[i][agent_id],
-                            actions = actions[i][agent_id],
-                            action_log_probs = action_log_probs[i][agent_id],
-                            value_preds = values[i][agent_id],
-                            rewards = rewards[i, agent_id],
-                            masks = masks[i, agent_id],
-                            deltaSteps = delta_steps[i, agent_id],
-                            criticStep = np.array(self.critic_buffer.step) if self.use_centralized_V else np.array(self.buffer[i][agent_id].step),
-                            no_reset = True,
-                            available_actions = available_actions[i, agent_id]
-                        )
+            if self.use_centralized_V:
+                s_obs = share_obs
+                c_insert_required = bool(np.any(self.ready))
+            else:
+                s_obs = obs
+
+            # Only insert for the agents that are ready for a new action.
+            self.buffer.insert(
+                self.ready,
+                share_obs = s_obs,
+                obs = obs,
+                rnn_states = rnn_states,
+                rnn_states_critic = rnn_states_critic,
+                actions = actions,
+                action_log_probs = action_log_probs,
+                value_preds = values,
+                rewards = rewards,
+                masks = masks,
+                deltaSteps = delta_steps,
+                criticStep = self.buffer.critic_step if self.use_centralized_V else self.buffer.steps,
+                available_actions = available_actions
+            )
                     
-                    # If we are using a shared critic, update the critic data.
-                    if self.use_centralized_V:
-                        # Update these regardless of whether the agent was skipped.
-                        c_obs[i, agent_id] = obs[i, agent_id]
-                        # c_share_obs[i, agent_id] = share_obs[i]
-                        c_share_obs[i, agent_id] = share_obs[i, agent_id]
-                        c_rewards[i, agent_id] = rewards[i, agent_id]
-                        c_values[i][agent_id] = values[i][agent_id]
-                        c_rnn_states_critic[i][agent_id] = rnn_states_critic[i][agent_id]
-
-                        # Only update these if the agent was not skipped.
-                        if actions[i][agent_id] != None:
-                            c_rnn_states[i][agent_id] = rnn_states[i][agent_id]
-                            c_actions[i][agent_id] = actions[i][agent_id]
-                            c_action_log_probs[i][agent_id] = action_log_probs[i][agent_id]
+            # If we are using a shared critic, update the critic data for every agent, whether or not it was skipped.
+            # The temporary buffer keeps the last action of skipped agents, so the actions are always updated too.
+            if self.use_centralized_V:
+                c_obs[...] = obs
+                c_rewards[...] = rewards
+                c_values[...] = values
+                c_rnn_states_critic[...] = rnn_states_critic
+                c_rnn_states[...] = rnn_states
+                c_actions[...] = actions
+                c_action_log_probs[...] = action_log_probs
         
         # Otherwise, insert the data into a buffer for each agent.
         else:
@@ -501,26 +595,25 @@ class PatrollingRunner(Runner):
             if c_insert_required:
                 # Reset RNN and mask arguments for done agents/envs.
                 c_masks = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        if dones[i, agent_id]:
-                            c_rnn_states[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
-                            c_rnn_states_critic[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
-                            c_masks[i, agent_id] = np.zeros((1, 1), dtype=np.float32)
-
-                self.critic_buffer.insert(
-                    share_obs=np.array(c_share_obs),
-                    obs=np.array(c_obs),
-                    rnn_states=np.array(c_rnn_states),
-                    rnn_states_critic=np.array(c_rnn_states_critic),
-                    actions=np.array(c_actions),
-                    action_log_probs=np.array(c_action_log_probs),
-                    value_preds=np.array(c_values),
-                    rewards=np.array(c_rewards),
-                    masks=c_masks,
-                    deltaSteps=np.array(c_delta_steps),
-                    no_reset=self.all_args.skip_steps_async
-                )
+                c_rnn_states[done_mask] = 0.0
+                c_rnn_states_critic[done_mask] = 0.0
+                c_masks[done_mask] = 0.0
+
+                if self.all_args.skip_steps_async:
+                    self.buffer.insert_critic(c_share_obs, c_rnn_states_critic, c_masks)
+                else:
+                    self.critic_buffer.insert(
+                        share_obs=np.array(c_share_obs),
+                        obs=np.array(c_obs),
+                        rnn_states=np.array(c_rnn_states),
+                        rnn_states_critic=np.array(c_rnn_states_critic),
+                        actions=np.array(c_actions),
+                        action_log_probs=np.array(c_action_log_probs),
+                        value_preds=np.array(c_values),
+                        rewards=np.array(c_rewards),
+                        masks=c_masks,
+                        deltaSteps=np.array(c_delta_steps)
+                    )
 
                 c_delta_steps = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.int32)
             
@@ -533,6 +626,17 @@ class PatrollingRunner(Runner):
         
         return data_critic
 
+    def _update_env_infos(self, infos):
+        ''' Record the environment information to be logged from the given infos. '''
+        # Add the total state information to env infos.
+        self.env_infos["total_state"] = [i["total_state"] for i in infos]
+        self.env_infos["agent_count"] = [i["agent_count"] for i in infos]
+
+        # Add the number of nodes visited to env infos.
+        node_visits = np.array([i["node_visits"] for i in infos])
+        for n in range(node_visits.shape[1]):
+            self.env_infos[f"node_visits/node_{n}"] = list(node_visits[:, n])
+
     def log_train(self, train_infos, total_num_steps): 
         # The train_infos is a list (size self.n_rollout_threads) of lists (size self.num_agents) of dicts.
         # We want to flatten this to a single list of dicts by averaging across rollout threads.
@@ -738,47 +842,9 @@ class PatrollingRunner(Runner):
         if self.use_centralized_V:
             self.trainer[0].prep_rollout()
 
-            # Create a new self.critic_buffer if we are using asynchronous skipping.
+            # If we are using asynchronous skipping, train the critic on the segments of all rollout threads and agents one after another.
             if self.all_args.skip_steps_async:
-                totalSteps = 0
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        totalSteps += self.buffer[i][agent_id].step
-                args = copy.deepcopy(self.all_args)
-                args.n_rollout_threads = 1
-                args.episode_length = totalSteps
-                cbuf = SeparatedReplayBuffer(
-                    args,
-                    self.envs.observation_space[0],
-                    self.envs.share_observation_space[0],
-                    self.envs.action_space[0]
-                )
-
-                # Append the buffers from each rollout thread and agent.
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        buf = self.buffer[i][agent_id]
-                        
-                        cbuf.share_obs[cbuf.step:cbuf.step + buf.step] = buf.share_obs[:buf.step]
-                        cbuf.obs[cbuf.step:cbuf.step + buf.step] = buf.obs[:buf.step]
-                        cbuf.rnn_states[cbuf.step:cbuf.step + buf.step] = buf.rnn_states[:buf.step]
-                        cbuf.rnn_states_critic[cbuf.step:cbuf.step + buf.step] = buf.rnn_states_critic[:buf.step]
-                        cbuf.actions[cbuf.step:cbuf.step + buf.step] = buf.actions[:buf.step]
-                        cbuf.action_log_probs[cbuf.step:cbuf.step + buf.step] = buf.action_log_probs[:buf.step]
-                        cbuf.value_preds[cbuf.step:cbuf.step + buf.step] = buf.value_preds[:buf.step]
-                        cbuf.rewards[cbuf.step:cbuf.step + buf.step] = buf.rewards[:buf.step]
-                        cbuf.masks[cbuf.step:cbuf.step + buf.step] = buf.masks[:buf.step]
-                        cbuf.deltaSteps[cbuf.step:cbuf.step + buf.step] = buf.deltaSteps[:buf.step]
-
-                        # Set the mask for the first step to 0 (reset the RNN)
-                        cbuf.masks[cbuf.step] = np.zeros_like(cbuf.masks[cbuf.step])
-
-                        cbuf.step += buf.step
-
-                if cbuf.step != totalSteps:
-                    raise ValueError(f"Total step count is incorrect for critic buffer! Expected {totalSteps}, got {cbuf.step}")
-
-                # Update the critic buffer.
+                cbuf = self.buffer.series()
                 self.critic_buffer_series = cbuf
             else:
                 cbuf = self.critic_buffer
@@ -791,64 +857,58 @@ class PatrollingRunner(Runner):
             #     raise RuntimeError(f"Total step count is incorrect for critic buffer! Expected {self.all_args.episode_length}, got {stepSum}")
 
             if self.all_args.skip_steps_async:
-                next_value = self.trainer[0].policy.get_values(cbuf.share_obs[cbuf.step - 1], 
-                                                                cbuf.rnn_states_critic[cbuf.step - 1],
-                                                                cbuf.masks[cbuf.step - 1])
-                next_value = _t2n(next_value)
+                # Only the last segment of the series is bootstrapped. The others end where the next one begins.
+                last = cbuf.rows[-1]
+                next_value = self.trainer[0].policy.get_values(self.buffer.share_obs[last][None],
+                                                                self.buffer.rnn_states_critic[last][None],
+                                                                cbuf.masks[-1])
+                next_values = np.zeros((*self.buffer.steps.shape, 1), dtype=np.float32)
+                next_masks = np.zeros_like(next_values)
+                i, agent_id = divmod(self.buffer.pair[last], self.num_agents)
+                next_values[i, agent_id] = _t2n(next_value)
+                next_masks[i, agent_id] = 1.0
+                self.buffer.compute_returns(next_values, next_masks, self.trainer[0].value_normalizer)
             else:
                 next_value = self.trainer[0].policy.get_values(np.concatenate(cbuf.share_obs[cbuf.step - 1]), 
                                                                 np.concatenate(cbuf.rnn_states_critic[cbuf.step - 1]),
                                                                 np.concatenate(cbuf.masks[cbuf.step - 1]))
                 next_value = np.array(np.split(_t2n(next_value), self.n_rollout_threads))
-            cbuf.compute_returns(
-                next_value,
-                self.trainer[0].value_normalizer,
-                last_step=cbuf.step
-            )
-
-            # Copy returns to each agent's buffer.
-            if self.all_args.skip_steps_async:
-                offset = 0
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        for j in range(self.buffer[i][agent_id].step):
-                            self.buffer[i][agent_id].returns[j] = cbuf.returns[offset + j, 0, 0]
-
-                        # Copy the last step to capture the final return and value.
-                        self.buffer[i][agent_id].returns[j + 1] = cbuf.returns[offset + j + 1, 0, 0]
-                        self.buffer[i][agent_id].value_preds[j + 1] = cbuf.value_preds[offset + j + 1, 0, 0]
+                cbuf.compute_returns(
+                    next_value,
+                    self.trainer[0].value_normalizer,
+                    last_step=cbuf.step
+                )
 
-                        offset += self.buffer[i][agent_id].step
-            else:
+                # Copy returns to each agent's buffer.
                 for agent_id in range(self.num_agents):
                     self.buffer[agent_id].returns = cbuf.returns[:, :, agent_id]
                     self.buffer[agent_id].value_preds[self.buffer[agent_id].step] = cbuf.value_preds[cbuf.step, :, agent_id]
 
         # Compute returns for the decentralized critics.
         else:
-            # If using asynchronous skipping, we compute returns for each agent's policy using buffers from each rollout thread.
+            # If using asynchronous skipping, we compute returns for each agent's policy over the segments from each rollout thread.
             if self.all_args.skip_steps_async:
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        self.trainer[agent_id].prep_rollout()
-                        cbuf = self.buffer[i][agent_id]
+                buf = self.buffer
+                last_rows = buf.last_rows()
+                next_values = np.zeros((*buf.steps.shape, 1), dtype=np.float32)
+                for agent_id in range(self.num_agents):
+                    self.trainer[agent_id].prep_rollout()
+                    rows = last_rows[:, agent_id]
+                    threads = np.flatnonzero(rows >= 0)
+                    if len(threads) == 0:
+                        continue
 
-                        # # Check that the total step count is correct.
-                        # stepSum = np.sum(buf.deltaSteps[:buf.step])
-                        # if stepSum != self.all_args.episode_length:
-                        #     raise RuntimeError(f"Total step count is incorrect for buffer {i}-{agent_id}! Expected {self.all_args.episode_length}, got {stepSum}")
+                    # Bootstrap each segment from the state its last transition was taken from.
+                    next_value = self.trainer[agent_id].policy.get_values(
+                        buf.share_obs[rows[threads]],
+                        buf.rnn_states_critic[rows[threads]],
+                        buf.masks[rows[threads]]
+                    )
+                    next_values[threads, agent_id] = _t2n(next_value)
 
-                        next_value = self.trainer[agent_id].policy.get_values(
-                            cbuf.share_obs[cbuf.step - 1], 
-                            cbuf.rnn_states_critic[cbuf.step - 1],
-                            cbuf.masks[cbuf.step - 1]
-                        )
-                        next_value = _t2n(next_value)
-                        cbuf.compute_returns(
-                            next_value,
-                            self.trainer[agent_id].value_normalizer,
-                            last_step=cbuf.step
-                        )
+                    pairs = np.zeros(buf.steps.shape, dtype=bool)
+                    pairs[:, agent_id] = True
+                    buf.compute_returns(next_values, buf.cur_masks, self.trainer[agent_id].value_normalizer, pairs=pairs)
             
             # Otherwise, we compute returns for each agent's policy using a single buffer.
             else:
@@ -925,16 +985,14 @@ class PatrollingRunner(Runner):
                     #         f.write("\n")
                     # # raise Exception("Done printing buffer.")
 
+                    segment = self.buffer.segment(i, agent_id)
                     train_info = self.trainer[agent_id].train(
-                        self.buffer[i][agent_id],
+                        segment,
                         update_actor=True,
                         update_critic=(not self.use_centralized_V),
-                        last_step=self.buffer[i][agent_id].step
+                        last_step=segment.step
                     )
                     train_infos["actors"][i].append(train_info)       
-                    self.buffer[i][agent_id].after_update(
-                        last_step = self.buffer[i][agent_id].step
-                    )
         
         else:
             # Otherwise, we update each agent's policy using a single buffer.
@@ -967,24 +1025,16 @@ class PatrollingRunner(Runner):
         ''' Determine whether this step is the last step of the episode. '''
 
         if self.all_args.skip_steps_async:
-            stepSum = 0
-            # Check that all agent buffers have enough data.
-            for i in range(self.n_rollout_threads):
-                for agent_id in range(self.num_agents):
-                    stepSum += self.buffer[i][agent_id].step
-                    if self.buffer[i][agent_id].step // self.all_args.data_chunk_length < 2:
-                        return False
+            # Check that all agent segments have enough data.
+            if np.any(self.buffer.steps // self.all_args.data_chunk_length < 2):
+                return False
 
             if self.use_centralized_V:
-                # Since we will concatenate the actor buffers, check the sum.
+                # Since we will concatenate the actor segments, check the sum.
                 # bufferStep = stepSum
-                bufferStep = self.critic_buffer.step
+                bufferStep = self.buffer.critic_step
             else:
-                maxBufferStep = 0
-                for i in range(self.n_rollout_threads):
-                    for agent_id in range(self.num_agents):
-                        maxBufferStep = max(maxBufferStep, self.buffer[i][agent_id].step)
-                bufferStep = maxBufferStep
+                bufferStep = self.buffer.steps.max()
             last_step = bufferStep >= self.episode_length - 1
         else:
             last_step = step >= self.episode_length - 1
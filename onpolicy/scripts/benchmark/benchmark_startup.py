@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Measures the time to first step of the search-and-deliver rollout environments, i.e. the time from creating
+the vectorized environments until all of them have been reset and stepped once, for several numbers of
+rollout threads. Takes the same arguments as train_sd.py, e.g.
+
+    python benchmark_startup.py --env_name search-deliver --graph_file <graph> --num_agents 4 --start_method spawn
+
+Only lightweight modules are imported at the top of this file, since worker processes started with "spawn"
+or "forkserver" import it again.
+"""
+# python standard libraries
+import sys
+import time
+import multiprocessing
+
+# third-party packages
+import numpy as np
+
+
+def time_to_first_step(all_args, n_rollout_threads):
+    """
+    Create the rollout environments, then reset and step all of them once.
+    :param all_args: (argparse.Namespace) training arguments.
+    :param n_rollout_threads: (int) number of rollout environments.
+
+    :return reset_time: (float) seconds until the environments were created and reset.
+    :return step_time: (float) seconds until the first step completed.
+    :return n_workers: (int) number of worker processes, 0 if the environments run in this process.
+    """
+    from onpolicy.scripts.train.train_sd import make_train_env
+
+    all_args.n_rollout_threads = n_rollout_threads
+    start = time.perf_counter()
+    envs = make_train_env(all_args)
+    obs = envs.reset()
+    reset_time = time.perf_counter() - start
+
+    actions = [[int(np.flatnonzero(available)[0]) for available in o["available_actions"]] for o in obs]
+    envs.step(actions)
+    step_time = time.perf_counter() - start
+
+    n_workers = len(getattr(envs, "ps", []))
+    envs.close()
+    return reset_time, step_time, n_workers
+
+
+def main(args, parsed_args=None):
+    """
+    Run the benchmark.
+    :param args: (list) command line arguments.
+    :param parsed_args: (argparse.Namespace) optional training arguments prepared by a script, as for train_sd.main().
+                        The benchmark options are still read from args.
+    """
+    from onpolicy.config import get_config
+    from onpolicy.scripts.train.train_sd import parse_args, validateArgs
+
+    parser = get_config()
+    parser.add_argument("--benchmark_threads", type=int, nargs="+", default=[1, 16, 64],
+                        help="Numbers of rollout threads to measure the time to first step for.")
+    parser.add_argument("--start_method", type=str, default=None, choices=["fork", "spawn", "forkserver"],
+                        help="by default, the platform's default. How worker processes are started.")
+    benchmark_args = parse_args(args, parser)
+    all_args = parsed_args if parsed_args is not None else benchmark_args
+    validateArgs(all_args)
+
+    if benchmark_args.start_method is not None:
+        multiprocessing.set_start_method(benchmark_args.start_method)
+
+    for n_rollout_threads in benchmark_args.benchmark_threads:
+        reset_time, step_time, n_workers = time_to_first_step(all_args, n_rollout_threads)
+        print(f"{n_rollout_threads} rollout threads ({n_workers} worker processes): "
+              f"reset after {reset_time:.2f} s, first step after {step_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
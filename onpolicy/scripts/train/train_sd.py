@@ -14,7 +14,7 @@ import wandb
 # code repository sub-packages
 from onpolicy.config import get_config
 from onpolicy.envs.patrolling.SDEnv import SDEnv
-from onpolicy.envs.env_wrappers import SubprocVecEnv, DummyVecEnv
+from onpolicy.envs.env_wrappers import SubprocVecEnv, SharedMemorySubprocVecEnv, MultiEnvSubprocVecEnv, DummyVecEnv, default_envs_per_worker
 
 
 def make_train_env(all_args):
@@ -29,8 +29,15 @@ def make_train_env(all_args):
             env.seed(all_args.seed + rank * 1000)
             return env
         return init_env
+    envs_per_worker = all_args.envs_per_worker or default_envs_per_worker(all_args.n_rollout_threads)
     if all_args.n_rollout_threads == 1:
         return DummyVecEnv([get_env_fn(0)])
+    elif all_args.shared_memory_envs:
+        return SharedMemorySubprocVecEnv([get_env_fn(i) for i in range(
+            all_args.n_rollout_threads)])
+    elif envs_per_worker > 1:
+        return MultiEnvSubprocVecEnv([get_env_fn(i) for i in range(
+            all_args.n_rollout_threads)], envs_per_worker=envs_per_worker)
     else:
         return SubprocVecEnv([get_env_fn(i) for i in range(
             all_args.n_rollout_threads)])
@@ -48,8 +55,15 @@ def make_eval_env(all_args):
             env.seed(all_args.seed * 50000 + rank * 10000)
             return env
         return init_env
+    envs_per_worker = all_args.envs_per_worker or default_envs_per_worker(all_args.n_eval_rollout_threads)
     if all_args.n_eval_rollout_threads == 1:
         return DummyVecEnv([get_env_fn(0)])
+    elif all_args.shared_memory_envs:
+        return SharedMemorySubprocVecEnv([get_env_fn(i) for i in range(
+            all_args.n_eval_rollout_threads)])
+    elif envs_per_worker > 1:
+        return MultiEnvSubprocVecEnv([get_env_fn(i) for i in range(
+            all_args.n_eval_rollout_threads)], envs_per_worker=envs_per_worker)
     else:
         return SubprocVecEnv([get_env_fn(i) for i in range(
             all_args.n_eval_rollout_threads)])
@@ -64,6 +78,8 @@ def parse_args(args, parser):
                         help="Whether to skip steps with no action required (by any agent).")
     parser.add_argument("--skip_steps_sync", type=bool, default=False,
                         help="Whether to skip steps with no action required (by any agent).")
+    parser.add_argument("--skip_steps_event", type=bool, default=False,
+                        help="Whether to jump straight to the next step in which an agent is ready, instead of simulating each skipped step (requires skip_steps_sync). Positions, payloads and rewards follow the same distribution, but the agents' beliefs are only updated at the end of each jump, which differs with a finite observation radius or random communication.")
     parser.add_argument("--graph_file", type=str,
                         default="", 
                         help="The path to the graph file.")
@@ -100,7 +116,7 @@ def parse_args(args, parser):
                         help="the observation method to use for global observation")
     parser.add_argument("--observe_bitmap_size", type=int, default=50, 
                         help="the size (squared) to which the bitmap should be scaled for observation")
-    parser.add_argument("--observation_radius", type=float, default=np.Inf, 
+    parser.add_argument("--observation_radius", type=float, default=np.inf, 
                         help="the observable radius for each agent")
     parser.add_argument("--attrition_method", type=str, default="none", 
                         help="the method to use for agent attrition")
@@ -139,6 +155,12 @@ def parse_args(args, parser):
                         help="directory to save videos.")
     parser.add_argument("--cuda_idx", type=int, default=0, 
                         help="Index of the GPU to use")
+    parser.add_argument("--shared_memory_envs", action="store_true", default=False, 
+                        help="by default False. If True, rollout workers return observations through shared memory instead of pipes. Requires fixed-shape (flattened) observations.")
+    parser.add_argument("--pipelined_rollout", action="store_true", default=False, 
+                        help="by default False. If True, step half of the rollout threads while the policy samples actions for the other half (separated runner only).")
+    parser.add_argument("--envs_per_worker", type=int, default=0, 
+                        help="Number of environments hosted by each rollout worker process. By default (0), n_rollout_threads / number of CPU cores, rounded up. Ignored with shared_memory_envs.")
                         
     all_args = parser.parse_known_args(args)[0]
 
@@ -166,6 +188,15 @@ def validateArgs(all_args):
     if all_args.skip_steps_async and all_args.skip_steps_sync:
         raise ValueError("Cannot skip steps in both async and sync mode.")
 
+    if all_args.skip_steps_event and not all_args.skip_steps_sync:
+        raise ValueError("Event-driven step skipping requires skip_steps_sync.")
+
+    if all_args.pipelined_rollout and all_args.n_rollout_threads < 2:
+        raise ValueError("Pipelined rollout requires at least 2 rollout threads.")
+
+    if all_args.envs_per_worker < 0:
+        raise ValueError("The number of environments per worker cannot be negative.")
+
 
 def main(args, parsed_args=None):
     if parsed_args is None:
@@ -0,0 +1,197 @@
+import numpy as np
+import torch
+
+from torch_geometric.data import Batch
+
+from onpolicy.utils.util import get_graph_obs_space_idx
+
+
+def _cumsum(counts):
+    ''' Return the offsets [0, c0, c0 + c1, ...] of consecutive blocks with the given sizes. '''
+    return torch.cat((counts.new_zeros(1), torch.cumsum(counts, 0)))
+
+def _ranges(starts, counts):
+    ''' Return the concatenation of the ranges [start, start + count) for each start and count. '''
+    offsets = torch.repeat_interleave(starts - _cumsum(counts)[:-1], counts)
+    return offsets + torch.arange(offsets.shape[0])
+
+
+class CollatedGraphs(object):
+    """
+    PyG observation graphs stored in collated form. The node and edge attributes of all graphs are concatenated,
+    with offsets marking where each graph starts, and the graph-level attributes are stacked. A batch of any
+    subset of the graphs is then a slice-and-offset operation instead of a call to Batch.from_data_list().
+    :param graphs: (list) torch_geometric.data.Data graphs, all with the same attributes.
+    """
+    def __init__(self, graphs):
+        first = graphs[0]
+        self.num_graphs = len(graphs)
+        self.num_nodes = torch.tensor([g.num_nodes for g in graphs], dtype=torch.long)
+        self.num_edges = torch.tensor([g.num_edges for g in graphs], dtype=torch.long)
+        self.node_ptr = _cumsum(self.num_nodes)
+        self.edge_ptr = _cumsum(self.num_edges)
+
+        # Each attribute is stored with its kind, which determines how a batch slices it.
+        self.attrs = {}
+        for key in first.keys():
+            values = [g[key] for g in graphs]
+            if key == "edge_index":
+                # Edge endpoints are kept in each graph's own node numbering, and offset when batching.
+                self.attrs[key] = ("edge_index", torch.cat(values, dim=1))
+            elif first.is_node_attr(key):
+                self.attrs[key] = ("node", torch.cat(values, dim=first.__cat_dim__(key, first[key])))
+            elif first.is_edge_attr(key):
+                self.attrs[key] = ("edge", torch.cat(values, dim=first.__cat_dim__(key, first[key])))
+            elif isinstance(first[key], torch.Tensor):
+                if first[key].dim() == 0:
+                    self.attrs[key] = ("graph", torch.stack(values))
+                else:
+                    self.attrs[key] = ("graph", torch.cat(values, dim=first.__cat_dim__(key, first[key])))
+            elif isinstance(first[key], (int, float)):
+                self.attrs[key] = ("graph", torch.tensor(values))
+            else:
+                # Other attributes (lists, arrays) come back as lists, as from Batch.from_data_list().
+                objects = np.empty(self.num_graphs, dtype=object)
+                for i, v in enumerate(values):
+                    objects[i] = v
+                self.attrs[key] = ("object", objects)
+
+    def batch(self, indices):
+        """
+        Batch the graphs at the given indices, in order.
+        :param indices: (np.ndarray) indices of the graphs to batch.
+
+        :return batch: (torch_geometric.data.Batch) the batched graphs, as Batch.from_data_list() would build them.
+        """
+        indices = torch.as_tensor(np.asarray(indices), dtype=torch.long).reshape(-1)
+        num_nodes = self.num_nodes[indices]
+        num_edges = self.num_edges[indices]
+        node_rows = _ranges(self.node_ptr[indices], num_nodes)
+        edge_rows = _ranges(self.edge_ptr[indices], num_edges)
+        ptr = _cumsum(num_nodes)
+
+        data = {}
+        for key, (kind, value) in self.attrs.items():
+            if kind == "edge_index":
+                # Shift the edge endpoints from each graph's own numbering to its place in the batch.
+                data[key] = value[:, edge_rows] + torch.repeat_interleave(ptr[:-1], num_edges)
+            elif kind == "node":
+                data[key] = value[node_rows]
+            elif kind == "edge":
+                data[key] = value[edge_rows]
+            elif kind == "graph":
+                data[key] = value[indices]
+            else:
+                data[key] = list(value[indices.numpy()])
+
+        batch = Batch(batch=torch.repeat_interleave(torch.arange(indices.shape[0]), num_nodes), ptr=ptr, **data)
+        batch._num_graphs = indices.shape[0]
+        return batch
+
+
+def unique_graphs(batch):
+    """
+    Find the distinct graphs of a batch, as seen by a GNN encoder (node features, edge attributes and topology).
+    When all agents observe the same graph, e.g. with full communication or an infinite observation radius, the
+    encoder only needs to run on one copy of it.
+    :param batch: (torch_geometric.data.Batch) batched graphs with x, edge_attr and edge_index.
+
+    :return unique: (torch_geometric.data.Batch) the first occurrence of each distinct graph, in batch order,
+                    with x, edge_attr, edge_index, batch and ptr.
+    :return inverse: (torch.Tensor) index into unique of each graph of the batch.
+    """
+    num_graphs = batch.num_graphs
+    node_ptr = batch.ptr.cpu()
+    num_nodes = node_ptr[1:] - node_ptr[:-1]
+    edge_graph = batch.batch.cpu()[batch.edge_index[0].cpu()]
+    num_edges = torch.bincount(edge_graph, minlength=num_graphs)
+    edge_ptr = _cumsum(num_edges)
+    local_edges = batch.edge_index - node_ptr[edge_graph].to(batch.edge_index.device)
+
+    # Only graphs with the same numbers of nodes and edges can be equal, and those are compared as flat rows.
+    first = torch.arange(num_graphs)
+    sizes, group = torch.unique(torch.stack((num_nodes, num_edges), dim=1), dim=0, return_inverse=True)
+    for g, (n, e) in enumerate(sizes.tolist()):
+        members = torch.nonzero(group == g).reshape(-1)
+        if members.shape[0] == 1:
+            continue
+        node_rows = _ranges(node_ptr[members], num_nodes[members]).to(batch.x.device)
+        edge_rows = _ranges(edge_ptr[members], num_edges[members]).to(batch.x.device)
+        rows = torch.cat((
+            batch.x[node_rows].double().reshape(members.shape[0], -1),
+            batch.edge_attr[edge_rows].double().reshape(members.shape[0], -1),
+            local_edges[:, edge_rows].double().reshape(2, members.shape[0], e).transpose(0, 1).reshape(members.shape[0], -1)
+        ), dim=1)
+        _, inverse = torch.unique(rows, dim=0, return_inverse=True)
+        inverse = inverse.cpu()
+        owner = torch.full((int(inverse.max()) + 1,), num_graphs, dtype=torch.long).scatter_reduce(0, inverse, members, "amin")
+        first[members] = owner[inverse]
+
+    keep = torch.unique(first)
+    inverse = torch.searchsorted(keep, first)
+    num_nodes = num_nodes[keep]
+    num_edges = num_edges[keep]
+    ptr = _cumsum(num_nodes)
+    node_rows = _ranges(node_ptr[keep], num_nodes).to(batch.x.device)
+    edge_rows = _ranges(edge_ptr[keep], num_edges).to(batch.x.device)
+    unique = Batch(
+        x=batch.x[node_rows],
+        edge_attr=batch.edge_attr[edge_rows],
+        edge_index=local_edges[:, edge_rows] + torch.repeat_interleave(ptr[:-1], num_edges).to(local_edges.device),
+        batch=torch.repeat_interleave(torch.arange(keep.shape[0]), num_nodes),
+        ptr=ptr
+    )
+    unique._num_graphs = keep.shape[0]
+    return unique, inverse
+
+
+class CollatedObs(object):
+    """
+    Minibatch of observations whose graphs have already been batched, so the policy does not collate them again.
+    :param obs: (np.ndarray) the observations, including their graph column.
+    :param graphs: (torch_geometric.data.Batch) the batched graphs of the observations.
+    """
+    def __init__(self, obs, graphs):
+        self.obs = obs
+        self.graphs = graphs
+
+    @property
+    def shape(self):
+        return self.obs.shape
+
+
+class GraphCollator(object):
+    """
+    Collates the graphs of observation arrays for a replay buffer. The collated graphs are reused for as long as
+    the same graph objects are requested, so they are built once per update rather than once per minibatch.
+    :param obs_space: (gym.Space) observation space, which contains a graph subspace.
+    """
+    def __init__(self, obs_space):
+        self.graph_idx = get_graph_obs_space_idx(obs_space) if obs_space.__class__.__name__ == 'Dict' else 0
+        self.graphs = None
+        self.collated = None
+
+    def __call__(self, obs):
+        """
+        Collate the graphs of an array of observations.
+        :param obs: (np.ndarray) object array of observations, with the observation entries on the last axis.
+
+        :return collated: (CollatedGraphs) the graphs of the observations, in flattened order.
+        """
+        graphs = obs.reshape(-1, obs.shape[-1])[:, self.graph_idx]
+        if self.graphs is None or len(graphs) != len(self.graphs) or any(a is not b for a, b in zip(graphs, self.graphs)):
+            # Keep a copy of the references, since the buffers overwrite their observation arrays in place.
+            self.graphs = graphs.copy()
+            self.collated = CollatedGraphs(list(graphs))
+        return self.collated
+
+    def wrap(self, obs, obs_batch, indices):
+        """
+        Attach the batched graphs to a minibatch of observations.
+        :param obs: (np.ndarray) object array of all observations the minibatch is drawn from.
+        :param obs_batch: (np.ndarray) the minibatch of observations.
+        :param indices: (np.ndarray) flattened indices of the minibatch into obs.
+
+        :return obs_batch: (CollatedObs) the minibatch with its graphs batched.
+        """
+        return CollatedObs(obs_batch, self(obs).batch(indices))
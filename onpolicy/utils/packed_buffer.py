@@ -0,0 +1,417 @@
+import torch
+import numpy as np
+
+from onpolicy.utils.util import get_shape_from_obs_space, get_shape_from_act_space, has_graph_obs_space, gae_returns, discounted_returns
+from onpolicy.utils.collated_graphs import GraphCollator
+
+
+class PackedReplayBuffer(object):
+    """
+    Buffer to store training data when skipping steps asynchronously, so that every (rollout thread, agent) pair
+    acts at its own pace. The transitions of all pairs are appended to a single arena in the order they are
+    inserted, and each pair owns the segment of arena rows it inserted. The state each pair will act from next
+    is kept per pair, outside of the arena, and carries over between episodes.
+    :param args: (argparse.Namespace) arguments containing relevant model, policy, and env information.
+    :param num_agents: (int) number of agents in the env.
+    :param obs_space: (gym.Space) observation space of agents.
+    :param share_obs_space: (gym.Space) value function input space of agents.
+    :param act_space: (gym.Space) action space for agents.
+    """
+
+    def __init__(self, args, num_agents, obs_space, share_obs_space, act_space):
+        self.n_rollout_threads = args.n_rollout_threads
+        self.num_agents = num_agents
+        self.hidden_size = args.hidden_size
+        self.recurrent_N = args.recurrent_N
+        self.gamma = args.gamma
+        self.gae_lambda = args.gae_lambda
+        self._use_gae = args.use_gae
+        self._use_gae_amadm = args.use_gae_amadm
+        self._use_popart = args.use_popart
+        self._use_valuenorm = args.use_valuenorm
+
+        obs_shape = get_shape_from_obs_space(obs_space)
+        share_obs_shape = get_shape_from_obs_space(share_obs_space)
+
+        if type(obs_shape[-1]) == list:
+            obs_shape = obs_shape[:1]
+
+        if type(share_obs_shape[-1]) == list:
+            share_obs_shape = share_obs_shape[:1]
+
+        act_shape = get_shape_from_act_space(act_space)
+        obs_dtype = object if has_graph_obs_space(obs_space) else np.float32
+        # Collate the graphs once per update, so that each minibatch batches them by slicing.
+        self.graph_collator = GraphCollator(obs_space) if obs_dtype == object else None
+
+        # Shape, dtype and fill value of each per-transition field. The state fields hold the state the
+        # transition was started from, the others hold what happened from that state.
+        self.fields = {
+            "share_obs": (share_obs_shape, np.float32, 0),
+            "obs": (obs_shape, obs_dtype, 0),
+            "rnn_states": ((self.recurrent_N, self.hidden_size), np.float32, 0),
+            "rnn_states_critic": ((self.recurrent_N, self.hidden_size), np.float32, 0),
+            "masks": ((1,), np.float32, 1),
+            "active_masks": ((1,), np.float32, 1),
+            "actions": ((act_shape,), np.float32, 0),
+            "action_log_probs": ((act_shape,), np.float32, 0),
+            "value_preds": ((1,), np.float32, 0),
+            "returns": ((1,), np.float32, 0),
+            "rewards": ((1,), np.float32, 0),
+            "deltaSteps": ((1,), np.int32, 0),
+            "criticStep": ((1,), np.int32, 0),
+            "pair": ((), np.int64, 0),
+        }
+        if act_space.__class__.__name__ == 'Discrete':
+            self.fields["available_actions"] = ((act_space.n,), np.float32, 1)
+        else:
+            self.available_actions = None
+
+        # Start with room for every pair acting on every step of an episode, and grow if that is exceeded.
+        self.capacity = 0
+        self._grow(args.episode_length * self.n_rollout_threads * num_agents)
+
+        # The state each pair acts from next.
+        pairs = (self.n_rollout_threads, num_agents)
+        self.cur_share_obs = np.zeros((*pairs, *share_obs_shape), dtype=np.float32)
+        if obs_dtype == object:
+            self.cur_obs = np.empty((*pairs, *obs_shape), dtype=object)
+        else:
+            self.cur_obs = np.zeros((*pairs, *obs_shape), dtype=np.float32)
+        self.cur_rnn_states = np.zeros((*pairs, self.recurrent_N, self.hidden_size), dtype=np.float32)
+        self.cur_rnn_states_critic = np.zeros_like(self.cur_rnn_states)
+        self.cur_masks = np.ones((*pairs, 1), dtype=np.float32)
+        self.cur_active_masks = np.ones_like(self.cur_masks)
+        if self.available_actions is not None:
+            self.cur_available_actions = np.ones((*pairs, act_space.n), dtype=np.float32)
+        else:
+            self.cur_available_actions = None
+
+        # The latest input of a centralized critic, which is updated for every pair whenever any agent acts.
+        self.critic_share_obs = np.zeros_like(self.cur_share_obs)
+        self.critic_rnn_states = np.zeros_like(self.cur_rnn_states)
+        self.critic_masks = np.ones_like(self.cur_masks)
+        self.critic_step = 0
+
+        self.steps = np.zeros(pairs, dtype=np.int64)
+        self.size = 0
+        self._segments = None
+
+    def _grow(self, capacity):
+        ''' Reallocate the arena with room for at least the given number of transitions. '''
+        capacity = max(capacity, 2 * self.capacity)
+        for name, (shape, dtype, fill) in self.fields.items():
+            arr = np.full((capacity, *shape), fill, dtype=dtype)
+            if self.capacity > 0:
+                arr[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, arr)
+        self.capacity = capacity
+
+    def reset(self):
+        ''' Start a new episode. The current state of each pair is kept. '''
+        self.size = 0
+        self.steps[:] = 0
+        self.critic_step = 0
+        self._segments = None
+
+    def insert(self, ready, share_obs, obs, rnn_states, rnn_states_critic, actions, action_log_probs,
+               value_preds, rewards, masks, active_masks=None, available_actions=None, deltaSteps=None,
+               criticStep=None):
+        """
+        Append a transition for every (thread, agent) pair that is ready. The data arrays are indexed by
+        (thread, agent) first and describe the step just taken, ending in the new state of each pair.
+        :param ready: (np.ndarray) (threads, agents) boolean mask of the pairs to insert.
+        :param share_obs: (np.ndarray) value function inputs of the new state.
+        :param obs: (np.ndarray) local agent observations of the new state.
+        :param rnn_states: (np.ndarray) RNN states for actor network.
+        :param rnn_states_critic: (np.ndarray) RNN states for critic network.
+        :param actions: (np.ndarray) actions taken by agents.
+        :param action_log_probs: (np.ndarray) log probs of actions taken by agents.
+        :param value_preds: (np.ndarray) value function prediction of the state the actions were taken from.
+        :param rewards: (np.ndarray) rewards collected since the actions were taken.
+        :param masks: (np.ndarray) denotes whether the environment has terminated or not.
+        :param active_masks: (np.ndarray) denotes whether an agent is active or dead in the env.
+        :param available_actions: (np.ndarray) actions available to each agent in the new state.
+        :param deltaSteps: (np.ndarray) number of environment steps since the actions were taken.
+        :param criticStep: (np.ndarray) critic step of each transition, broadcast to (threads, agents).
+        """
+        count = int(np.count_nonzero(ready))
+        if count == 0:
+            return
+        if self.size + count > self.capacity:
+            self._grow(self.size + count)
+        rows = slice(self.size, self.size + count)
+
+        # Each transition starts from the pair's current state, which then advances to the new one.
+        self.share_obs[rows] = self.cur_share_obs[ready]
+        self.obs[rows] = self.cur_obs[ready]
+        self.rnn_states[rows] = self.cur_rnn_states[ready]
+        self.rnn_states_critic[rows] = self.cur_rnn_states_critic[ready]
+        self.masks[rows] = self.cur_masks[ready]
+        self.active_masks[rows] = self.cur_active_masks[ready]
+        if self.available_actions is not None:
+            self.available_actions[rows] = self.cur_available_actions[ready]
+
+        self.cur_share_obs[ready] = share_obs[ready]
+        self.cur_obs[ready] = obs[ready]
+        self.cur_rnn_states[ready] = rnn_states[ready]
+        self.cur_rnn_states_critic[ready] = rnn_states_critic[ready]
+        self.cur_masks[ready] = masks[ready]
+        if active_masks is not None:
+            self.cur_active_masks[ready] = active_masks[ready]
+        if available_actions is not None and self.available_actions is not None:
+            self.cur_available_actions[ready] = available_actions[ready]
+
+        self.actions[rows] = actions[ready]
+        self.action_log_probs[rows] = action_log_probs[ready]
+        self.value_preds[rows] = value_preds[ready]
+        self.rewards[rows] = rewards[ready]
+        if deltaSteps is not None:
+            self.deltaSteps[rows] = deltaSteps[ready]
+        if criticStep is not None:
+            self.criticStep[rows, 0] = np.broadcast_to(criticStep, ready.shape)[ready]
+        self.pair[rows] = np.flatnonzero(ready)
+
+        self.steps[ready] += 1
+        self.size += count
+        self._segments = None
+
+    def insert_critic(self, share_obs, rnn_states_critic, masks):
+        """
+        Record the latest input of a centralized critic for every (thread, agent) pair.
+        :param share_obs: (np.ndarray) centralized inputs to the critic.
+        :param rnn_states_critic: (np.ndarray) RNN states for critic network.
+        :param masks: (np.ndarray) denotes whether the environment has terminated or not.
+        """
+        self.critic_share_obs[:] = share_obs
+        self.critic_rnn_states[:] = rnn_states_critic
+        self.critic_masks[:] = masks
+        self.critic_step += 1
+
+    def segments(self):
+        ''' Return the arena rows of each pair in insertion order, as a list indexed by thread * num_agents + agent. '''
+        if self._segments is None:
+            order = np.argsort(self.pair[:self.size], kind="stable")
+            self._segments = np.split(order, np.cumsum(self.steps.ravel())[:-1])
+        return self._segments
+
+    def segment(self, thread, agent_id):
+        ''' Return a buffer view of the transitions of a single (thread, agent) pair. '''
+        return PackedSegment(self, self.segments()[thread * self.num_agents + agent_id])
+
+    def series(self):
+        '''
+        Return a buffer view of the segments of all pairs one after another, as used to train a centralized critic.
+        The RNN state is reset at the start of every segment, and the view has no action masking.
+        '''
+        counts = self.steps.ravel()
+        first = np.zeros(self.size, dtype=bool)
+        first[(np.cumsum(counts) - counts)[counts > 0]] = True
+        return PackedSegment(self, np.concatenate(self.segments()), first=first)
+
+    def last_rows(self):
+        ''' Return the (threads, agents) arena rows of the last transition of each pair, or -1 for pairs without any. '''
+        rows = np.array([seg[-1] if len(seg) > 0 else -1 for seg in self.segments()])
+        return rows.reshape(self.steps.shape)
+
+    def compute_returns(self, next_values, next_masks, value_normalizer=None, pairs=None):
+        """
+        Compute the returns of the transitions of each pair, running the backward recursion over all segments at once.
+        :param next_values: (np.ndarray) (threads, agents, 1) value used to bootstrap the end of each segment.
+        :param next_masks: (np.ndarray) (threads, agents, 1) mask applied to the bootstrap value.
+        :param value_normalizer: (PopArt / ValueNorm) normalizer of the value predictions, if any.
+        :param pairs: (np.ndarray) (threads, agents) boolean mask of the pairs to compute. Defaults to all pairs.
+        """
+        if pairs is None:
+            pairs = np.ones(self.steps.shape, dtype=bool)
+        pairs = pairs & (self.steps > 0)
+        if not np.any(pairs):
+            return
+
+        segments = self.segments()
+        counts = self.steps[pairs]
+        n_pairs, length = len(counts), counts.max()
+
+        # Lay the segments out as the columns of a (steps, pairs) matrix, padded past the end of each segment.
+        valid = np.arange(length)[:, None] < counts[None, :]
+        index = np.zeros((n_pairs, length), dtype=np.int64)
+        index[valid.T] = np.concatenate([segments[p] for p in np.flatnonzero(pairs)])
+        index = index.T
+        ends = (counts - 1, np.arange(n_pairs))
+
+        # The padding is cut off like a time limit, so nothing leaks from it into the segment.
+        padding_masks = valid[..., None].astype(np.float32)
+        rewards = self.rewards[index]
+
+        # Mask applied to the state after each transition: the next transition's own mask, or the bootstrap mask.
+        masks = np.zeros((length, n_pairs, 1), dtype=np.float32)
+        masks[:-1] = self.masks[index[1:]]
+        masks[ends] = next_masks[pairs]
+
+        # Check whether we should use the AMADM GAE modification from https://arxiv.org/abs/2308.06036,
+        # which discounts each transition by the number of steps it spans.
+        # Time limits are not tracked separately (no bad masks are recorded), so use_proper_time_limits has no effect.
+        if (self._use_gae_amadm and not self._use_gae) or self._use_gae:
+            # Value of the state before each transition, followed by the bootstrap value.
+            values = np.zeros((length + 1, n_pairs, 1), dtype=np.float32)
+            values[:-1] = self.value_preds[index]
+            values[(ends[0] + 1, ends[1])] = next_values[pairs]
+            if self._use_popart or self._use_valuenorm:
+                values = value_normalizer.denormalize(values)
+
+            if self._use_gae_amadm and not self._use_gae:
+                deltaSteps = self.deltaSteps[index]
+                discounts = np.power(self.gamma, deltaSteps)
+                traces = np.power(self.gamma * self.gae_lambda, deltaSteps)
+            else:
+                discounts = self.gamma
+                traces = self.gamma * self.gae_lambda
+            returns = gae_returns(rewards, values, masks, discounts, traces, padding_masks)
+        else:
+            # The padding holds the bootstrap value, which is where each segment's returns start from.
+            bootstrap = np.broadcast_to(next_values[pairs], masks.shape)
+            returns = discounted_returns(rewards, bootstrap[0], masks, self.gamma, padding_masks, bootstrap)
+
+        self.returns[index[valid]] = returns[valid]
+
+
+class PackedSegment(object):
+    """
+    Read-only view of a sequence of PackedReplayBuffer transitions, with the interface the trainers expect from
+    a single-thread replay buffer. Minibatches are gathered straight from the arena.
+    :param buffer: (PackedReplayBuffer) buffer holding the transitions.
+    :param rows: (np.ndarray) arena rows of the transitions, in order.
+    :param first: (np.ndarray) optional boolean mask of the positions at which the RNN state is reset, which also
+                  disables action masking.
+    """
+
+    def __init__(self, buffer, rows, first=None):
+        self.buffer = buffer
+        self.rows = rows
+        self.first = first
+        self.step = len(rows)
+
+    def _masks(self, positions):
+        masks = self.buffer.masks[self.rows[positions]]
+        if self.first is not None:
+            masks = np.where(self.first[positions].reshape(*masks.shape[:-1], 1), 0.0, masks).astype(np.float32)
+        return masks
+
+    def _available_actions(self, rows):
+        if self.buffer.available_actions is None:
+            return None
+        if self.first is not None:
+            return np.ones((*rows.shape, self.buffer.available_actions.shape[-1]), dtype=np.float32)
+        return self.buffer.available_actions[rows]
+
+    @property
+    def returns(self):
+        return self.buffer.returns[self.rows][:, None]
+
+    @property
+    def value_preds(self):
+        return self.buffer.value_preds[self.rows][:, None]
+
+    @property
+    def masks(self):
+        return self._masks(np.arange(self.step))[:, None]
+
+    @property
+    def active_masks(self):
+        return self.buffer.active_masks[self.rows][:, None]
+
+    def after_update(self, last_step=-1):
+        # The buffer keeps the current state of each pair, so there is nothing to carry over.
+        pass
+
+    def _batch(self, positions, advantages):
+        ''' Gather the minibatch at the given positions, flattening any leading dimensions. '''
+        buf = self.buffer
+        rows = self.rows[positions]
+        n = rows.size
+
+        available_actions = self._available_actions(rows)
+        if available_actions is not None:
+            available_actions = available_actions.reshape(n, -1)
+
+        obs_batch = buf.obs[rows].reshape(n, *buf.obs.shape[1:])
+        if buf.graph_collator is not None:
+            obs_batch = buf.graph_collator.wrap(buf.obs[:buf.size], obs_batch, rows.reshape(-1))
+
+        return (
+            buf.share_obs[rows].reshape(n, *buf.share_obs.shape[1:]),
+            obs_batch,
+            buf.actions[rows].reshape(n, -1),
+            buf.value_preds[rows].reshape(n, 1),
+            buf.returns[rows].reshape(n, 1),
+            self._masks(positions).reshape(n, 1),
+            buf.active_masks[rows].reshape(n, 1),
+            buf.action_log_probs[rows].reshape(n, -1),
+            None if advantages is None else advantages[positions].reshape(n, 1),
+            available_actions,
+        )
+
+    def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None, last_step=-1):
+        batch_size = self.step if last_step == -1 else last_step
+        if mini_batch_size is None:
+            assert batch_size >= num_mini_batch, (
+                "PPO requires the number of steps ({}) to be greater than or equal to the number of PPO mini "
+                "batches ({}).".format(batch_size, num_mini_batch))
+            mini_batch_size = batch_size // num_mini_batch
+
+        if advantages is not None:
+            advantages = advantages.reshape(-1, 1)
+
+        rand = torch.randperm(batch_size).numpy()
+        sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
+
+        for indices in sampler:
+            share_obs_batch, obs_batch, actions_batch, value_preds_batch, return_batch, masks_batch, \
+                active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch = self._batch(indices, advantages)
+            rows = self.rows[indices]
+            rnn_states_batch = self.buffer.rnn_states[rows]
+            rnn_states_critic_batch = self.buffer.rnn_states_critic[rows]
+
+            yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch
+
+    def naive_recurrent_generator(self, advantages, num_mini_batch, last_step=-1):
+        assert num_mini_batch == 1, (
+            "PPO requires the number of processes (1) to be greater than or equal to the number of "
+            "PPO mini batches ({}).".format(num_mini_batch))
+        length = self.step if last_step == -1 else last_step
+
+        positions = np.arange(length)
+        share_obs_batch, obs_batch, actions_batch, value_preds_batch, return_batch, masks_batch, \
+            active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch = self._batch(positions, advantages.reshape(-1, 1))
+        rnn_states_batch = self.buffer.rnn_states[self.rows[:1]]
+        rnn_states_critic_batch = self.buffer.rnn_states_critic[self.rows[:1]]
+
+        yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch
+
+    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length, last_step=-1):
+        batch_size = self.step if last_step == -1 else last_step
+        data_chunks = batch_size // data_chunk_length  # [C=r*T/L]
+        mini_batch_size = data_chunks // num_mini_batch
+
+        assert batch_size >= data_chunk_length, (
+            "PPO requires the number of steps ({}) to be greater than or equal to the data chunk length "
+            "({}).".format(batch_size, data_chunk_length))
+        assert data_chunks >= 2, ("need larger batch size")
+
+        advantages = advantages.reshape(-1, 1)
+
+        rand = torch.randperm(data_chunks).numpy()
+        sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
+
+        for indices in sampler:
+            # [N] chunks --> [N, L] positions, gathered chunk by chunk and flattened to [N*L].
+            starts = indices * data_chunk_length
+            positions = starts[:, None] + np.arange(data_chunk_length)[None, :]
+            share_obs_batch, obs_batch, actions_batch, value_preds_batch, return_batch, masks_batch, \
+                active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch = self._batch(positions, advantages)
+
+            # States are taken at the start of each chunk.
+            rnn_states_batch = self.buffer.rnn_states[self.rows[starts]]
+            rnn_states_critic_batch = self.buffer.rnn_states_critic[self.rows[starts]]
+
+            yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch
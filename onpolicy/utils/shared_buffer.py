@@ -1,6 +1,7 @@
 import torch
 import numpy as np
-from onpolicy.utils.util import get_shape_from_obs_space, get_shape_from_act_space, has_graph_obs_space
+from onpolicy.utils.util import get_shape_from_obs_space, get_shape_from_act_space, has_graph_obs_space, gae_returns, discounted_returns
+from onpolicy.utils.collated_graphs import GraphCollator
 
 
 def _flatten(T, N, x):
@@ -49,8 +50,11 @@ class SharedReplayBuffer(object):
         
         if has_graph_obs_space(obs_space):
             self.obs = np.empty((self.episode_length + 1, self.n_rollout_threads, num_agents, *obs_shape), dtype=object)
+            # Collate the graphs once per update, so that each minibatch batches them by slicing.
+            self.graph_collator = GraphCollator(obs_space)
         else:
             self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *obs_shape), dtype=np.float32)
+            self.graph_collator = None
 
         self.rnn_states = np.zeros(
             (self.episode_length + 1, self.n_rollout_threads, num_agents, self.recurrent_N, self.hidden_size),
@@ -200,76 +204,34 @@ class SharedReplayBuffer(object):
         if last_step == -1:
             last_step = self.episode_length
 
-        # Check whether we should use the AMADM GAE modification from https://arxiv.org/abs/2308.06036
-        # Unfortunately, I don't have time to implement for all of the other options (like use_proper_time_limits),
-        # so I just ignore them!
-        if self._use_gae_amadm and not self._use_gae:
+        rewards = self.rewards[:last_step]
+        masks = self.masks[1:last_step + 1]
+        bad_masks = self.bad_masks[1:last_step + 1] if self._use_proper_time_limits else None
+
+        # Check whether we should use the AMADM GAE modification from https://arxiv.org/abs/2308.06036,
+        # which discounts each step by the number of environment steps it spans.
+        # It does not support the other options (like use_proper_time_limits), so they are ignored.
+        if (self._use_gae_amadm and not self._use_gae) or self._use_gae:
             self.value_preds[last_step] = next_value
-            gae = 0
-            for step in reversed(range(last_step)):
-                if self._use_popart or self._use_valuenorm:
-                    delta = self.rewards[step] + np.power(self.gamma, self.deltaSteps[step]) * value_normalizer.denormalize(
-                        self.value_preds[step + 1]) * self.masks[step + 1] \
-                            - value_normalizer.denormalize(self.value_preds[step])
-                    gae = delta + np.power(self.gamma * self.gae_lambda, self.deltaSteps[step]) * self.masks[step + 1] * gae
-                    self.returns[step] = gae + value_normalizer.denormalize(self.value_preds[step])
-                else:
-                    delta = self.rewards[step] + np.power(self.gamma, self.deltaSteps[step]) * self.value_preds[step + 1] * self.masks[step + 1] - \
-                            self.value_preds[step]
-                    gae = delta + np.power(self.gamma * self.gae_lambda, self.deltaSteps[step]) * self.masks[step + 1] * gae
-                    self.returns[step] = gae + self.value_preds[step]
-        
-        elif self._use_proper_time_limits:
-            if self._use_gae:
-                self.value_preds[last_step] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if self._use_popart or self._use_valuenorm:
-                        # step + 1
-                        delta = self.rewards[step] + self.gamma * value_normalizer.denormalize(
-                            self.value_preds[step + 1]) * self.masks[step + 1] \
-                                - value_normalizer.denormalize(self.value_preds[step])
-                        gae = delta + self.gamma * self.gae_lambda * gae * self.masks[step + 1]
-                        gae = gae * self.bad_masks[step + 1]
-                        self.returns[step] = gae + value_normalizer.denormalize(self.value_preds[step])
-                    else:
-                        delta = self.rewards[step] + self.gamma * self.value_preds[step + 1] * self.masks[step + 1] - \
-                                self.value_preds[step]
-                        gae = delta + self.gamma * self.gae_lambda * self.masks[step + 1] * gae
-                        gae = gae * self.bad_masks[step + 1]
-                        self.returns[step] = gae + self.value_preds[step]
+            values = self.value_preds[:last_step + 1]
+            if self._use_popart or self._use_valuenorm:
+                values = value_normalizer.denormalize(values)
+
+            if self._use_gae_amadm and not self._use_gae:
+                deltaSteps = self.deltaSteps[:last_step]
+                discounts = np.power(self.gamma, deltaSteps)
+                traces = np.power(self.gamma * self.gae_lambda, deltaSteps)
+                bad_masks = None
             else:
-                self.returns[last_step] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    if self._use_popart or self._use_valuenorm:
-                        self.returns[step] = (self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[
-                            step]) * self.bad_masks[step + 1] \
-                                             + (1 - self.bad_masks[step + 1]) * value_normalizer.denormalize(
-                            self.value_preds[step])
-                    else:
-                        self.returns[step] = (self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[
-                            step]) * self.bad_masks[step + 1] \
-                                             + (1 - self.bad_masks[step + 1]) * self.value_preds[step]
+                discounts = self.gamma
+                traces = self.gamma * self.gae_lambda
+            self.returns[:last_step] = gae_returns(rewards, values, masks, discounts, traces, bad_masks)
         else:
-            if self._use_gae:
-                self.value_preds[last_step] = next_value
-                gae = 0
-                for step in reversed(range(self.rewards.shape[0])):
-                    if self._use_popart or self._use_valuenorm:
-                        delta = self.rewards[step] + self.gamma * value_normalizer.denormalize(
-                            self.value_preds[step + 1]) * self.masks[step + 1] \
-                                - value_normalizer.denormalize(self.value_preds[step])
-                        gae = delta + self.gamma * self.gae_lambda * self.masks[step + 1] * gae
-                        self.returns[step] = gae + value_normalizer.denormalize(self.value_preds[step])
-                    else:
-                        delta = self.rewards[step] + self.gamma * self.value_preds[step + 1] * self.masks[step + 1] - \
-                                self.value_preds[step]
-                        gae = delta + self.gamma * self.gae_lambda * self.masks[step + 1] * gae
-                        self.returns[step] = gae + self.value_preds[step]
-            else:
-                self.returns[last_step] = next_value
-                for step in reversed(range(self.rewards.shape[0])):
-                    self.returns[step] = self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[step]
+            self.returns[last_step] = next_value
+            values = self.value_preds[:last_step]
+            if bad_masks is not None and (self._use_popart or self._use_valuenorm):
+                values = value_normalizer.denormalize(values)
+            self.returns[:last_step] = discounted_returns(rewards, self.returns[last_step], masks, self.gamma, bad_masks, values)
 
     def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None, last_step=-1):
         """
@@ -314,6 +276,8 @@ class SharedReplayBuffer(object):
             # obs size [T+1 N M Dim]-->[T N M Dim]-->[T*N*M,Dim]-->[index,Dim]
             share_obs_batch = share_obs[indices]
             obs_batch = obs[indices]
+            if self.graph_collator is not None:
+                obs_batch = self.graph_collator.wrap(obs, obs_batch, indices)
             rnn_states_batch = rnn_states[indices]
             rnn_states_critic_batch = rnn_states_critic[indices]
             actions_batch = actions[indices]
@@ -418,6 +382,9 @@ class SharedReplayBuffer(object):
             # Flatten the (T, N, ...) from_numpys to (T * N, ...)
             share_obs_batch = _flatten(T, N, share_obs_batch)
             obs_batch = _flatten(T, N, obs_batch)
+            if self.graph_collator is not None:
+                inds = perm[start_ind:start_ind + num_envs_per_batch]
+                obs_batch = self.graph_collator.wrap(obs[:last_step], obs_batch, (np.arange(T)[:, None] * batch_size + inds).ravel())
             actions_batch = _flatten(T, N, actions_batch)
             if self.available_actions is not None:
                 available_actions_batch = _flatten(T, N, available_actions_batch)
@@ -533,6 +500,8 @@ class SharedReplayBuffer(object):
             # Flatten the (L, N, ...) from_numpys to (L * N, ...)
             share_obs_batch = _flatten(L, N, share_obs_batch)
             obs_batch = _flatten(L, N, obs_batch)
+            if self.graph_collator is not None:
+                obs_batch = self.graph_collator.wrap(obs, obs_batch, (np.arange(L)[:, None] + indices * L).ravel())
             actions_batch = _flatten(L, N, actions_batch)
             if self.available_actions is not None:
                 available_actions_batch = _flatten(L, N, available_actions_batch)
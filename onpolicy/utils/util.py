@@ -1,10 +1,11 @@
 import numpy as np
 import math
-import torch
 from copy import copy
 
 def check(input):
     if type(input) == np.ndarray:
+        # torch is imported here so that environments can use these utilities without it.
+        import torch
         return torch.from_numpy(input)
         
 def get_grad_norm(it):
@@ -100,6 +101,36 @@ def get_shape_from_act_space(act_space):
         act_shape = act_space[0].shape[0] + 1  
     return act_shape
 
+def gae_returns(rewards, values, masks, discounts, traces, bad_masks=None):
+    ''' Compute GAE returns with a backward scan over the first (time) axis.
+        values holds the (denormalized) value of each step followed by the bootstrap value, and masks the mask
+        of the state after each step. discounts and traces are the factors applied to the next value and to the
+        next advantage, either scalars or per-step arrays (e.g. gamma ** deltaSteps for semi-MDP discounting).
+        bad_masks optionally cuts the advantage at time limits. '''
+    # Everything except the recursion itself is computed for all steps at once.
+    deltas = rewards + discounts * values[1:] * masks - values[:-1]
+    coefs = traces * masks
+    advantages = np.empty_like(deltas)
+    gae = 0
+    for step in reversed(range(len(deltas))):
+        gae = deltas[step] + coefs[step] * gae
+        if bad_masks is not None:
+            gae = gae * bad_masks[step]
+        advantages[step] = gae
+    return advantages + values[:-1]
+
+def discounted_returns(rewards, next_return, masks, gamma, bad_masks=None, values=None):
+    ''' Compute discounted returns with a backward scan over the first (time) axis, starting from next_return.
+        Where bad_masks is 0 (a time limit), the return is replaced by the corresponding entry of values. '''
+    returns = np.empty_like(rewards)
+    ret = next_return
+    for step in reversed(range(len(rewards))):
+        ret = ret * gamma * masks[step] + rewards[step]
+        if bad_masks is not None:
+            ret = ret * bad_masks[step] + (1 - bad_masks[step]) * values[step]
+        returns[step] = ret
+    return returns
+
 
 def tile_images(img_nhwc):
     """
@@ -120,3 +151,81 @@ def tile_images(img_nhwc):
     img_HhWwc = img_HWhwc.transpose(0, 2, 1, 3, 4)
     img_Hh_Ww_c = img_HhWwc.reshape(H*h, W*w, c)
     return img_Hh_Ww_c
+
+
+class FlattenPlan(object):
+    """
+    Flattens observations of a fixed gymnasium space into a reusable output array, producing exactly what
+    gymnasium.spaces.utils.flatten() would. The nested space is compiled once into a list of leaves, each
+    holding a view of the output at its precomputed offset, so flattening does not allocate per leaf.
+    :param space: (gymnasium.spaces.Space) the space to flatten, which must be numpy-flattenable.
+    :param out: (np.ndarray) optional 1D output array of flatdim(space) elements to write into, e.g. a row of a
+                larger buffer. Its dtype may be wider than the flattened dtype, as when the space is one part of a larger Dict.
+    """
+    def __init__(self, space, out=None):
+        from gymnasium.spaces import Box, Dict, Discrete
+        from gymnasium.spaces.utils import flatdim
+
+        self.space = space
+        self.leaves = []
+        leaf_dtypes = []
+
+        # Collect the leaf spaces in the same order that flatten() concatenates them.
+        def collect(s, path):
+            if isinstance(s, Dict):
+                for k, sub in s.spaces.items():
+                    collect(sub, path + (k,))
+            else:
+                leaf_dtypes.append(s.dtype)
+                self.leaves.append((path, s))
+        collect(space, ())
+
+        self.size = flatdim(space)
+        self.out = np.zeros(self.size, dtype=np.result_type(*leaf_dtypes)) if out is None else out
+        self.dtype = self.out.dtype
+        if self.out.shape != (self.size,) or not np.can_cast(np.result_type(*leaf_dtypes), self.dtype, casting="safe"):
+            raise ValueError(f"Output array must have shape ({self.size},) and a dtype which can hold {np.result_type(*leaf_dtypes)}")
+
+        # Assign each leaf its view of the output. Leaves whose dtype differs from the output are first cast
+        # through a staging array of their own dtype, matching the per-leaf cast that flatten() performs.
+        compiled = []
+        offset = 0
+        for path, s in self.leaves:
+            size = flatdim(s)
+            view = self.out[offset:offset + size]
+            if isinstance(s, Box):
+                kind = "box"
+                view = view.reshape(s.shape)
+            elif isinstance(s, Discrete):
+                kind = "discrete"
+            else:
+                kind = "other"
+            stage = np.zeros(view.shape, dtype=s.dtype) if kind == "box" and s.dtype != self.dtype else None
+            compiled.append((path, s, kind, view, stage))
+            offset += size
+        self.leaves = compiled
+
+    def __call__(self, x):
+        """
+        Flatten x into the output array.
+        :param x: an element of the space.
+
+        :return out: (np.ndarray) the output array, which is overwritten by the next call.
+        """
+        for path, s, kind, view, stage in self.leaves:
+            v = x
+            for k in path:
+                v = v[k]
+            if kind == "box":
+                if stage is None:
+                    view[...] = v
+                else:
+                    stage[...] = v
+                    view[...] = stage
+            elif kind == "discrete":
+                view[...] = 0
+                view[v - s.start] = 1
+            else:
+                from gymnasium.spaces.utils import flatten
+                view[...] = flatten(s, v)
+        return self.out
@@ -0,0 +1,448 @@
+import random
+import numpy as np
+from sdzoo.env.sdzoo import ACTION
+
+
+class SDBatchEnv():
+    ''' Simulates a batch of independent search-and-deliver episodes which share a single graph.
+        All episode and agent state is stored as arrays with leading (episode, agent) dimensions, and
+        every episode is advanced by a single vectorized call to `step`.
+
+        The dynamics, rewards and action masks follow `parallel_env`. Agents within an episode act in
+        order of their id, exactly as in `parallel_env`, so a batch of one episode reproduces a
+        `parallel_env` rollout given the same seeds. Observations follow the "adjacency" observation
+        method. Communication, attrition and graph regeneration are not supported. '''
+
+    def __init__(self, sd_graph, num_agents, num_envs,
+                 require_explicit_visit = True,
+                 speed = 1.0,
+                 alpha = 10.0,
+                 beta = 100.0,
+                 action_method = "neighbors",
+                 action_full_max_nodes = 40,
+                 action_neighbors_max_degree = 15,
+                 reward_method_terminal = "average",
+                 observation_radius = np.inf,
+                 max_cycles: int = -1,
+                 drop_reward = 5,
+                 load_reward = 5,
+                 state_reward = 20,
+                 step_penalty = 0.1,
+                 agent_max_capacity = 1,
+                 auto_reset: bool = True):
+        '''
+        Initialize the batch of environments.
+
+        Args:
+            sd_graph (SDGraph): The graph shared by all episodes.
+            num_agents (int): The number of agents in each episode.
+            num_envs (int): The number of episodes simulated in parallel.
+            auto_reset (bool): Whether episodes are reset as soon as they finish.
+
+        The remaining arguments have the same meaning as for `parallel_env`.
+        '''
+
+        self.sdg = sd_graph
+        self.num_agents = num_agents
+        self.num_envs = num_envs
+
+        # Configuration.
+        self.requireExplicitVisit = require_explicit_visit
+        self.speed = speed
+        self.alpha = alpha
+        self.beta = beta
+        self.action_method = action_method
+        self.action_full_max_nodes = action_full_max_nodes
+        self.action_neighbors_max_degree = action_neighbors_max_degree
+        self.reward_method_terminal = reward_method_terminal
+        self.observationRadius = observation_radius
+        self.max_cycles = max_cycles
+        self.drop_reward = drop_reward
+        self.load_reward = load_reward
+        self.state_reward = state_reward
+        self.step_penalty = step_penalty
+        self.agent_max_capacity = agent_max_capacity
+        self.auto_reset = auto_reset
+
+        # Static graph information, indexed by node.
+        numNodes = self.sdg.graph.number_of_nodes()
+        self.numNodes = numNodes
+        self.nodePositions = self.sdg.nodePositions
+        self.nodePeople = self.sdg.nodePeople.astype(np.int64)
+        self.nodeDegree = np.zeros(numNodes, dtype=np.int64)
+        self.nodeDegree[self.sdg.nodeOrder] = self.sdg.nodeDegree
+
+        # Neighbor lists and edge weights, in the same order as the graph's neighbor lists.
+        src, dst = self.sdg.nodeOrder[self.sdg.edgeIndex]
+        self.neighborTable = np.full((numNodes, max(self.nodeDegree.max(), 1)), -1, dtype=np.int64)
+        self.neighborTable[src, self.sdg.edgeNeighborIndex] = dst
+        self.edgeWeightMatrix = np.zeros((numNodes, numNodes), dtype=np.float64)
+        self.edgeWeightMatrix[src, dst] = self.sdg.edgeWeights
+
+        # The normalized adjacency matrix, shared read-only by all observations.
+        self.adjacencyMatrix = -1.0 * np.ones((numNodes, numNodes), dtype=np.float32)
+        if len(self.sdg.edgeWeights) > 0:
+            weights = self.sdg.edgeWeights
+            self.adjacencyMatrix[src, dst] = self._minMaxNormalize(weights, minimum=weights.min(), maximum=weights.max())
+        self.adjacencyMatrix.setflags(write=False)
+
+        # Size of the action space.
+        if self.action_method == "full":
+            if self.action_full_max_nodes < numNodes:
+                raise ValueError("The action space is smaller than the graph size.")
+            self.action_size = (self.action_full_max_nodes if self.action_full_max_nodes > 0 else numNodes) + 2 # add 2 for load and drop
+        elif self.action_method == "neighbors":
+            self.action_size = self.action_neighbors_max_degree + 2 # add 2 for load and drop
+        else:
+            raise ValueError(f"Invalid action method {self.action_method}")
+
+        # Per-episode node state.
+        self.nodePayloads = np.zeros((num_envs, numNodes), dtype=np.int64)
+        self.nodeDeficit = np.zeros((num_envs, numNodes), dtype=np.int64)
+        self.nodeSurplus = np.zeros((num_envs, numNodes), dtype=np.int64)
+        self.totalDeficit = np.zeros(num_envs, dtype=np.int64)
+        self.nodeVisits = np.zeros((num_envs, numNodes), dtype=np.int64)
+
+        # Per-agent state. Agents which are on a node have an edge of (-1, -1), and no current action is -1.
+        self.agentPositions = np.zeros((num_envs, num_agents, 2), dtype=np.float64)
+        self.agentLastNode = np.zeros((num_envs, num_agents), dtype=np.int64)
+        self.agentEdges = np.full((num_envs, num_agents, 2), -1, dtype=np.int64)
+        self.agentCurrentAction = np.full((num_envs, num_agents), -1, dtype=np.int64)
+        self.agentPayloads = np.zeros((num_envs, num_agents), dtype=np.int64)
+        self.agentLastNodeVisited = np.full((num_envs, num_agents), -1, dtype=np.int64)
+
+        # Per-episode bookkeeping.
+        self.step_count = np.zeros(num_envs, dtype=np.int64)
+        self.dones = np.zeros(num_envs, dtype=bool)
+        self.available_actions = np.zeros((num_envs, num_agents, self.action_size), dtype=np.float32)
+
+        self.reset()
+
+
+    def reset(self, seed=None, envs=None):
+        ''' Resets the given episodes (all of them by default) to their initial state.
+            Returns the observations of all episodes. '''
+
+        if seed != None:
+            random.seed(seed)
+        envs = np.arange(self.num_envs) if envs is None else np.asarray(envs, dtype=np.int64).reshape(-1)
+
+        # Distribute the payloads and pick the agent origins, one episode at a time so each uses the same random draws as `parallel_env`.
+        nodes = list(self.sdg.graph.nodes)
+        origins = np.zeros((len(envs), self.num_agents), dtype=np.int64)
+        for i, env in enumerate(envs):
+            self.sdg.distributePayloads(self.nodePayloads[env])
+            origins[i] = random.sample(nodes, self.num_agents)
+        self._updateNodeStates(envs)
+
+        # Reset the agents.
+        self.agentPositions[envs] = self.nodePositions[origins]
+        self.agentLastNode[envs] = origins
+        self.agentEdges[envs] = -1
+        self.agentCurrentAction[envs] = -1
+        self.agentPayloads[envs] = 0
+        self.agentLastNodeVisited[envs] = -1
+
+        # Reset other state.
+        self.nodeVisits[envs] = 0
+        self.step_count[envs] = 0
+        self.dones[envs] = False
+        self._updateAvailableActions()
+
+        return self.observe()
+
+
+    def step(self, actions):
+        '''
+        Perform a step in every episode which has not finished yet.
+
+        Args:
+            actions (np.ndarray): An array of shape (num_envs, num_agents) holding the action of each agent.
+
+        Returns:
+            obs (dict): The observations of all episodes, as returned by `observe`.
+            rewards (np.ndarray): The reward of each agent, of shape (num_envs, num_agents).
+            dones (np.ndarray): Whether each agent is done, of shape (num_envs, num_agents).
+            truncated (np.ndarray): Whether each agent was truncated, of shape (num_envs, num_agents).
+            info (dict): Additional information, with the "ready" flag of each agent, and the node visits and total deficit of each episode.
+
+        If `auto_reset` is set, finished episodes are reset and the returned observations belong to the new episodes.
+        '''
+
+        actions = np.asarray(actions, dtype=np.int64).reshape(self.num_envs, self.num_agents)
+        rewards = np.zeros((self.num_envs, self.num_agents), dtype=np.float64)
+        ready = np.repeat(self.dones[:, None], self.num_agents, axis=1) #if done, set ready to true.
+
+        active = np.flatnonzero(~self.dones)
+        self.step_count[active] += 1
+
+        # Perform actions, one agent at a time.
+        for a in range(self.num_agents):
+            action = actions[active, a]
+
+            # Store this as the agent's last action.
+            self.agentCurrentAction[active, a] = action
+
+            drop = action == self.action_neighbors_max_degree + ACTION.DROP
+            load = action == self.action_neighbors_max_degree + ACTION.LOAD
+            move = ~(drop | load)
+
+            # Attempt to drop or load payloads, adding the appropriate reward.
+            rewards[active[drop], a] += self._dropPayloads(active[drop], a)
+            rewards[active[load], a] += self._loadPayloads(active[load], a)
+            ready[active[~move], a] = True
+
+            # Take a step along the shortest path to the destination node.
+            envs = active[move]
+            dstNodes = self.getDestinationNodes(envs, a, action[move])
+            stepSize = np.random.normal(loc=self.speed, scale=1.0, size=len(envs))
+            arrived = self._moveAgents(envs, a, dstNodes, stepSize)
+            self.agentCurrentAction[envs[arrived], a] = -1
+            ready[envs[arrived], a] = True
+
+            # Add a small penalty for each step taken.
+            rewards[envs, a] -= self.step_penalty
+
+        # Check termination conditions.
+        finished = np.zeros(self.num_envs, dtype=bool)
+        finished[active] = self.totalDeficit[active] == 0
+        if self.max_cycles >= 0:
+            finished[active] |= self.step_count[active] >= self.max_cycles
+
+        # Provide an end-of-episode reward.
+        if self.reward_method_terminal == "average":
+            rewards[finished] += (self._minMaxNormalize(-self.totalDeficit[finished], minimum=-self.sdg.getTotalPayloads(), maximum=0.0) * self.state_reward * self.beta)[:, None]
+        elif self.reward_method_terminal != "none":
+            raise ValueError(f"Invalid terminal reward method {self.reward_method_terminal}")
+        ready[finished] = True
+        self.dones |= finished
+
+        dones = np.repeat(self.dones[:, None], self.num_agents, axis=1)
+        truncated = np.repeat(finished[:, None], self.num_agents, axis=1)
+        info = {
+            "ready": ready,
+            "node_visits": self.nodeVisits.copy(),
+            "total_state": self.totalDeficit.copy()
+        }
+
+        if self.auto_reset and finished.any():
+            obs = self.reset(envs=np.flatnonzero(finished))
+        else:
+            self._updateAvailableActions()
+            obs = self.observe()
+
+        return obs, rewards, dones, truncated, info
+
+
+    def observe(self):
+        ''' Returns the "adjacency" observation of every agent in every episode, stacked into arrays
+            with leading (num_envs, num_agents) dimensions. '''
+
+        # Add people and payloads at each visible vertex.
+        vertexDist = self._dist(self.nodePositions[None, None, :, :], self.agentPositions[:, :, None, :])
+        vertexState = np.stack((self.nodeDeficit, self.nodeSurplus), axis=-1)[:, None, :, :]
+        vertexState = np.where((vertexDist <= self.observationRadius)[..., None], vertexState, -1.0).astype(np.float32)
+
+        # Add the graph position of each visible agent.
+        agentDist = self._dist(self.agentPositions[:, None, :, :], self.agentPositions[:, :, None, :])
+        graphPos = self._getAgentGraphPositions()[:, None, :, :]
+        graphPos = np.where((agentDist <= self.observationRadius)[..., None], graphPos, -1.0).astype(np.float32)
+
+        return {
+            "adjacency": self.adjacencyMatrix,
+            "agent_graph_position": graphPos,
+            "agent_id": np.broadcast_to(np.arange(self.num_agents), (self.num_envs, self.num_agents)),
+            "vertex_state": vertexState
+        }
+
+
+    def getDestinationNodes(self, envs, a, actions):
+        ''' Returns the destination node of agent `a` in each of the given episodes for the given movement actions. '''
+
+        if self.action_method == "full":
+            if ((actions < 0) | (actions >= self.numNodes)).any():
+                raise ValueError(f"Invalid actions {actions} for agent {a}")
+            return actions
+
+        lastNodes = self.agentLastNode[envs, a]
+        invalid = (actions < 0) | (actions >= self.nodeDegree[lastNodes])
+        if invalid.any():
+            raise ValueError(f"Invalid actions {actions[invalid]} for agent {a}. Nodes {lastNodes[invalid]} have only {self.nodeDegree[lastNodes[invalid]]} neighbors.")
+        return self.neighborTable[lastNodes, actions]
+
+
+    def _moveAgents(self, envs, a, dstNodes, stepSize):
+        ''' Moves agent `a` in each of the given episodes along the shortest path to its destination node,
+            covering at most `stepSize`. Returns a mask of the episodes in which the agent reached its destination. '''
+
+        positions = self.agentPositions[envs, a]
+        lastNodes = self.agentLastNode[envs, a]
+        edges = self.agentEdges[envs, a]
+        nextHop = self.sdg.shortestPathNextHop
+
+        # Determine the first node on the path. Agents on an edge head for whichever end results in the shortest path.
+        onEdge = edges[:, 0] >= 0
+        pathLen1 = self._dist(positions, self.nodePositions[edges[:, 0]]) + self.sdg.shortestPathLengths[edges[:, 0], dstNodes]
+        pathLen2 = self._dist(positions, self.nodePositions[edges[:, 1]]) + self.sdg.shortestPathLengths[edges[:, 1], dstNodes]
+        targets = np.where(lastNodes == dstNodes, dstNodes, nextHop[lastNodes, dstNodes])
+        targets = np.where(onEdge, np.where(pathLen2 < pathLen1, edges[:, 1], edges[:, 0]), targets)
+
+        arrived = np.zeros(len(envs), dtype=bool)
+        moving = np.arange(len(envs))
+        while len(moving) > 0:
+            node = targets[moving]
+            pos = positions[moving]
+            stepLeft = stepSize[moving]
+
+            # Take a step towards the next node.
+            posNextNode = self.nodePositions[node]
+            distCurrToNext = self._dist(pos, posNextNode)
+            reached = distCurrToNext <= stepLeft
+            step = np.where(reached, distCurrToNext, stepLeft)
+            hasDist = distCurrToNext > 0.0
+            dist = np.where(hasDist, distCurrToNext, 1.0)[:, None]
+            positions[moving] = np.where(hasDist[:, None], pos + (posNextNode - pos) * step[:, None] / dist, pos)
+
+            # Set information about the node/edge which the agent is currently on.
+            leaving = ~reached & (lastNodes[moving] != node)
+            edges[moving[leaving]] = np.sort(np.stack((lastNodes[moving[leaving]], node[leaving]), axis=1), axis=1)
+            lastNodes[moving[reached]] = node[reached]
+            edges[moving[reached]] = -1
+
+            # Visit the node if it is the destination, or if visits need not be explicit.
+            atDst = reached & (node == dstNodes[moving])
+            visited = atDst if self.requireExplicitVisit else reached
+            np.add.at(self.nodeVisits, (envs[moving[visited]], node[visited]), 1)
+            self.agentLastNodeVisited[envs[moving[visited]], a] = node[visited]
+            arrived[moving[atDst]] = True
+
+            # Continue along the path while the agent has movement budget left.
+            stepSize[moving] = np.maximum(stepLeft - distCurrToNext, 0.0)
+            moving = moving[~atDst & (stepSize[moving] > 0.0)]
+            targets[moving] = nextHop[targets[moving], dstNodes[moving]]
+
+        self.agentPositions[envs, a] = positions
+        self.agentLastNode[envs, a] = lastNodes
+        self.agentEdges[envs, a] = edges
+        return arrived
+
+
+    def _dropPayloads(self, envs, a):
+        ''' Drops a payload for agent `a` in each of the given episodes and returns the rewards.
+            There is a positive reward for dropping a payload for a person in need, and 0 reward for dropping unneeded payloads. '''
+
+        rewards = np.zeros(len(envs), dtype=np.float64)
+        nodes = self.agentLastNode[envs, a]
+        initial_deficit = self.nodeDeficit[envs, nodes]
+
+        carrying = self.agentPayloads[envs, a] > 0
+        envs, nodes = envs[carrying], nodes[carrying]
+        self.nodePayloads[envs, nodes] += 1
+        self.agentPayloads[envs, a] -= 1
+        new_deficit = self._updateNodeStates(envs, nodes)
+
+        rewards[carrying] = (initial_deficit[carrying] - new_deficit) * self.drop_reward * self.alpha
+        return rewards
+
+
+    def _loadPayloads(self, envs, a):
+        ''' Loads a payload for agent `a` in each of the given episodes and returns the rewards.
+            There is 0 reward for loading properly and a negative reward for taking a payload from a person in need. '''
+
+        rewards = np.zeros(len(envs), dtype=np.float64)
+        nodes = self.agentLastNode[envs, a]
+        initial_deficit = self.nodeDeficit[envs, nodes]
+
+        canLoad = (self.agentPayloads[envs, a] < self.agent_max_capacity) & (self.nodePayloads[envs, nodes] > 0)
+        envs, nodes = envs[canLoad], nodes[canLoad]
+        self.nodePayloads[envs, nodes] -= 1
+        self.agentPayloads[envs, a] += 1
+        new_deficit = self._updateNodeStates(envs, nodes)
+
+        rewards[canLoad] = (initial_deficit[canLoad] - new_deficit) * self.load_reward * self.alpha
+        return rewards
+
+
+    def _updateNodeStates(self, envs, nodes=None):
+        ''' Recalculates the deficit and surplus of the given nodes (all nodes by default) in the given episodes,
+            keeping the total deficit up to date. Returns the new deficits. '''
+
+        if nodes is None:
+            payloads = self.nodePayloads[envs]
+            self.nodeDeficit[envs] = np.maximum(self.nodePeople - payloads, 0)
+            self.nodeSurplus[envs] = np.maximum(payloads - self.nodePeople, 0)
+            self.totalDeficit[envs] = self.nodeDeficit[envs].sum(axis=1)
+            return self.nodeDeficit[envs]
+
+        payloads = self.nodePayloads[envs, nodes]
+        deficit = np.maximum(self.nodePeople[nodes] - payloads, 0)
+        self.totalDeficit[envs] += deficit - self.nodeDeficit[envs, nodes]
+        self.nodeDeficit[envs, nodes] = deficit
+        self.nodeSurplus[envs, nodes] = np.maximum(payloads - self.nodePeople[nodes], 0)
+        return deficit
+
+
+    def _updateAvailableActions(self):
+        ''' Recalculates the action masks of every agent in every episode. '''
+
+        onNode = self.agentEdges[:, :, 0] < 0
+        nodePayloads = np.take_along_axis(self.nodePayloads, self.agentLastNode, axis=1)
+        canLoad = (self.agentPayloads < self.agent_max_capacity) & (nodePayloads > 0)
+        canDrop = self.agentPayloads > 0
+
+        # All movement actions are available to agents which are on a node, plus load and drop where possible.
+        if self.action_method == "full":
+            numMoves = np.full_like(self.agentLastNode, self.numNodes)
+            offset = self.numNodes
+        else:
+            numMoves = self.nodeDegree[self.agentLastNode]
+            offset = self.action_neighbors_max_degree
+        masks = np.arange(self.action_size) < numMoves[:, :, None]
+        masks[:, :, offset + ACTION.LOAD] = canLoad
+        masks[:, :, offset + ACTION.DROP] = canDrop
+        masks &= onNode[:, :, None]
+
+        # Agents on an edge can only continue their current action.
+        envs, agents = np.nonzero(~onNode)
+        masks[envs, agents, self.agentCurrentAction[envs, agents]] = True
+
+        self.available_actions[:] = masks
+
+
+    def _getAgentGraphPositions(self):
+        ''' Returns the graph position vector of every agent: the nodes of the edge it is on (or its node twice),
+            the distance to the first node relative to the edge length, its payloads and its capacity. '''
+
+        onNode = self.agentEdges[:, :, 0] < 0
+        node1 = np.where(onNode, self.agentLastNode, self.agentEdges[:, :, 0])
+        node2 = np.where(onNode, self.agentLastNode, self.agentEdges[:, :, 1])
+
+        # Length of the shortest path to the first node, via either end of the edge.
+        pathLen1 = self._dist(self.agentPositions, self.nodePositions[node1]) + self.sdg.shortestPathLengths[node1, node1]
+        pathLen2 = self._dist(self.agentPositions, self.nodePositions[node2]) + self.sdg.shortestPathLengths[node2, node1]
+        pathLen = np.where(pathLen2 < pathLen1, pathLen2, pathLen1)
+        weight = np.where(onNode, 1.0, self.edgeWeightMatrix[node1, node2])
+
+        return np.stack((
+            node1,
+            node2,
+            np.where(onNode, 1.0, pathLen / weight),
+            self.agentPayloads,
+            np.full_like(self.agentPayloads, self.agent_max_capacity)
+        ), axis=-1)
+
+
+    def _dist(self, pos1, pos2):
+        ''' Calculates the Euclidean distance between two arrays of points. '''
+
+        return np.sqrt(np.power(pos1[..., 0] - pos2[..., 0], 2) + np.power(pos1[..., 1] - pos2[..., 1], 2))
+
+
+    def _minMaxNormalize(self, x, eps=1e-8, a=0.0, b=1.0, maximum=None, minimum=None):
+        ''' Normalizes numpy array x to be between a and b. '''
+
+        if maximum is None:
+            maximum = np.max(x)
+        if minimum is None:
+            minimum = np.min(x)
+        return a + (x - minimum) * (b - a) / (maximum - minimum + eps)
@@ -1,9 +1,20 @@
 import numpy as np
 import networkx as nx
 import math
-import matplotlib.pyplot as plt
+import hashlib
+import io
+import os
 import random
 from enum import IntEnum
+from scipy.spatial import cKDTree
+
+# Arrays stored in the compiled graph cache, in addition to the header and the networkx topology.
+GRAPH_CACHE_ARRAYS = [
+    "nodePositions", "nodeDepot", "nodePeople", "nodePayloads",
+    "shortestPathLengths", "shortestPathNextHop",
+    "nodeOrder", "nodeOrderIndex", "nodeDegree", "edgeOffsets", "edgeIndex", "edgeWeights", "edgeNeighborIndex"
+]
+GRAPH_CACHE_VERSION = 1
 
 class NODE_TYPE(IntEnum):
     OBSERVABLE_NODE = 0
@@ -15,16 +26,80 @@ class SDGraph():
     ''' This reads a graph file of the format provided by
         https://github.com/davidbsp/patrolling_sim '''
     
-    def __init__(self, filepath = None, numNodes = 40, payloads = 25):
+    def __init__(self, filepath = None, numNodes = 40, payloads = 25, useCache = True):
         self.graph = nx.Graph()
         if filepath is None:
             self.generateRandomGraph(numNodes, payloads=payloads)
         else:
-            self.loadFromFile(filepath)
-
-
-    def loadFromFile(self, filepath: str): 
-        with open(filepath, "r") as file:
+            self.loadFromFile(filepath, useCache=useCache)
+
+
+    def _allocateNodeState(self, numNodes):
+        ''' Allocates the per-node state arrays. The networkx graph only stores topology and edge weights;
+            all node state is kept here, indexed by node. `nodeVersion` is bumped whenever a node's payloads change,
+            so observers can tell which nodes changed since they last looked. '''
+
+        self.nodePositions = np.zeros((numNodes, 2), dtype=np.float64)
+        self.nodeIds = np.arange(numNodes, dtype=np.int32)
+        self.nodeDepot = np.zeros(numNodes, dtype=bool)
+        self.nodePeople = np.zeros(numNodes, dtype=np.int32)
+        self.nodePayloads = np.zeros(numNodes, dtype=np.int32)
+        self.nodeDeficit = np.zeros(numNodes, dtype=np.int32)
+        self.nodeSurplus = np.zeros(numNodes, dtype=np.int32)
+        self.nodeVersion = np.zeros(numNodes, dtype=np.int64)
+        self.totalDeficit = 0
+        self.totalSurplus = 0
+
+
+    def _updateNodeStates(self):
+        ''' Recalculates the deficit and surplus of every node, along with the totals. '''
+
+        np.maximum(self.nodePeople - self.nodePayloads, 0, out=self.nodeDeficit)
+        np.maximum(self.nodePayloads - self.nodePeople, 0, out=self.nodeSurplus)
+        self.nodeVersion += 1
+        self.totalDeficit = int(self.nodeDeficit.sum())
+        self.totalSurplus = int(self.nodeSurplus.sum())
+
+
+    def getState(self):
+        ''' Returns a snapshot of the mutable node state as a dictionary of arrays, which setState() restores.
+            The topology is not part of the snapshot, so it can only be restored onto the same graph. '''
+
+        return {
+            "nodePayloads": self.nodePayloads.copy(),
+            "nodeDeficit": self.nodeDeficit.copy(),
+            "nodeSurplus": self.nodeSurplus.copy(),
+            "nodeVersion": self.nodeVersion.copy(),
+            "totals": np.array([self.totalDeficit, self.totalSurplus], dtype=np.int64)
+        }
+
+
+    def setState(self, state):
+        ''' Restores the node state from a snapshot returned by getState(). '''
+
+        self.nodePayloads[:] = state["nodePayloads"]
+        self.nodeDeficit[:] = state["nodeDeficit"]
+        self.nodeSurplus[:] = state["nodeSurplus"]
+        self.nodeVersion[:] = state["nodeVersion"]
+        self.totalDeficit = int(state["totals"][0])
+        self.totalSurplus = int(state["totals"][1])
+
+
+    def loadFromFile(self, filepath: str, useCache = True): 
+        ''' Loads a graph from a .graph file.
+            If useCache is True, the parsed graph and its shortest path tables are stored in a compiled
+            cache next to the file (`<filepath>.npz`), keyed by the hash of the file contents, and
+            subsequent loads read the cache instead. '''
+
+        with open(filepath, "rb") as file:
+            contents = file.read()
+        cachePath = filepath + ".npz"
+        sourceHash = hashlib.sha1(contents).hexdigest()
+        if useCache and self._loadCache(cachePath, sourceHash):
+            return
+
+        self._edgeSequence = []
+        with io.StringIO(contents.decode()) as file:
             # Read graph information.
             self.graphDimension = int(file.readline())
             self.widthPixels = int(file.readline())
@@ -33,6 +108,7 @@ class SDGraph():
             self.offsetX = float(file.readline())
             self.offsetY = float(file.readline())
             self.totalPayloads = int(file.readline())
+            self._allocateNodeState(self.graphDimension)
 
             # Read node data.
             for _ in range(self.graphDimension): 
@@ -47,19 +123,11 @@ class SDGraph():
                 peeps = p if not dep else 0
                 load = 0 if not dep else p
 
-                self.graph.add_node(i,
-                    pos = (posx, posy),
-                    id = i,
-                    nodeType = NODE_TYPE.OBSERVABLE_NODE,
-                    depot = dep,
-                    people = peeps, 
-                    payloads = load,
-                    surplus = 0,
-                    deficit = 0
-                )
-
-                self.setNodeDeficit(i)
-                self.setNodeSurplus(i)
+                self.graph.add_node(i)
+                self.nodePositions[i] = (posx, posy)
+                self.nodeDepot[i] = dep
+                self.nodePeople[i] = peeps
+                self.nodePayloads[i] = load
                 
                 # Add a self-loop to the node.
                 # self.graph.add_edge(i, i)
@@ -71,19 +139,86 @@ class SDGraph():
                     direction = str(file.readline()) # not useful!
                     cost = int(file.readline()) # we no longer use this cost value, as it does not correspond to the actual euclidean distance.
                     self.graph.add_edge(i, j)
+                    self._edgeSequence.append((i, j))
         
+        self._updateNodeStates()
+
         # Set a weight on each edge which corresponds to the actual euclidean distance.
         for edge in self.graph.edges:
             i = edge[0]
             j = edge[1]
-            self.graph.edges[i, j]["weight"] = self._dist(self.graph.nodes[i]["pos"], self.graph.nodes[j]["pos"])
+            self.graph.edges[i, j]["weight"] = self._dist(self.getNodePosition(i), self.getNodePosition(j))
         
-        # Compute the absolute longest path.
-        self.longestPathLength = 0.0
-        all_pairs = nx.all_pairs_dijkstra_path_length(self.graph, weight="weight")
-        for i in all_pairs:
-            if i[1][j] > self.longestPathLength:
-                self.longestPathLength = i[1][j]
+        # Compute the shortest path tables and the absolute longest path.
+        self._computeShortestPaths()
+        self._computeEdgeArrays()
+        self._buildSpatialIndex()
+
+        if useCache:
+            self._saveCache(cachePath, sourceHash)
+
+
+    def _saveCache(self, cachePath, sourceHash):
+        ''' Writes the parsed graph to the compiled cache. The file is written to a temporary path and
+            then moved into place, so concurrent loaders never see a partial cache.
+            Failing to write the cache (e.g. a read-only directory) is not an error. '''
+
+        header = np.array([self.graphDimension, self.widthPixels, self.heightPixels,
+                           self.resolution, self.offsetX, self.offsetY, self.totalPayloads], dtype=np.float64)
+        arrays = {name: getattr(self, name) for name in GRAPH_CACHE_ARRAYS}
+        tmpPath = f"{cachePath}.{os.getpid()}.tmp"
+        try:
+            with open(tmpPath, "wb") as file:
+                np.savez(file,
+                    version = GRAPH_CACHE_VERSION,
+                    sourceHash = sourceHash,
+                    header = header,
+                    edgeSequence = np.array(self._edgeSequence, dtype=np.int64).reshape(-1, 2),
+                    graphEdgeWeights = np.array([w for _, _, w in self.graph.edges.data("weight")], dtype=np.float64),
+                    longestPathLength = self.longestPathLength,
+                    **arrays
+                )
+            os.replace(tmpPath, cachePath)
+        except OSError:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+
+    def _loadCache(self, cachePath, sourceHash):
+        ''' Loads the graph from the compiled cache. Returns False if there is no cache for this file contents. '''
+
+        try:
+            cache = np.load(cachePath)
+        except (OSError, ValueError):
+            return False
+
+        with cache:
+            if int(cache["version"]) != GRAPH_CACHE_VERSION or str(cache["sourceHash"]) != sourceHash:
+                return False
+            
+            header = cache["header"]
+            self.graphDimension = int(header[0])
+            self.widthPixels = int(header[1])
+            self.heightPixels = int(header[2])
+            self.resolution = float(header[3])
+            self.offsetX = float(header[4])
+            self.offsetY = float(header[5])
+            self.totalPayloads = int(header[6])
+            self._allocateNodeState(self.graphDimension)
+            for name in GRAPH_CACHE_ARRAYS:
+                setattr(self, name, cache[name])
+            self.longestPathLength = float(cache["longestPathLength"])
+
+            # Rebuild the networkx graph in the original insertion order, so neighbor order (and thus actions) is unchanged.
+            self._edgeSequence = [tuple(edge) for edge in cache["edgeSequence"].tolist()]
+            self.graph.add_nodes_from(self.nodeOrder.tolist())
+            self.graph.add_edges_from(self._edgeSequence)
+            for (i, j), weight in zip(self.graph.edges, cache["graphEdgeWeights"].tolist()):
+                self.graph.edges[i, j]["weight"] = weight
+
+        self._updateNodeStates()
+        self._buildSpatialIndex()
+        return True
 
 
     def generateRandomGraph(self, numNodes, radius=35, sizeX=200, sizeY=200, seed=None, payloads=25):
@@ -105,13 +240,15 @@ class SDGraph():
 
         num_depots = len(self.graph.nodes) // 3
 
-        depot_nodes = set(np.random.randint(0, len(self.graph.nodes) - 1, num_depots))
+        # Move the node positions into the state arrays, leaving only topology in the networkx graph.
+        self._allocateNodeState(numNodes)
         for node in self.graph.nodes:
-            self.graph.nodes[node]["nodeType"] = NODE_TYPE.OBSERVABLE_NODE
-            self.graph.nodes[node]["id"] = node
-            self.graph.nodes[node]["depot"] = node in depot_nodes
-            self.graph.nodes[node]["people"] = 0
-            self.graph.nodes[node]["payloads"] = 0
+            self.nodePositions[node] = self.graph.nodes[node]["pos"]
+            self.graph.nodes[node].clear()
+
+        depot_nodes = set(np.random.randint(0, len(self.graph.nodes) - 1, num_depots))
+        for node in depot_nodes:
+            self.nodeDepot[node] = True
             
 
         # add people to nodes
@@ -120,13 +257,13 @@ class SDGraph():
             for node in self.graph.nodes:
                 if people_left == 0:
                     break
-                elif self.graph.nodes[node]["depot"]: # don't add people to depot node
+                elif self.nodeDepot[node]: # don't add people to depot node
                     continue
 
                 people = float("inf")
                 while people > people_left:
                     people = random.randint(0, 3) # add maximum 3 people at a time to a given node
-                self.graph.nodes[node]["people"] += people
+                self.nodePeople[node] += people
                 people_left -= people
 
         # add payloads to depot nodes
@@ -138,30 +275,117 @@ class SDGraph():
                 payloads = float("inf")
                 while payloads > payloads_left:
                     payloads = random.randint(0, 5) # add maximum 5 payloads at a time to a given depot node
-                self.graph.nodes[node]["payloads"] += payloads
+                self.nodePayloads[node] += payloads
                 payloads_left -= payloads
                 
 
 
 
         # calculate deficit and surplus for each node
-        for node in self.graph.nodes:
-            self.setNodeDeficit(node)
-            self.setNodeSurplus(node)
+        self._updateNodeStates()
 
             
         for edge in self.graph.edges:
-            self.graph.edges[edge]["weight"] = self._dist(self.graph.nodes[edge[0]]["pos"], self.graph.nodes[edge[1]]["pos"])
-        self.longestPathLength = 0.0
-        all_pairs = nx.all_pairs_dijkstra_path_length(self.graph, weight="weight")
-        for i in all_pairs:
-            for j in i[1]:
-                if i[1][j] > self.longestPathLength:
-                    self.longestPathLength = i[1][j]
+            self.graph.edges[edge]["weight"] = self._dist(self.getNodePosition(edge[0]), self.getNodePosition(edge[1]))
+        self._computeShortestPaths()
+        self._computeEdgeArrays()
+        self._buildSpatialIndex()
         
         print(f"Finished generating random graph with {numNodes} nodes and degree {self.graph.degree()}.")
 
 
+    def _computeShortestPaths(self):
+        ''' Computes the all-pairs shortest path tables for the current topology.
+            `shortestPathLengths[i, j]` holds the length of the shortest path from node i to node j,
+            and `shortestPathNextHop[i, j]` holds the node which follows i on that path.
+            This must be called whenever the topology or edge weights change. '''
+
+        numNodes = self.graph.number_of_nodes()
+        self.shortestPathLengths = np.full((numNodes, numNodes), np.inf, dtype=np.float64)
+        self.shortestPathNextHop = np.full((numNodes, numNodes), -1, dtype=np.int64)
+        for src, (lengths, paths) in nx.all_pairs_dijkstra(self.graph, weight="weight"):
+            for dst, path in paths.items():
+                self.shortestPathLengths[src, dst] = lengths[dst]
+                self.shortestPathNextHop[src, dst] = path[1] if len(path) > 1 else src
+
+        self.longestPathLength = float(np.max(self.shortestPathLengths[np.isfinite(self.shortestPathLengths)]))
+
+
+    def _computeEdgeArrays(self):
+        ''' Caches the topology as flat arrays, in the same order that networkx iterates it.
+            Nodes are referred to by their position in `nodeOrder`, and every undirected edge is stored
+            once per direction, grouped by source node. The edges of the node at position i are
+            `edgeOffsets[i]:edgeOffsets[i + 1]`, and `edgeNeighborIndex` holds the index of the target
+            within the source's neighbor list.
+            This must be called whenever the topology or edge weights change. '''
+
+        self.nodeOrder = np.array(list(self.graph.nodes), dtype=np.int64)
+        self.nodeOrderIndex = np.empty(len(self.nodeOrder), dtype=np.int64)
+        self.nodeOrderIndex[self.nodeOrder] = np.arange(len(self.nodeOrder))
+
+        self.nodeDegree = np.array([len(self.graph.adj[node]) for node in self.nodeOrder], dtype=np.int64)
+        self.edgeOffsets = np.zeros(len(self.nodeOrder) + 1, dtype=np.int64)
+        np.cumsum(self.nodeDegree, out=self.edgeOffsets[1:])
+
+        src, dst, weights, neighborIndex = [], [], [], []
+        for node, neighbors in self.graph.adjacency():
+            for idx, (neighbor, data) in enumerate(neighbors.items()):
+                src.append(self.nodeOrderIndex[node])
+                dst.append(self.nodeOrderIndex[neighbor])
+                weights.append(data["weight"])
+                neighborIndex.append(idx)
+        self.edgeIndex = np.array([src, dst], dtype=np.int64).reshape(2, -1)
+        self.edgeWeights = np.array(weights, dtype=np.float64)
+        self.edgeNeighborIndex = np.array(neighborIndex, dtype=np.int64)
+
+
+    def _buildSpatialIndex(self):
+        ''' Builds a KD-tree over the node positions, used for radius and nearest-node queries.
+            This must be called whenever node positions change. '''
+
+        self.nodeTree = cKDTree(self.nodePositions)
+
+
+    def _nodeDistances(self, nodes, pos):
+        ''' Returns the exact Euclidean distances from `pos` to the given nodes, computed the same way as `_dist`. '''
+
+        positions = self.nodePositions[nodes]
+        return np.sqrt(np.power(positions[:, 0] - pos[0], 2) + np.power(positions[:, 1] - pos[1], 2))
+
+
+    def getNodesInRadius(self, pos, radius):
+        ''' Returns a boolean mask (indexed by node) of the nodes within `radius` of `pos`. '''
+
+        mask = np.zeros(len(self.nodePositions), dtype=bool)
+        if radius == np.inf:
+            mask[:] = True
+            return mask
+
+        # Query the tree with a slightly larger radius, then apply the exact distance test to the candidates.
+        candidates = np.array(self.nodeTree.query_ball_point(pos, radius * (1.0 + 1e-9) + 1e-9), dtype=np.int64)
+        if len(candidates) > 0:
+            mask[candidates[self._nodeDistances(candidates, pos) <= radius]] = True
+        return mask
+
+
+    def getShortestPath(self, src, dst):
+        ''' Returns the shortest path from `src` to `dst` as a list of nodes, including both endpoints. '''
+
+        if self.shortestPathNextHop[src, dst] < 0:
+            raise nx.NetworkXNoPath(f"No path between {src} and {dst}.")
+
+        path = [src]
+        while path[-1] != dst:
+            path.append(int(self.shortestPathNextHop[path[-1], dst]))
+        return path
+
+
+    def getShortestPathLength(self, src, dst):
+        ''' Returns the length of the shortest path from `src` to `dst`. '''
+
+        return self.shortestPathLengths[src, dst]
+
+
     def reset(self, seed=None, randomizeIds=False, regenerateGraph=False):
         ''' Resets the graph to initial state.
             If regenerateGraph is True, a new random graph is generated. '''
@@ -173,13 +397,20 @@ class SDGraph():
             # Get random node IDs.
             availableIds = random.sample(range(1000), self.graphDimension)
             for node in self.graph.nodes:
-                self.graph.nodes[node]["id"] = availableIds.pop()
+                self.nodeIds[node] = availableIds.pop()
 
         # Reset payloads
-        for node in self.graph.nodes:
-            self.graph.nodes[node]["payloads"] = 0
+        self.distributePayloads(self.nodePayloads)
+        self._updateNodeStates()
+
+
+    def distributePayloads(self, nodePayloads):
+        ''' Randomly distributes the total payloads across the depot nodes, writing them into the
+            `nodePayloads` array (indexed by node). '''
 
-        depot_nodes = [node for node in self.graph.nodes if self.graph.nodes[node]["depot"]]
+        nodePayloads[:] = 0
+
+        depot_nodes = [node for node in self.graph.nodes if self.nodeDepot[node]]
         payloads_left = self.totalPayloads
         while payloads_left > 0:
             for node in depot_nodes:
@@ -188,18 +419,36 @@ class SDGraph():
                 payloads = float("inf")
                 while payloads > payloads_left:
                     payloads = random.randint(0, 5) # add maximum 5 payloads at a time to a given depot node
-                self.graph.nodes[node]["payloads"] += payloads
+                nodePayloads[node] += payloads
                 payloads_left -= payloads
 
-        for node in self.graph.nodes:
-            self.setNodeDeficit(node)
-            self.setNodeSurplus(node)
-
 
     def getNodePosition(self, node):
         ''' Returns the node position as a tuple (x, y). '''
 
-        return self.graph.nodes[node]["pos"]
+        pos = self.nodePositions[node]
+        return (float(pos[0]), float(pos[1]))
+
+
+    def getNodeId(self, node):
+        ''' Returns the (possibly randomized) ID of a node. '''
+
+        return int(self.nodeIds[node])
+
+
+    def getNodeAttributes(self, node):
+        ''' Returns a dictionary of all state for a node, in the same form as the former networkx node attributes. '''
+
+        return {
+            "pos": self.getNodePosition(node),
+            "id": self.getNodeId(node),
+            "nodeType": NODE_TYPE.OBSERVABLE_NODE,
+            "depot": self.isDepot(node),
+            "people": self.getNodePeople(node),
+            "payloads": self.getNodePayloads(node),
+            "surplus": self.getNodeSurplus(node),
+            "deficit": self.getNodeDeficit(node)
+        }
 
 
     def getAverageIdlenessTime(self, currentTime):
@@ -229,13 +478,14 @@ class SDGraph():
     def getNodePayloads(self, node):
         ''' Returns the number of payloads delivered to a node'''
 
-        return self.graph.nodes[node]["payloads"]
+        return int(self.nodePayloads[node])
     
 
     def putPayloads(self, node, num):
         ''' Adds `num` payloads to `node`'''
 
-        self.graph.nodes[node]["payloads"] += num
+        self.nodePayloads[node] += num
+        self.nodeVersion[node] += 1
         self.setNodeDeficit(node)
         self.setNodeSurplus(node)
 
@@ -243,10 +493,11 @@ class SDGraph():
     def takePayloads(self, node, num):
         ''' Removes `num` payloads from `node`'''
 
-        self.graph.nodes[node]["payloads"] -= num
-        if self.graph.nodes[node]["payloads"] < 0:
+        self.nodePayloads[node] -= num
+        if self.nodePayloads[node] < 0:
             raise ValueError("Attempting to take from a node with 0 payloads")
         
+        self.nodeVersion[node] += 1
         self.setNodeDeficit(node)
         self.setNodeSurplus(node)
 
@@ -254,36 +505,33 @@ class SDGraph():
     def isDepot(self, node):
         ''' Returns if a given node is the depot node'''
         
-        return self.graph.nodes[node]["depot"]
+        return bool(self.nodeDepot[node])
     
 
     def getNodePeople(self, node):
         ''' Returns the number of people at a node'''
 
-        return self.graph.nodes[node]["people"]
+        return int(self.nodePeople[node])
     
 
     def setNodeDeficit(self, node):
-        ''' Calculates the node's deficit. '''
+        ''' Calculates the node's deficit and updates the total deficit. '''
         
-        self.graph.nodes[node]["deficit"] =  max(self.getNodePeople(node) - self.getNodePayloads(node), 0)
+        deficit = max(self.getNodePeople(node) - self.getNodePayloads(node), 0)
+        self.totalDeficit += deficit - int(self.nodeDeficit[node])
+        self.nodeDeficit[node] = deficit
     
 
     def getNodeDeficit(self, node):
         ''' Returns the deficit of a node. '''
 
-        return self.graph.nodes[node]["deficit"]
+        return int(self.nodeDeficit[node])
     
 
     def getTotalDeficit(self):
         ''' Returns the deficit of all nodes. '''
-        deficit = nx.get_node_attributes(self.graph, "deficit")
-        t = nx.get_node_attributes(self.graph, "nodeType")
-        for node, nodeType in t.items():
-            if nodeType == NODE_TYPE.AGENT:
-                deficit[node] = 0
 
-        return sum(deficit.values())
+        return self.totalDeficit
     
 
     def getAverageDeficit(self):
@@ -293,26 +541,23 @@ class SDGraph():
     
 
     def setNodeSurplus(self, node):
-        ''' Calculates and the node's surplus. '''
+        ''' Calculates the node's surplus and updates the total surplus. '''
         
-        self.graph.nodes[node]["surplus"] =  max(self.getNodePayloads(node) - self.getNodePeople(node), 0)
+        surplus = max(self.getNodePayloads(node) - self.getNodePeople(node), 0)
+        self.totalSurplus += surplus - int(self.nodeSurplus[node])
+        self.nodeSurplus[node] = surplus
     
 
     def getNodeSurplus(self, node):
         ''' Returns the surplus of a node. '''
 
-        return self.graph.nodes[node]["surplus"]
+        return int(self.nodeSurplus[node])
     
 
     def getTotalSurplus(self):
         ''' Returns the surplus of all nodes. '''
-        surplus = nx.get_node_attributes(self.graph, "surplus")
-        t = nx.get_node_attributes(self.graph, "nodeType")
-        for node, nodeType in t.items():
-            if nodeType == NODE_TYPE.AGENT:
-                surplus[node] = 0
         
-        return sum(surplus.values())
+        return self.totalSurplus
     
 
     def getAverageSurplus(self):
@@ -331,14 +576,12 @@ class SDGraph():
         ''' Returns the nearest node to the given position.
             If epsilon is not None and no node is within epsilon, returns None. '''
         
-        # Find the nearest node.
-        bestDist = math.sqrt(math.pow(self.graph.nodes[0]["pos"][0] - pos[0], 2) + math.pow(self.graph.nodes[0]["pos"][1] - pos[1], 2))
-        bestNode = 0
-        for i in range(len(self.graph.nodes)):
-            dist = math.sqrt(math.pow(self.graph.nodes[i]["pos"][0] - pos[0], 2) + math.pow(self.graph.nodes[i]["pos"][1] - pos[1], 2))
-            if dist < bestDist:
-                bestDist = dist
-                bestNode = i
+        # Find the nearest node. Ties go to the lowest node, so gather every node at (about) the nearest distance.
+        nearestDist, _ = self.nodeTree.query(pos)
+        candidates = np.array(self.nodeTree.query_ball_point(pos, nearestDist * (1.0 + 1e-9) + 1e-9), dtype=np.int64)
+        dists = self._nodeDistances(candidates, pos)
+        bestDist = float(dists.min())
+        bestNode = int(candidates[dists == bestDist].min())
 
         # Check if the nearest node is within epsilon.
         if epsilon is not None and bestDist > epsilon:
@@ -348,8 +591,7 @@ class SDGraph():
 
 
     def getOriginsFromInitialPoses(self, initialPoses):
-        ''' Given (x,y) initial positions, returns the nearest node for each position.
-            This is a horrible n^2 algorithm but that's fine for now. '''
+        ''' Given (x,y) initial positions, returns the nearest node for each position. '''
 
         origins = []
         for pos in zip(initialPoses[0::2], initialPoses[1::2]):
@@ -367,7 +609,10 @@ class SDGraph():
         ''' Returns a torch_geometric (PyG) graph object. '''
 
         from torch_geometric.utils.convert import from_networkx
-        return from_networkx(self.graph, group_node_attrs=["pos", "people", "payloads"], group_edge_attrs=["weight"])
+        g = self.graph.copy()
+        for node in g.nodes:
+            g.nodes[node].update(self.getNodeAttributes(node))
+        return from_networkx(g, group_node_attrs=["pos", "people", "payloads"], group_edge_attrs=["weight"])
 
 
     def exportToFile(self, filename): 
@@ -389,13 +634,13 @@ class SDGraph():
                 
                 # Write the node.
                 file.write(f"{i}\n")
-                file.write(f"{int((self.graph.nodes[i]['pos'][0] - self.offsetX) / self.resolution)}\n")
-                file.write(f"{int((self.graph.nodes[i]['pos'][1] - self.offsetY) / self.resolution)}\n")
-                file.write(f"{int(self.graph.nodes[i]['depot'])}\n")
-                if self.graph.nodes[i]['depot']:
-                    file.write(f"{int(self.graph.nodes[i]['payloads'])}\n")
+                file.write(f"{int((self.getNodePosition(i)[0] - self.offsetX) / self.resolution)}\n")
+                file.write(f"{int((self.getNodePosition(i)[1] - self.offsetY) / self.resolution)}\n")
+                file.write(f"{int(self.isDepot(i))}\n")
+                if self.isDepot(i):
+                    file.write(f"{self.getNodePayloads(i)}\n")
                 else:
-                    file.write(f"{int(self.graph.nodes[i]['people'])}\n")
+                    file.write(f"{self.getNodePeople(i)}\n")
                 
                 # Write edges.
                 numEdges = self.graph.degree[i]
@@ -5,13 +5,9 @@ from gymnasium import spaces
 import random
 import numpy as np
 import math
-from copy import deepcopy
-from matplotlib import pyplot as plt
 import networkx as nx
 from copy import copy
 from enum import IntEnum
-from torch_geometric.utils.convert import from_networkx
-from torch_geometric.data import Data
 
 class ACTION(IntEnum):
     LOAD = 0
@@ -31,6 +27,7 @@ class SDAgent():
         self.max_nodes = max_nodes
         self.max_capacity = max_capacity
         self.num_agents = num_agents
+        self.stateBelief = np.empty((max_nodes, 2), dtype=np.float32)
         self.reset()
     
     
@@ -41,7 +38,7 @@ class SDAgent():
         self.currentAction = -1.0
         self.lastNode = self.startingNode
         self.lastNodeVisited = None
-        self.stateBelief = {i: np.array([-1.0, -1.0]) for i in range(self.max_nodes)}
+        self.stateBelief.fill(-1.0)
         self.agentBelief = {a: np.array([-1.0, -1.0, -1.0, -1.0, -1.0]) for a in range(self.num_agents)}
         self.payloads = 0
 
@@ -68,6 +65,9 @@ class parallel_env(ParallelEnv):
         "name": "sdzoo_environment_v0",
     }
 
+    # Global observation methods whose state_all() entries only differ between agents in the ego state (see _populateEgoState).
+    SHARED_STATE_METHODS = ["adjacency"]
+
     def __init__(self, sd_graph, num_agents,
                  comms_model = CommunicationModel(model = "none"),
                  require_explicit_visit = True,
@@ -157,6 +157,12 @@ class parallel_env(ParallelEnv):
             ) for i in range(num_agents)
         ]
 
+        # Node state beliefs of all agents. Each agent's stateBelief is a view into its row.
+        self.stateBeliefs = np.full((num_agents, self.max_nodes, 2), -1.0, dtype=np.float32)
+        self.beliefVersions = np.full((num_agents, self.max_nodes), -1, dtype=np.int64)
+        for agent in self.possible_agents:
+            agent.stateBelief = self.stateBeliefs[agent.id]
+
         # Create the action space.
         action_space = self._buildActionSpace(self.action_method)
         self.action_spaces = spaces.Dict({agent: action_space for agent in self.possible_agents}) # type: ignore
@@ -170,6 +176,7 @@ class parallel_env(ParallelEnv):
         self.observation_spaces = spaces.Dict({agent: obs_space for agent in self.possible_agents}) # type: ignore
 
         self.reset_count = 0
+        self.adjacencyMatrix = None
         self.reset()
 
 
@@ -347,6 +354,10 @@ class parallel_env(ParallelEnv):
         randomizeIds = regenerateGraph
         self.sdg.reset(seed, randomizeIds=randomizeIds, regenerateGraph=regenerateGraph)
 
+        # Cache the normalized adjacency matrix, which only changes when the graph is regenerated.
+        if regenerateGraph or self.adjacencyMatrix is None:
+            self.adjacencyMatrix = self._buildAdjacencyMatrix()
+
         # Reset the information about idleness over time.
         self.avgIdlenessTimes = []
 
@@ -361,6 +372,12 @@ class parallel_env(ParallelEnv):
             agent.startingPosition = startingPositions[agent.id]
             agent.startingNode = self.agentOrigins[agent.id]
             agent.reset()
+
+        # Reset the beliefs bookkeeping and the cached visibility and distances of the agents.
+        self.beliefVersions.fill(-1)
+        self.visibleNodes = {}
+        self.agentDistancesKey = None
+        self.deferredSurroundings = {}
         
         # Reset other state.
         self.step_count = 0
@@ -370,7 +387,7 @@ class parallel_env(ParallelEnv):
         self.available_actions = {agent: self._getAvailableActions(agent) for agent in self.agents}
 
         # Return the initial observation.
-        observation = {agent: self.observe(agent) for agent in self.agents}
+        observation = {agent: self.observe(agent) for agent in self.agents} if self.observe_method != "none" else {}
         info = {
             agent: {
                 "ready": True
@@ -380,6 +397,72 @@ class parallel_env(ParallelEnv):
         return observation, info
 
 
+    def get_state(self):
+        ''' Returns a snapshot of all mutable environment state, which set_state() restores.
+            This allows branching the environment, e.g. for lookahead planning, without copying the graph.
+            The snapshot is a dictionary of arrays, indexed by agent ID and node, along with the states of the random number generators.
+            The topology is not part of the snapshot, so it can only be restored onto the same environment and graph. '''
+
+        agents = self.possible_agents
+        return {
+            "graph": self.sdg.getState(),
+            "agentPositions": np.array([a.position for a in agents], dtype=np.float64),
+            "agentSpeeds": np.array([a.speed for a in agents], dtype=np.float64),
+            "agentEdges": np.array([a.edge if a.edge != None else (-1, -1) for a in agents], dtype=np.int64),
+            "agentCurrentActions": np.array([a.currentAction for a in agents], dtype=np.int64),
+            "agentLastNodes": np.array([a.lastNode for a in agents], dtype=np.int64),
+            "agentLastNodesVisited": np.array([a.lastNodeVisited if a.lastNodeVisited != None else -1 for a in agents], dtype=np.int64),
+            "agentPayloads": np.array([a.payloads for a in agents], dtype=np.int64),
+            "agentCommsStates": np.array([a.currentState for a in agents], dtype=np.int64),
+            "agentBeliefs": np.array([[a.agentBelief[b.id] for b in agents] for a in agents], dtype=np.float64),
+            "alive": np.array([a in self.agents for a in agents], dtype=bool),
+            "dones": np.array([self.dones[a] for a in agents], dtype=bool),
+            "stateBeliefs": self.stateBeliefs.copy(),
+            "beliefVersions": self.beliefVersions.copy(),
+            "nodeVisits": self.nodeVisits.copy(),
+            "availableActions": np.array([self.available_actions[a] for a in agents]),
+            "counters": np.array([self.step_count, self.total_reward], dtype=np.float64),
+            "random": random.getstate(),
+            "npRandom": np.random.get_state()
+        }
+
+
+    def set_state(self, state, restoreRng=True):
+        ''' Restores the environment from a snapshot returned by get_state(). The snapshot is not modified, so it can be restored repeatedly.
+            If restoreRng is False, the random number generators are left as they are, so that restored branches sample different outcomes. '''
+
+        self.sdg.setState(state["graph"])
+        self.stateBeliefs[:] = state["stateBeliefs"]
+        self.beliefVersions[:] = state["beliefVersions"]
+        self.nodeVisits[:] = state["nodeVisits"]
+
+        agentBeliefs = state["agentBeliefs"].copy()
+        for agent in self.possible_agents:
+            i = agent.id
+            agent.position = (float(state["agentPositions"][i, 0]), float(state["agentPositions"][i, 1]))
+            agent.speed = float(state["agentSpeeds"][i])
+            agent.edge = tuple(int(n) for n in state["agentEdges"][i]) if state["agentEdges"][i, 0] >= 0 else None
+            agent.currentAction = int(state["agentCurrentActions"][i]) if state["agentCurrentActions"][i] >= 0 else -1.0
+            agent.lastNode = int(state["agentLastNodes"][i])
+            agent.lastNodeVisited = int(state["agentLastNodesVisited"][i]) if state["agentLastNodesVisited"][i] >= 0 else None
+            agent.payloads = int(state["agentPayloads"][i])
+            agent.currentState = int(state["agentCommsStates"][i])
+            agent.agentBelief = {b.id: agentBeliefs[i, b.id] for b in self.possible_agents}
+
+        self.agents = [a for a in self.possible_agents if state["alive"][a.id]]
+        self.dones = {a: bool(state["dones"][a.id]) for a in self.possible_agents}
+        self.available_actions = {a: state["availableActions"][a.id].copy() for a in self.possible_agents}
+        self.step_count = int(state["counters"][0])
+        self.total_reward = float(state["counters"][1])
+
+        # Surroundings observed before the restore no longer apply.
+        self.deferredSurroundings = {}
+
+        if restoreRng:
+            random.setstate(state["random"])
+            np.random.set_state(state["npRandom"])
+
+
     def render(self, figsize=(12, 9)):
         ''' Renders the environment.
             
@@ -389,13 +472,15 @@ class parallel_env(ParallelEnv):
             Returns:
                 None
         '''
+        from matplotlib import pyplot as plt
+
         fig, ax = plt.subplots(figsize=figsize)
         markers = ['p']
         markers_done = ['X']
         colors = ['red', 'blue', 'green', 'cyan', 'magenta', 'yellow', 'black']
 
         # Draw the graph.
-        pos = nx.get_node_attributes(self.sdg.graph, 'pos')
+        pos = {n: self.sdg.getNodePosition(n) for n in self.sdg.graph.nodes}
         state = [self.sdg.getNodeDeficit(i) for i in self.sdg.graph.nodes]
         labels = {n: f"{n}\n{self.sdg.getNodePeople(n)},{self.sdg.getNodePayloads(n)}" for n in self.sdg.graph.nodes}
         nx.draw_networkx(self.sdg.graph,
@@ -453,15 +538,59 @@ class parallel_env(ParallelEnv):
         return state
 
 
+    def state_all_shared(self):
+        ''' Equivalent to state_all(), for global observation methods in SHARED_STATE_METHODS.
+            The part of the state which is identical for all agents is populated only once and returned as `shared`,
+            while `ego[agent]` holds the entries which differ between agents.
+            Beliefs and communication are still updated for every agent, exactly as in state_all(). '''
+
+        if self.observe_method_global not in self.SHARED_STATE_METHODS:
+            raise ValueError(f"Observation method {self.observe_method_global} does not support a shared global state")
+
+        shared = None
+        ego = {}
+        for agent in self.possible_agents:
+            agents, vertices = self._observeSurroundings(agent, np.inf, allow_done_agents=True)
+            if shared is None:
+                shared = self._buildObservation(self.observe_method_global, agent, agents, vertices)
+            ego[agent] = self._populateEgoState(self.observe_method_global, agent)
+        return shared, ego
+
+
     def observe(self, agent, radius=None, allow_done_agents=False):
         ''' Returns the observation for the given agent.'''
 
         return self._populateStateSpace(self.observe_method, agent, radius, allow_done_agents)
 
 
+    def observeDeferred(self):
+        ''' Returns the observations of all agents as of the last step(..., observe=False).
+            That step already observed the surroundings of each agent, so only the observations themselves are built. '''
+
+        if self.observe_method == "none":
+            return {}
+        return {agent: self._buildObservation(self.observe_method, agent, *self.deferredSurroundings[agent]) for agent in self.possible_agents}
+
+
+    def observeState(self):
+        ''' Updates the beliefs of all agents exactly as state_all() does, without building the state.
+            This is useful for steps whose global state is not needed. '''
+
+        for agent in self.possible_agents:
+            self._observeSurroundings(agent, np.inf, allow_done_agents=True)
+
+
     def _populateStateSpace(self, observe_method, agent, radius, allow_done_agents):
         ''' Returns a populated state/observation space.'''
 
+        agents, vertices = self._observeSurroundings(agent, radius, allow_done_agents)
+        return self._buildObservation(observe_method, agent, agents, vertices)
+
+
+    def _observeSurroundings(self, agent, radius, allow_done_agents):
+        ''' Determines the agents and vertices visible to the agent, directly or through communication,
+            and updates the agent's beliefs accordingly. Returns the sorted lists of agents and vertices. '''
+
         if radius == None:
             radius = agent.observationRadius
 
@@ -470,13 +599,13 @@ class parallel_env(ParallelEnv):
         else:
             agentList = self.agents
 
-        # Calculate the list of visible agents and vertices.
-        vertices = [v for v in self.sdg.graph.nodes if self._dist(self.sdg.getNodePosition(v), agent.position) <= radius]
-        agents = [a for a in agentList if self._dist(a.position, agent.position) <= radius]
+        # Calculate the visible agents and vertices.
+        visible = self._getVisibleNodes(agent, radius)
+        agentDistances = self._getAgentDistances()
+        agents = [a for a in agentList if agentDistances[agent.id, a.id] <= radius]
 
         # Update beliefs for nodes which we can see.
-        for v in vertices:
-            agent.stateBelief[v] = np.array([self.sdg.getNodeDeficit(v), self.sdg.getNodeSurplus(v)])
+        self._refreshBeliefs(agent, visible)
 
         # Add own agents belief
         agent.agentBelief[agent.id] = np.array([agent.id, agent.lastNode, agent.currentAction, agent.payloads, agent.max_capacity])
@@ -486,23 +615,38 @@ class parallel_env(ParallelEnv):
             if a != agent and self.comms_model.canReceive(a, agent):
                 if a not in agents:
                     agents.append(a)
-                for v in self.sdg.graph.nodes:
-                    if self._dist(self.sdg.getNodePosition(v), a.position) <= radius:
-                        if v not in vertices:
-                            vertices.append(v)
-                        # Update state belief for communicates nodes.
-                        agent.stateBelief[v] = np.array([self.sdg.getNodeDeficit(v), self.sdg.getNodeSurplus(v)]) # TODO: add state belief to observation similar
+                # Update state belief for communicated nodes.
+                communicated = self._getVisibleNodes(a, radius)
+                visible = visible | communicated
+                self._refreshBeliefs(agent, communicated) # TODO: add state belief to observation similar
                 
                 agent.agentBelief[a.id] = np.array([a.id, a.lastNode, a.currentAction, a.payloads, a.max_capacity])
         
         agents = sorted(agents, key=lambda a: a.id)
-        vertices = sorted(vertices)
-        
-        obs = {}
+        vertices = np.flatnonzero(visible).tolist()
+        return agents, vertices
+
+
+    def _populateEgoState(self, observe_method, agent):
+        ''' Returns the entries of the observation which identify the observing agent itself. '''
+
+        ego = {}
 
         # Add agent ID.
         if observe_method in ["adjacency"]:
-            obs["agent_id"] = agent.id
+            ego["agent_id"] = agent.id
+
+        return ego
+
+
+    def _buildObservation(self, observe_method, agent, agents, vertices):
+        ''' Builds the observation of the agent given the visible agents and vertices. '''
+        
+        # The "none" observation method has no observation, e.g. for heuristics which read the environment directly.
+        if observe_method == "none":
+            return None
+
+        obs = self._populateEgoState(observe_method, agent)
 
         # Add people and payloads at each vertex.
         if observe_method in ["adjacency"]:
@@ -514,15 +658,7 @@ class parallel_env(ParallelEnv):
 
         # Add weighted adjacency matrix (normalized).
         if observe_method in ["adjacency"]:
-            # Create adjacency matrix.
-            adjacency = -1.0 * np.ones((self.sdg.graph.number_of_nodes(), self.sdg.graph.number_of_nodes()), dtype=np.float32)
-            for edge in self.sdg.graph.edges:
-                maxWeight = max([self.sdg.graph.edges[e]["weight"] for e in self.sdg.graph.edges])
-                minWeight = min([self.sdg.graph.edges[e]["weight"] for e in self.sdg.graph.edges])
-                weight = self._minMaxNormalize(self.sdg.graph.edges[edge]["weight"], minimum=minWeight, maximum=maxWeight)
-                adjacency[edge[0], edge[1]] = weight
-                adjacency[edge[1], edge[0]] = weight
-            obs["adjacency"] = adjacency
+            obs["adjacency"] = self.adjacencyMatrix
         
         if observe_method in ["pyg"]:
             if agent.edge == None:
@@ -560,173 +696,19 @@ class parallel_env(ParallelEnv):
             obs["agent_graph_position"] = graphPos
 
         if observe_method in ["pyg"]:
-            # Copy pg map to g
-            g = deepcopy(self.sdg.graph)
-
-            # Set attributes of patrol graph nodes based on agent's beliefs.
-            deficit_beliefs = [agent.stateBelief[i][0] for i in range(self.sdg.graph.number_of_nodes())]
-            surplus_beliefs = [agent.stateBelief[i][1] for i in range(self.sdg.graph.number_of_nodes())]
-
-            # Set attributes of patrol graph nodes.
-            for node in g.nodes:
-                # Add dummy lastNode, currentAction, and max_capacity values as attributes in g for all nodes.
-                g.nodes[node]["lastNode"] = -1.0
-                g.nodes[node]["currentAction"] = -1.0
-                g.nodes[node]["max_capacity"] = -1.0
-
-                # Set the deficit and surplus values for each node the agent knows about.
-                g.nodes[node]["deficit"] = deficit_beliefs[node]
-                g.nodes[node]["surplus"] = surplus_beliefs[node]
-
-
-                # Set appropriate visibility for each node  
-                if node in vertices:
-                    # Node is visible.
-                    g.nodes[node]["nodeType"] = NODE_TYPE.OBSERVABLE_NODE
-                else:
-                    # Node is not visible.
-                    g.nodes[node]["nodeType"] = NODE_TYPE.UNOBSERVABLE_NODE
-
-            # Ensure that we add a node for the current agent, even if it's dead.
-            agentsPlusEgo = agents + [agent] if agent not in agents else agents
-
-            # count the number of nearby agents
-            nearby_agents = 0
-
-            # Traverse through all visible agents and add their positions as new nodes to g
-            for a in agentsPlusEgo:
-                # To avoid node ID conflicts, generate a unique node ID
-                agent_node_id = f"agent_{a.id}_pos"
-                g.add_node(
-                    agent_node_id,
-                    pos = a.position,
-                    id = -1 - a.id,
-                    nodeType = NODE_TYPE.AGENT,
-                    people = -1.0,
-                    payloads = a.payloads,
-                    max_capacity = a.max_capacity,
-                    depot = False, # for consistency in the gnn
-                    surplus = a.payloads,
-                    deficit = -1.0,
-                    lastNode = g.nodes[a.lastNode]["id"] if a.lastNode in g.nodes else -1.0,
-                    currentAction = a.currentAction if a in agents else -1.0
-                )
-
-                # Check if the agent has an edge that it is currently on
-                if a.edge is None:
-                    # If the agent is not on an edge, add an edge from the agent's node to the node it is currently on
-                    g.add_edge(agent_node_id, a.lastNode, weight=0.0)
-
-                    # If the agent is not the ego agent and is sharing the node with the ego agent, increase the nearby_agents count
-                    if a != agent and a.lastNode == agent.lastNode and agent.edge is None:
-                        nearby_agents += 1
-
-                    # Add all of a.lastNode's neighbors as edges to the agent's node.
-                    for neighbor in g.neighbors(a.lastNode):
-                        if g.nodes[neighbor]["nodeType"] != NODE_TYPE.AGENT:
-                            g.add_edge(agent_node_id, neighbor, weight=g.edges[(a.lastNode, neighbor)]["weight"])
-                else:
-                    node1_id, node2_id = a.edge
-
-                    # Calculate weights or set them on a case-by-case basis
-                    weight_to_node1 = self._calculateEdgeWeight(a.position, g.nodes[node1_id]['pos'])
-                    weight_to_node2 = self._calculateEdgeWeight(a.position, g.nodes[node2_id]['pos'])
-
-                    g.add_edge(agent_node_id, node1_id, weight=weight_to_node1)
-                    g.add_edge(agent_node_id, node2_id, weight=weight_to_node2)
-            
-            # for a in self.possible_agents:
-            #     obs[f"agent_{a.id}_id"] = agent.agentBelief[a.id][0]
-            #     obs[f"agent_{a.id}_lastNode"] = agent.agentBelief[a.id][1]
-            #     obs[f"agent_{a.id}_currentAction"] = agent.agentBelief[a.id][2]
-            #     obs[f"agent_{a.id}_payloads"] = agent.agentBelief[a.id][3]
-            #     obs[f"agent_{a.id}_max_capacity"] = agent.agentBelief[a.id][4]
-                
-
-            # Normalize the edge weights of g.
-            weights = nx.get_edge_attributes(g, 'weight')
-            maxWeight = max(weights.values())
-            minWeight = min(weights.values())
-            for edge in g.edges:
-                g.edges[edge]["weight"] = self._minMaxNormalize(weights[edge], minimum=minWeight, maximum=maxWeight)
-            
-            # Turn g into a digraph, dg
-            dg = nx.DiGraph(g)
-
-            if self.action_method == "neighbors":
-                for i in dg.nodes:
-                    # Add degree to the node features.
-                    dg.nodes[i]["degree"] = dg.out_degree(i)
-
-                    # Add neighbor indices to the edges.
-                    idx = 0
-                    for j in dg.neighbors(i):
-                        if dg.nodes[j]["nodeType"] == NODE_TYPE.AGENT:
-                            dg.edges[(i, j)]["neighborIndex"] = -1
-                        else:
-                            dg.edges[(i, j)]["neighborIndex"] = idx
-                            idx += 1
-
-            # Trim the graph to only include the nodes and edges that are visible to the agent.
-            # subgraphNodes = vertices + [f"agent_{a.id}_pos" for a in agents]
-            # subgraph = nx.subgraph(g, subgraphNodes)
-            subgraph = dg
-            subgraphNodes = list(g.nodes)
-
-            if self.action_method == "neighbors":
-                edge_attrs = ["weight", "neighborIndex"]
-                node_attrs = ["id", "nodeType", "degree", "surplus", "deficit", "max_capacity", "lastNode", "currentAction"]
-                # node_attrs = ["id", "nodeType", "idlenessTime", "lastNode", "currentAction"]
-            else:
-                edge_attrs = ["weight"]
-                node_attrs = ["id", "nodeType", "lastNode", "currentAction", "surplus", "deficit", "max_capacity"]
-
-            # Convert g to PyG
-            data = from_networkx(
-                subgraph,
-                group_node_attrs=node_attrs,
-                group_edge_attrs=edge_attrs
-            )
-            data.x = data.x.float()
-            data.edge_attr = data.edge_attr.float()
-
-            # Calculate the agent_mask based on the graph node ID assigned to this agent.
-            if agent.edge == None:
-                idx = subgraphNodes.index(agent.lastNode)
-                neighborhood = list(subgraph.neighbors(agent.lastNode))
-            else:
-                idx = subgraphNodes.index(f"agent_{agent.id}_pos")
-                neighborhood = list(subgraph.neighbors(f"agent_{agent.id}_pos"))
-            agent_mask = np.zeros(self.max_nodes, dtype=bool)
-            agent_mask[idx] = True
-            data.agent_idx = idx
-            data.agent_mask = agent_mask
-
-            # Calculate neighbor information.
-            neighbors = [subgraphNodes.index(agent.lastNode)] if agent.edge is None else [] # include the current node in the gnn if the agent is not on an edge
-            for neighbor in neighborhood:
-                if subgraph.nodes[neighbor]["nodeType"] != NODE_TYPE.AGENT:
-                    neighbors.append(subgraphNodes.index(neighbor))
-            nbrMask = np.zeros(self.max_nodes, dtype=bool)
-            nbrMask[neighbors] = True
-            data.neighbors = neighbors
-            data.neighbors_mask = nbrMask
-            data.agent_edge = [agent.edge]
-
-            obs["graph"] = data
+            obs["graph"] = self._buildPygGraph(agent, agents, vertices)
 
 
         if (type(obs) == dict and obs == {}) or (type(obs) != dict and len(obs) < 1):
             raise ValueError(f"Invalid observation method {self.observe_method}")
         
 
-        # Check if type of any values in obs is a graph.
+        # Check if the observation contains a graph, which only the "pyg" method adds.
         if type(obs) == dict:
             # Ensure dictionary ordering.
             obs = dict(sorted(obs.items()))
 
-            typeSet = set([type(v) for v in obs.values()])
-            if Data in typeSet:
+            if observe_method in ["pyg"]:
                 # If so, we want the observation to be a single-element array of objects.
                 o = np.empty((len(obs),), dtype=object)
                 for i, k in enumerate(obs.keys()):
@@ -735,26 +717,227 @@ class parallel_env(ParallelEnv):
 
         return obs
     
+    def _getVisibleNodes(self, agent, radius):
+        ''' Returns a boolean mask (indexed by node) of the nodes within `radius` of the agent.
+            The mask is cached per agent and only recomputed once the agent has moved.
+            Finite radii are answered by the graph's KD-tree. '''
+
+        key = (agent.position, radius)
+        cached = self.visibleNodes.get(agent.id)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        visible = self.sdg.getNodesInRadius(agent.position, radius)
+        self.visibleNodes[agent.id] = (key, visible)
+        return visible
+
+
+    def _getAgentDistances(self):
+        ''' Returns the matrix of distances between all pairs of agents, indexed by agent ID.
+            The matrix is cached and only recomputed once any agent has moved. '''
+
+        positions = [a.position for a in self.possible_agents]
+        if positions != self.agentDistancesKey:
+            pos = np.array(positions, dtype=np.float64)
+            self.agentDistances = np.sqrt(np.power(pos[:, None, 0] - pos[None, :, 0], 2) + np.power(pos[:, None, 1] - pos[None, :, 1], 2))
+            self.agentDistancesKey = positions
+        return self.agentDistances
+
+
+    def _refreshBeliefs(self, agent, visible):
+        ''' Copies the true state of the visible nodes into the agent's beliefs, skipping nodes
+            which have not changed since the agent last saw them. '''
+
+        numNodes = len(visible)
+        stale = visible & (self.beliefVersions[agent.id, :numNodes] != self.sdg.nodeVersion)
+        if not stale.any():
+            return
+        nodes = np.flatnonzero(stale)
+        agent.stateBelief[nodes, 0] = self.sdg.nodeDeficit[nodes]
+        agent.stateBelief[nodes, 1] = self.sdg.nodeSurplus[nodes]
+        self.beliefVersions[agent.id, nodes] = self.sdg.nodeVersion[nodes]
+
+
+    def _buildAdjacencyMatrix(self):
+        ''' Builds the weighted adjacency matrix of the graph, with edge weights normalized and -1.0 for missing edges.
+            The matrix is read-only, since it is shared by the observations of all agents. '''
+
+        numNodes = self.sdg.graph.number_of_nodes()
+        adjacency = -1.0 * np.ones((numNodes, numNodes), dtype=np.float32)
+        weights = self.sdg.edgeWeights
+        if len(weights) > 0:
+            src, dst = self.sdg.nodeOrder[self.sdg.edgeIndex]
+            adjacency[src, dst] = self._minMaxNormalize(weights, minimum=weights.min(), maximum=weights.max())
+        adjacency.setflags(write=False)
+        return adjacency
+
+
+    def _buildPygGraph(self, agent, agents, vertices):
+        ''' Builds the PyG graph observation for the given agent.
+            The patrol graph is augmented with a node for each visible agent (and the ego agent), which
+            is connected to the node it is on and that node's neighbors, or to both ends of the edge it
+            is on. The tensors are assembled directly from the cached topology arrays of the graph and
+            match what `from_networkx` produces for the equivalent networkx graph. '''
+
+        # PyG (and torch) are only imported once a graph observation is needed.
+        import torch
+        from torch_geometric.data import Data
+
+        sdg = self.sdg
+        order = sdg.nodeOrder
+        numNodes = len(order)
+
+        # Ensure that we add a node for the current agent, even if it's dead.
+        agentsPlusEgo = agents + [agent] if agent not in agents else agents
+        numAgents = len(agentsPlusEgo)
+
+        # Connect each agent node to the graph.
+        agentNeighbors = []
+        agentWeights = []
+        for a in agentsPlusEgo:
+            if a.edge is None:
+                # Connect to the node the agent is on, and to all of that node's neighbors.
+                idx = sdg.nodeOrderIndex[a.lastNode]
+                start, end = sdg.edgeOffsets[idx], sdg.edgeOffsets[idx + 1]
+                agentNeighbors.append(np.concatenate(([idx], sdg.edgeIndex[1, start:end])))
+                agentWeights.append(np.concatenate(([0.0], sdg.edgeWeights[start:end])))
+            else:
+                # Connect to both ends of the edge the agent is on.
+                node1, node2 = a.edge
+                agentNeighbors.append(sdg.nodeOrderIndex[[node1, node2]])
+                agentWeights.append(np.array([
+                    self._calculateEdgeWeight(a.position, sdg.nodePositions[node1]),
+                    self._calculateEdgeWeight(a.position, sdg.nodePositions[node2])
+                ]))
+        agentDegree = np.array([len(n) for n in agentNeighbors], dtype=np.int64)
+        agentRows = np.repeat(np.arange(numNodes, numNodes + numAgents), agentDegree)
+        agentNeighbors = np.concatenate(agentNeighbors)
+        agentWeights = np.concatenate(agentWeights)
+
+        # Edges out of patrol graph nodes: the static edges of each node, followed by its agent edges.
+        src = np.concatenate((sdg.edgeIndex[0], agentNeighbors))
+        perm = np.argsort(src, kind="stable")
+        nodeEdges = np.stack((
+            src[perm],
+            np.concatenate((sdg.edgeIndex[1], agentRows))[perm]
+        ))
+        nodeWeights = np.concatenate((sdg.edgeWeights, agentWeights))[perm]
+        nodeNeighborIndex = np.concatenate((sdg.edgeNeighborIndex, np.full(len(agentRows), -1, dtype=np.int64)))[perm]
+
+        # Edges out of agent nodes.
+        agentEdges = np.stack((agentRows, agentNeighbors))
+        agentNeighborIndex = np.arange(len(agentRows), dtype=np.int64) - np.repeat(np.cumsum(agentDegree) - agentDegree, agentDegree)
+
+        edgeIndex = np.concatenate((nodeEdges, agentEdges), axis=1)
+        weights = np.concatenate((nodeWeights, agentWeights))
+        weights = self._minMaxNormalize(weights, minimum=weights.min(), maximum=weights.max())
+        if self.action_method == "neighbors":
+            edgeAttr = np.stack((weights, np.concatenate((nodeNeighborIndex, agentNeighborIndex))), axis=1)
+        else:
+            edgeAttr = weights.reshape(-1, 1)
+
+        # Node features of the patrol graph nodes, based on the agent's beliefs.
+        visible = np.zeros(sdg.graph.number_of_nodes(), dtype=bool)
+        visible[vertices] = True
+        beliefs = agent.stateBelief[:numNodes].astype(np.float64)
+        features = {
+            "id": sdg.nodeIds[order],
+            "nodeType": np.where(visible[order], NODE_TYPE.OBSERVABLE_NODE, NODE_TYPE.UNOBSERVABLE_NODE),
+            "degree": sdg.nodeDegree + np.bincount(agentNeighbors, minlength=numNodes),
+            "surplus": beliefs[order, 1],
+            "deficit": beliefs[order, 0],
+            "max_capacity": np.full(numNodes, -1.0),
+            "lastNode": np.full(numNodes, -1.0),
+            "currentAction": np.full(numNodes, -1.0)
+        }
+
+        # Node features of the agent nodes.
+        agentFeatures = {
+            "id": [-1 - a.id for a in agentsPlusEgo],
+            "nodeType": np.full(numAgents, NODE_TYPE.AGENT),
+            "degree": agentDegree,
+            "surplus": [a.payloads for a in agentsPlusEgo],
+            "deficit": np.full(numAgents, -1.0),
+            "max_capacity": [a.max_capacity for a in agentsPlusEgo],
+            "lastNode": [sdg.getNodeId(a.lastNode) if a.lastNode in sdg.graph.nodes else -1.0 for a in agentsPlusEgo],
+            "currentAction": [a.currentAction if a in agents else -1.0 for a in agentsPlusEgo]
+        }
+
+        if self.action_method == "neighbors":
+            node_attrs = ["id", "nodeType", "degree", "surplus", "deficit", "max_capacity", "lastNode", "currentAction"]
+        else:
+            node_attrs = ["id", "nodeType", "lastNode", "currentAction", "surplus", "deficit", "max_capacity"]
+        x = np.empty((numNodes + numAgents, len(node_attrs)), dtype=np.float64)
+        for i, attr in enumerate(node_attrs):
+            x[:numNodes, i] = features[attr]
+            x[numNodes:, i] = agentFeatures[attr]
+
+        # Positions are only inferred as doubles by from_networkx once an agent has moved and holds NumPy coordinates.
+        pos = np.concatenate((sdg.nodePositions[order], np.array([a.position for a in agentsPlusEgo], dtype=np.float64)))
+        posDtype = torch.float64 if any(isinstance(c, np.floating) for a in agentsPlusEgo for c in a.position) else torch.float32
+
+        data = Data(
+            x = torch.from_numpy(x.astype(np.float32)),
+            edge_index = torch.from_numpy(edgeIndex),
+            edge_attr = torch.from_numpy(edgeAttr.astype(np.float32)),
+            pos = torch.from_numpy(pos).to(posDtype),
+            depot = torch.from_numpy(np.concatenate((sdg.nodeDepot[order], np.zeros(numAgents, dtype=bool)))),
+            people = torch.from_numpy(np.concatenate((sdg.nodePeople[order], np.full(numAgents, -1))).astype(np.float32)),
+            payloads = torch.from_numpy(np.concatenate((sdg.nodePayloads[order], [a.payloads for a in agentsPlusEgo])).astype(np.int64))
+        )
+
+        # Calculate the agent_mask based on the graph node ID assigned to this agent.
+        if agent.edge == None:
+            idx = int(sdg.nodeOrderIndex[agent.lastNode])
+        else:
+            idx = numNodes + agentsPlusEgo.index(agent)
+        agent_mask = np.zeros(self.max_nodes, dtype=bool)
+        agent_mask[idx] = True
+        data.agent_idx = idx
+        data.agent_mask = agent_mask
+
+        # Calculate neighbor information. Include the current node in the gnn if the agent is not on an edge.
+        if agent.edge is None:
+            neighbors = [idx] + sdg.edgeIndex[1, sdg.edgeOffsets[idx]:sdg.edgeOffsets[idx + 1]].tolist()
+        else:
+            neighbors = sdg.nodeOrderIndex[list(agent.edge)].tolist()
+        nbrMask = np.zeros(self.max_nodes, dtype=bool)
+        nbrMask[neighbors] = True
+        data.neighbors = neighbors
+        data.neighbors_mask = nbrMask
+        data.agent_edge = [agent.edge]
+
+        # Padded indices of the scored neighbors (the current node is not an action), so batches can gather all scores at once.
+        scored = neighbors if agent.edge is not None else neighbors[1:]
+        scored = scored[:self.max_neighbors]
+        nbrIdx = np.full((1, self.max_neighbors), -1, dtype=np.int64)
+        nbrIdx[0, :len(scored)] = scored
+        data.neighbor_idx = torch.from_numpy(nbrIdx)
+
+        return data
+
+
     def _calculateEdgeWeight(self, pos1, pos2):
         '''Calculate the weights of the edges based on the position of the two points, here simply use the Euclidean distance'''
         return np.linalg.norm(np.array(pos1) - np.array(pos2))
 
 
-    def step(self, action_dict={}, lastStep=False): 
+    def step(self, action_dict={}, lastStep=False, observe=True): 
         ''''
         Perform a step in the environment based on the given action dictionary.
 
         Args:
             action_dict (dict): A dictionary containing actions for each agent.
+            observe (bool): Whether to build the observations. If False, the agents still observe their surroundings
+                (updating their beliefs), but the observations are only built by a later call to observeDeferred().
 
         Returns:
-            obs_dict (dict): A dictionary containing the observations for each agent.
+            obs_dict (dict): A dictionary containing the observations for each agent (empty with the "none" observation method).
             reward_dict (dict): A dictionary containing the rewards for each agent.
             done_dict (dict): A dictionary indicating whether each agent is done.
             info_dict (dict): A dictionary containing additional information for each agent.
         '''
         self.step_count += 1
-        obs_dict = {}
         reward_dict = {agent: 0.0 for agent in self.possible_agents} 
         truncated_dict = {agent: False for agent in self.possible_agents}
         info_dict = {
@@ -800,41 +983,120 @@ class parallel_env(ParallelEnv):
                         reward_dict[agent] += self._loadPayload(agent)
                     info_dict[agent]["ready"] = True
                 else:
-                    # Get the destination node.
+                    # Take a step towards the destination node.
                     dstNode = self.getDestinationNode(agent, action)
-                    
-                    # Calculate the shortest path.
                     path = self._getPathToNode(agent, dstNode)
-                    pathLen = self._getAgentPathLength(agent, path)
-                    
-                    # Take a step towards the next node.
                     stepSize = np.random.normal(loc=agent.speed, scale=1.0)
-                    for nextNode in path:
-                        reached, stepSize = self._moveTowardsNode(agent, nextNode, stepSize)
-
-                        # The agent has reached the next node.
-                        if reached:
-                            if nextNode == dstNode or not self.requireExplicitVisit:
-                                # The agent has reached its destination, visiting the node.
-                                self.nodeVisits[nextNode] += 1
-                                agent.lastNodeVisited = nextNode 
-                                if nextNode == dstNode:
-                                    agent.currentAction = -1.0
-                                    info_dict[agent]["ready"] = True
-                            # Agent reached the destination, assign a new speed from normal distribution
-                            # agent.speed = max(np.random.normal(loc=agent.startingSpeed, scale=5.0), 1.0)
-                
-                        # The agent has exceeded its movement budget for this step.
-                        if stepSize <= 0.0:
-                            break  
-                        
+                    self._moveAlongPath(agent, dstNode, path, stepSize, info_dict)
+
                     # Add a small penalty for each step taken.
                     reward_dict[agent] -= self.step_penalty 
 
-        # Perform observations.
-        for agent in self.possible_agents:
-            agent_observation = self.observe(agent)
-            obs_dict[agent] = agent_observation
+        return self._finishStep(reward_dict, truncated_dict, info_dict, lastStep, observe)
+
+
+    def stepToNextEvent(self, action_dict={}, lastStep=False, observe=True):
+        ''' Repeats step() with the same actions until any agent is ready or the episode ends, without simulating every step.
+            The first step performs any load/drop actions. After it, agents only move towards their destinations, so
+            time jumps straight to the next step in which an agent reaches a node.
+            The distance moved by each agent is sampled as the sum of its per-step distances up to that step.
+            Returns the combined results of the steps, with the number of steps taken in info_dict["steps"].
+            Attrition happens at individual steps, so with attrition only a single step is taken.
+
+            The agent positions, node visits, payloads, rewards and step counts are equivalent in distribution to repeated step() calls.
+            The beliefs and communication of the agents are not: they are only updated at the end of each jump, rather than
+            at every skipped step. So with a finite observation radius, or with a random communication model, the beliefs
+            and observations after a jump can differ from those of repeated step() calls. '''
+
+        _, reward_dict, done_dict, truncated_dict, info_dict = self.step(action_dict, lastStep, observe=False)
+        steps = 1
+
+        moving = [agent for agent in self.agents if agent in action_dict]
+        while self.attrition_method == "none" and len(moving) > 0 and not any(info_dict[agent]["ready"] for agent in self.agents):
+            # The remaining steps are bounded by the episode length.
+            limit = self.max_cycles - self.step_count if self.max_cycles >= 0 else None
+
+            # Sample the distance moved by each agent until any of them reaches the next node on its path.
+            dstNodes = [self.getDestinationNode(agent, action_dict[agent]) for agent in moving]
+            paths = [self._getPathToNode(agent, dstNode) for agent, dstNode in zip(moving, dstNodes)]
+            distances = np.array([self._dist(agent.position, self.sdg.getNodePosition(path[0])) for agent, path in zip(moving, paths)])
+            speeds = np.array([agent.speed for agent in moving], dtype=np.float64)
+            jump, moved = self._sampleMovement(speeds, distances, limit)
+
+            self.step_count += jump
+            steps += jump
+            jumpRewards = {agent: 0.0 for agent in self.possible_agents}
+            truncated_dict = {agent: False for agent in self.possible_agents}
+            info_dict = {agent: {"ready": self.dones[agent]} for agent in self.possible_agents}
+            for agent, dstNode, path, distance in zip(moving, dstNodes, paths, moved):
+                self._moveAlongPath(agent, dstNode, path, distance, info_dict)
+                jumpRewards[agent] -= self.step_penalty * jump
+
+            _, jumpRewards, done_dict, truncated_dict, info_dict = self._finishStep(jumpRewards, truncated_dict, info_dict, False, False)
+            for agent in self.possible_agents:
+                reward_dict[agent] += jumpRewards[agent]
+            moving = [agent for agent in moving if agent in self.agents]
+
+        obs_dict = self.observeDeferred() if observe else {}
+        info_dict["steps"] = steps
+        return obs_dict, reward_dict, done_dict, truncated_dict, info_dict
+
+
+    def _sampleMovement(self, speeds, distances, limit=None):
+        ''' Samples the per-step movement of agents with the given speeds until the first step in which any agent has moved
+            at least its given distance, or for at most `limit` steps.
+            Returns the number of steps and the total distance moved by each agent. '''
+
+        total = np.zeros(len(speeds))
+        steps = 0
+        while limit is None or steps < limit:
+            chunk = 32 if limit is None else min(32, limit - steps)
+            moved = total[:, None] + np.cumsum(np.random.normal(loc=speeds[:, None], scale=1.0, size=(len(speeds), chunk)), axis=1)
+            arrivals = np.flatnonzero((moved >= distances[:, None]).any(axis=0))
+            if len(arrivals) > 0:
+                return steps + arrivals[0] + 1, moved[:, arrivals[0]]
+            total = moved[:, -1]
+            steps += chunk
+        return steps, total
+
+
+    def _moveAlongPath(self, agent, dstNode, path, stepSize, info_dict):
+        ''' Moves the agent along the path to its destination node by the given distance, visiting the nodes it reaches.
+            The agent becomes ready once it reaches its destination. '''
+
+        for nextNode in path:
+            reached, stepSize = self._moveTowardsNode(agent, nextNode, stepSize)
+
+            # The agent has reached the next node.
+            if reached:
+                if nextNode == dstNode or not self.requireExplicitVisit:
+                    # The agent has reached its destination, visiting the node.
+                    self.nodeVisits[nextNode] += 1
+                    agent.lastNodeVisited = nextNode 
+                    if nextNode == dstNode:
+                        agent.currentAction = -1.0
+                        info_dict[agent]["ready"] = True
+                # Agent reached the destination, assign a new speed from normal distribution
+                # agent.speed = max(np.random.normal(loc=agent.startingSpeed, scale=5.0), 1.0)
+    
+            # The agent has exceeded its movement budget for this step.
+            if stepSize <= 0.0:
+                break  
+
+
+    def _finishStep(self, reward_dict, truncated_dict, info_dict, lastStep, observe):
+        ''' Observes the outcome of a step, checks whether the episode is over and returns the results of the step. '''
+
+        obs_dict = {}
+
+        # Perform observations. These are skipped entirely with the "none" observation method.
+        if self.observe_method != "none":
+            for agent in self.possible_agents:
+                if observe:
+                    agent_observation = self.observe(agent)
+                    obs_dict[agent] = agent_observation
+                else:
+                    self.deferredSurroundings[agent] = self._observeSurroundings(agent, None, False)
         
         # Record miscellaneous information.
         info_dict["node_visits"] = self.nodeVisits
@@ -948,17 +1210,16 @@ class parallel_env(ParallelEnv):
 
         # The agent is on an edge, so determine which connected node results in shortest path.
         if agent.edge != None:
-            path1 = nx.shortest_path(self.sdg.graph, source=agent.edge[0], target=dstNode, weight='weight')
-            pathLen1 = self._getAgentPathLength(agent, path1)
-            path2 = nx.shortest_path(self.sdg.graph, source=agent.edge[1], target=dstNode, weight='weight')
-            pathLen2 = self._getAgentPathLength(agent, path2)
-            path = path1
+            pathLen1 = self._dist(agent.position, self.sdg.getNodePosition(agent.edge[0])) + self.sdg.getShortestPathLength(agent.edge[0], dstNode)
+            pathLen2 = self._dist(agent.position, self.sdg.getNodePosition(agent.edge[1])) + self.sdg.getShortestPathLength(agent.edge[1], dstNode)
+            source = agent.edge[0]
             if pathLen2 < pathLen1:
-                path = path2
+                source = agent.edge[1]
+            path = self.sdg.getShortestPath(source, dstNode)
         
-        # The agent is on a node. Simply calculate the shortest path.
+        # The agent is on a node. Simply look up the shortest path.
         else:
-            path = nx.shortest_path(self.sdg.graph, source=agent.lastNode, target=dstNode, weight='weight')
+            path = self.sdg.getShortestPath(agent.lastNode, dstNode)
 
             # Remove the first node from the path if the destination is different than the current node.
             if agent.lastNode != dstNode:
@@ -968,11 +1229,12 @@ class parallel_env(ParallelEnv):
 
 
     def _getAgentPathLength(self, agent, path):
-        ''' Calculates the length of the given path for the given agent. '''
+        ''' Calculates the length of the given path for the given agent.
+            The path is assumed to be a shortest path, as returned by `_getPathToNode`. '''
 
         pathLen = 0.0
         pathLen += self._dist(agent.position, self.sdg.getNodePosition(path[0]))
-        pathLen += nx.path_weight(self.sdg.graph, path, weight='weight')
+        pathLen += self.sdg.getShortestPathLength(path[0], path[-1])
 
         return pathLen
 
@@ -1074,8 +1336,8 @@ class parallel_env(ParallelEnv):
     def __str__(self):
         ''' Returns a string representation of the environment. '''
         node_rep = {}
-        for key, val in self.sdg.graph.nodes(data=True):
-            node_rep[key] = val
+        for key in self.sdg.graph.nodes:
+            node_rep[key] = self.sdg.getNodeAttributes(key)
 
         return f"SDZoo Environment\nGraph: {self.sdg.graph}:\n{node_rep}\nAgents: {self.agents}\nObservation Method: {self.observe_method}\nAction Method: {self.action_method}"
     
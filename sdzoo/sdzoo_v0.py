@@ -4,5 +4,8 @@ from sdzoo.env.sdzoo import (
 from sdzoo.env.sd_graph import (
     SDGraph
 )
+from sdzoo.env.sd_batch_env import (
+    SDBatchEnv
+)
 
-__all__ = ["parallel_env", "SDGraph"]
\ No newline at end of file
+__all__ = ["parallel_env", "SDGraph", "SDBatchEnv"]
\ No newline at end of file
@@ -0,0 +1,479 @@
+import unittest
+from argparse import Namespace
+from itertools import product
+
+import numpy as np
+import torch
+from gymnasium import spaces
+
+from onpolicy.utils.separated_buffer import SeparatedReplayBuffer
+from onpolicy.utils.shared_buffer import SharedReplayBuffer
+from onpolicy.utils.packed_buffer import PackedReplayBuffer
+from onpolicy.utils.valuenorm import ValueNorm
+from onpolicy.algorithms.utils.popart import PopArt
+
+
+def bufferArgs(**kwargs):
+    ''' Create the arguments of a small replay buffer. '''
+    args = Namespace(
+        hidden_size=8,
+        recurrent_N=1,
+        gamma=0.9,
+        gae_lambda=0.8,
+        use_gae=True,
+        use_gae_amadm=False,
+        use_popart=False,
+        use_valuenorm=False,
+        use_proper_time_limits=False,
+    )
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+    return args
+
+
+class TestPackedReplayBuffer(unittest.TestCase):
+    ''' Checks that the packed buffer matches a separated buffer per (thread, agent) pair. '''
+
+    THREADS = 2
+    AGENTS = 2
+    EPISODE_LENGTH = 12
+
+    def _args(self, **kwargs):
+        return bufferArgs(episode_length=self.EPISODE_LENGTH, n_rollout_threads=self.THREADS, **kwargs)
+
+    def _spaces(self):
+        return (spaces.Box(-1.0, 1.0, (5,), dtype=np.float32),
+                spaces.Box(-1.0, 1.0, (7,), dtype=np.float32),
+                spaces.Discrete(4))
+
+    def _fill(self, args, seed=0, steps=None):
+        '''
+        Insert the same random transitions into a packed buffer and into one separated buffer per pair, and the
+        same centralized critic inputs into the packed buffer and into a shared critic buffer, as the runner did
+        before the packed buffer. Inserts args.episode_length steps unless given.
+        '''
+        rng = np.random.default_rng(seed)
+        obs_space, share_obs_space, act_space = self._spaces()
+        steps = args.episode_length if steps is None else steps
+
+        packed = PackedReplayBuffer(args, self.AGENTS, obs_space, share_obs_space, act_space)
+        sepArgs = Namespace(**vars(args))
+        sepArgs.n_rollout_threads = 1
+        sepArgs.episode_length = steps
+        separated = [[SeparatedReplayBuffer(sepArgs, obs_space, share_obs_space, act_space)
+                      for a in range(self.AGENTS)] for i in range(self.THREADS)]
+        criticArgs = Namespace(**vars(args))
+        criticArgs.episode_length = steps
+        critic = SharedReplayBuffer(criticArgs, self.AGENTS, obs_space, share_obs_space, act_space)
+
+        pairs = (self.THREADS, self.AGENTS)
+        hidden = (args.recurrent_N, args.hidden_size)
+
+        def random(*shape):
+            return rng.standard_normal((*pairs, *shape)).astype(np.float32)
+
+        # Initial state.
+        share_obs, obs, rnn_states, rnn_states_critic = random(7), random(5), random(*hidden), random(*hidden)
+        available_actions = (rng.random((*pairs, 4)) < 0.7).astype(np.float32)
+        packed.cur_share_obs[:] = share_obs
+        packed.cur_obs[:] = obs
+        packed.cur_rnn_states[:] = rnn_states
+        packed.cur_rnn_states_critic[:] = rnn_states_critic
+        packed.cur_available_actions[:] = available_actions
+        for i in range(self.THREADS):
+            for a in range(self.AGENTS):
+                buf = separated[i][a]
+                buf.share_obs[0] = share_obs[i, a]
+                buf.obs[0] = obs[i, a]
+                buf.rnn_states[0] = rnn_states[i, a]
+                buf.rnn_states_critic[0] = rnn_states_critic[i, a]
+                buf.available_actions[0] = available_actions[i, a]
+
+        critic.share_obs[0] = share_obs
+        packed.critic_share_obs[:] = share_obs
+
+        for step in range(steps):
+            # The first pair acts on every step, the others at random.
+            ready = rng.random(pairs) < 0.7
+            ready[0, 0] = True
+            data = dict(
+                share_obs=random(7),
+                obs=random(5),
+                rnn_states=random(*hidden),
+                rnn_states_critic=random(*hidden),
+                actions=rng.integers(0, 4, (*pairs, 1)).astype(np.float32),
+                action_log_probs=random(1),
+                value_preds=random(1),
+                rewards=random(1),
+                masks=(rng.random((*pairs, 1)) < 0.8).astype(np.float32),
+                active_masks=(rng.random((*pairs, 1)) < 0.9).astype(np.float32),
+                available_actions=(rng.random((*pairs, 4)) < 0.7).astype(np.float32),
+                deltaSteps=rng.integers(1, 4, (*pairs, 1)).astype(np.int32),
+            )
+            packed.insert(ready, **data, criticStep=packed.critic_step)
+            for i, a in zip(*np.nonzero(ready)):
+                separated[i][a].insert(**{k: v[i, a][None] for k, v in data.items()},
+                                       criticStep=np.array(critic.step), no_reset=True)
+
+            # Since the first pair acted, the critic inputs are updated for every pair.
+            criticData = dict(data, share_obs=random(7), rnn_states_critic=random(*hidden),
+                              masks=(rng.random((*pairs, 1)) < 0.8).astype(np.float32))
+            packed.insert_critic(criticData["share_obs"], criticData["rnn_states_critic"], criticData["masks"])
+            critic.insert(**criticData, no_reset=True)
+
+        return packed, separated, critic
+
+    def _computeReturns(self, packed, separated, normalizer):
+        next_values = np.random.default_rng(1).standard_normal((self.THREADS, self.AGENTS, 1)).astype(np.float32)
+        packed.compute_returns(next_values, packed.cur_masks, normalizer)
+        for i in range(self.THREADS):
+            for a in range(self.AGENTS):
+                buf = separated[i][a]
+                buf.compute_returns(next_values[i, a][None], normalizer, last_step=buf.step)
+
+    def _assertBatchesEqual(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for batchExpected, batchActual in zip(expected, actual):
+            self.assertEqual(len(batchExpected), len(batchActual))
+            for e, a in zip(batchExpected, batchActual):
+                if e is None:
+                    self.assertIsNone(a)
+                else:
+                    np.testing.assert_allclose(a, e, rtol=1e-5, atol=1e-6)
+
+    def _assertGeneratorsMatch(self, expected, actual, advantages, seed, full):
+        ''' Check that the minibatch generators of two buffers yield the same batches. '''
+        step = expected.step
+        generators = [lambda b: b.feed_forward_generator(advantages, num_mini_batch=2, last_step=step)]
+        if full:
+            generators.append(lambda b: b.naive_recurrent_generator(advantages, num_mini_batch=1, last_step=step))
+        if step >= 4:
+            generators.append(lambda b: b.recurrent_generator(advantages, num_mini_batch=1, data_chunk_length=2, last_step=step))
+
+        for generator in generators:
+            torch.manual_seed(seed)
+            batchesExpected = list(generator(expected))
+            torch.manual_seed(seed)
+            batchesActual = list(generator(actual))
+            self._assertBatchesEqual(batchesExpected, batchesActual)
+
+    def _assertMatches(self, args, normalizer=None, steps=None):
+        packed, separated, critic = self._fill(args, steps=steps)
+        self._computeReturns(packed, separated, normalizer)
+
+        for i in range(self.THREADS):
+            for a in range(self.AGENTS):
+                buf = separated[i][a]
+                segment = packed.segment(i, a)
+                self.assertEqual(segment.step, buf.step)
+                np.testing.assert_allclose(segment.returns, buf.returns[:buf.step], rtol=1e-5, atol=1e-6)
+                np.testing.assert_allclose(segment.value_preds, buf.value_preds[:buf.step])
+                np.testing.assert_allclose(segment.masks, buf.masks[:buf.step])
+                if buf.step == 0:
+                    continue
+
+                advantages = buf.returns[:buf.step] - buf.value_preds[:buf.step]
+                self._assertGeneratorsMatch(buf, segment, advantages, i * self.AGENTS + a, buf.step == buf.episode_length)
+
+    def test_gae(self):
+        self._assertMatches(self._args(use_gae=True))
+
+    def test_no_gae(self):
+        self._assertMatches(self._args(use_gae=False))
+
+    def test_gae_amadm(self):
+        self._assertMatches(self._args(use_gae=False, use_gae_amadm=True))
+
+    def test_valuenorm(self):
+        normalizer = ValueNorm(1)
+        normalizer.update(np.random.default_rng(2).normal(3.0, 2.0, (64, 1)).astype(np.float32))
+        self._assertMatches(self._args(use_gae=True, use_valuenorm=True), normalizer)
+
+    def test_proper_time_limits(self):
+        # The packed buffer does not record time limits, so this only checks the option does not change
+        # the result when none are hit (the separated buffer's bad masks are all ones).
+        self._assertMatches(self._args(use_gae=True, use_proper_time_limits=True))
+        self._assertMatches(self._args(use_gae=False, use_proper_time_limits=True))
+
+    def test_arena_growth(self):
+        args = self._args()
+        packed, separated, critic = self._fill(args, steps=3 * self.EPISODE_LENGTH)
+        initialCapacity = self.EPISODE_LENGTH * self.THREADS * self.AGENTS
+        self.assertGreater(packed.size, initialCapacity)
+        self.assertGreaterEqual(packed.capacity, packed.size)
+        self._assertMatches(args, steps=3 * self.EPISODE_LENGTH)
+
+    def _concatenatedCriticBuffer(self, args, separated):
+        ''' Build the critic buffer the runner trained a centralized critic on before the packed buffer. '''
+        totalSteps = 0
+        for i in range(self.THREADS):
+            for agent_id in range(self.AGENTS):
+                totalSteps += separated[i][agent_id].step
+        args = Namespace(**vars(args))
+        args.n_rollout_threads = 1
+        args.episode_length = totalSteps
+        cbuf = SeparatedReplayBuffer(args, *self._spaces())
+
+        # Append the buffers from each rollout thread and agent.
+        for i in range(self.THREADS):
+            for agent_id in range(self.AGENTS):
+                buf = separated[i][agent_id]
+
+                cbuf.share_obs[cbuf.step:cbuf.step + buf.step] = buf.share_obs[:buf.step]
+                cbuf.obs[cbuf.step:cbuf.step + buf.step] = buf.obs[:buf.step]
+                cbuf.rnn_states[cbuf.step:cbuf.step + buf.step] = buf.rnn_states[:buf.step]
+                cbuf.rnn_states_critic[cbuf.step:cbuf.step + buf.step] = buf.rnn_states_critic[:buf.step]
+                cbuf.actions[cbuf.step:cbuf.step + buf.step] = buf.actions[:buf.step]
+                cbuf.action_log_probs[cbuf.step:cbuf.step + buf.step] = buf.action_log_probs[:buf.step]
+                cbuf.value_preds[cbuf.step:cbuf.step + buf.step] = buf.value_preds[:buf.step]
+                cbuf.rewards[cbuf.step:cbuf.step + buf.step] = buf.rewards[:buf.step]
+                cbuf.masks[cbuf.step:cbuf.step + buf.step] = buf.masks[:buf.step]
+                cbuf.deltaSteps[cbuf.step:cbuf.step + buf.step] = buf.deltaSteps[:buf.step]
+
+                # Set the mask for the first step to 0 (reset the RNN)
+                cbuf.masks[cbuf.step] = np.zeros_like(cbuf.masks[cbuf.step])
+
+                cbuf.step += buf.step
+        return cbuf
+
+    def _assertSeriesMatches(self, args, normalizer=None, steps=None):
+        packed, separated, critic = self._fill(args, steps=steps)
+        # The runner records no active masks, and the concatenated buffer did not copy them.
+        packed.active_masks[:] = 1.0
+        cbuf = self._concatenatedCriticBuffer(args, separated)
+        series = packed.series()
+        self.assertEqual(series.step, cbuf.step)
+        np.testing.assert_array_equal(packed.share_obs[series.rows], cbuf.share_obs[:cbuf.step, 0])
+        np.testing.assert_array_equal(packed.rnn_states_critic[series.rows], cbuf.rnn_states_critic[:cbuf.step, 0])
+        np.testing.assert_array_equal(series.masks, cbuf.masks[:cbuf.step])
+        np.testing.assert_array_equal(series.value_preds, cbuf.value_preds[:cbuf.step])
+
+        # Only the last segment of the series is bootstrapped, as in the runner.
+        next_value = np.random.default_rng(1).standard_normal((1, 1)).astype(np.float32)
+        cbuf.compute_returns(next_value, normalizer, last_step=cbuf.step)
+        last = series.rows[-1]
+        i, agent_id = divmod(packed.pair[last], self.AGENTS)
+        next_values = np.zeros((self.THREADS, self.AGENTS, 1), dtype=np.float32)
+        next_masks = np.zeros_like(next_values)
+        next_values[i, agent_id] = next_value
+        next_masks[i, agent_id] = 1.0
+        packed.compute_returns(next_values, next_masks, normalizer)
+        np.testing.assert_allclose(series.returns, cbuf.returns[:cbuf.step], rtol=1e-5, atol=1e-5)
+
+        # The returns of each pair are those of its part of the series.
+        offset = 0
+        for i in range(self.THREADS):
+            for agent_id in range(self.AGENTS):
+                segment = packed.segment(i, agent_id)
+                np.testing.assert_allclose(segment.returns, cbuf.returns[offset:offset + segment.step], rtol=1e-5, atol=1e-5)
+                offset += segment.step
+
+        advantages = cbuf.returns[:cbuf.step] - cbuf.value_preds[:cbuf.step]
+        self._assertGeneratorsMatch(cbuf, series, advantages, 0, True)
+
+    def test_series_matches_concatenated_critic_buffer(self):
+        normalizer = ValueNorm(1)
+        normalizer.update(np.random.default_rng(2).normal(3.0, 2.0, (64, 1)).astype(np.float32))
+        for steps in (None, 3 * self.EPISODE_LENGTH):
+            with self.subTest(steps=steps):
+                self._assertSeriesMatches(self._args(use_gae=True), steps=steps)
+                self._assertSeriesMatches(self._args(use_gae=False), steps=steps)
+                self._assertSeriesMatches(self._args(use_gae=False, use_gae_amadm=True), steps=steps)
+                self._assertSeriesMatches(self._args(use_gae=True, use_valuenorm=True), normalizer, steps=steps)
+
+    def test_compute_returns_pairs(self):
+        # Each agent's critic computes the returns of its own pairs, as in the runner.
+        packed, separated, critic = self._fill(self._args(), steps=3 * self.EPISODE_LENGTH)
+        next_values = np.random.default_rng(1).standard_normal((self.THREADS, self.AGENTS, 1)).astype(np.float32)
+        packed.returns[:] = np.nan
+        for agent_id in range(self.AGENTS):
+            pairs = np.zeros((self.THREADS, self.AGENTS), dtype=bool)
+            pairs[:, agent_id] = True
+            packed.compute_returns(next_values, packed.cur_masks, pairs=pairs)
+
+            for i in range(self.THREADS):
+                for a in range(self.AGENTS):
+                    buf = separated[i][a]
+                    segment = packed.segment(i, a)
+                    if a > agent_id:
+                        # Pairs that were not selected are left alone.
+                        self.assertTrue(np.all(np.isnan(segment.returns)))
+                    elif a == agent_id:
+                        buf.compute_returns(next_values[i, a][None], None, last_step=buf.step)
+                        np.testing.assert_allclose(segment.returns, buf.returns[:buf.step], rtol=1e-5, atol=1e-6)
+
+    def test_insert_critic(self):
+        packed, separated, critic = self._fill(self._args(), steps=3 * self.EPISODE_LENGTH)
+
+        # The latest critic inputs are those the shared critic buffer would be evaluated on next.
+        self.assertEqual(packed.critic_step, critic.step)
+        np.testing.assert_array_equal(packed.critic_share_obs, critic.share_obs[critic.step])
+        np.testing.assert_array_equal(packed.critic_rnn_states, critic.rnn_states_critic[critic.step])
+        np.testing.assert_array_equal(packed.critic_masks, critic.masks[critic.step])
+
+        # Each transition records the critic step it was taken at.
+        for i in range(self.THREADS):
+            for agent_id in range(self.AGENTS):
+                buf = separated[i][agent_id]
+                rows = packed.segments()[i * self.AGENTS + agent_id]
+                np.testing.assert_array_equal(packed.criticStep[rows], buf.criticStep[:buf.step, 0])
+
+        packed.reset()
+        self.assertEqual(packed.critic_step, 0)
+
+
+def referenceReturns(buf, next_value, value_normalizer=None, denormalizeTimeLimitValues=True):
+    ''' The per-step loops that compute_returns() replaced, for a buffer filled for its whole episode.
+        Without GAE, the separated buffer only denormalized the values used at time limits for PopArt. '''
+    last_step = buf.episode_length
+    if buf._use_gae_amadm and not buf._use_gae:
+        buf.value_preds[last_step] = next_value
+        gae = 0
+        for step in reversed(range(last_step)):
+            if buf._use_popart or buf._use_valuenorm:
+                delta = buf.rewards[step] + np.power(buf.gamma, buf.deltaSteps[step]) * value_normalizer.denormalize(
+                    buf.value_preds[step + 1]) * buf.masks[step + 1] \
+                        - value_normalizer.denormalize(buf.value_preds[step])
+                gae = delta + np.power(buf.gamma * buf.gae_lambda, buf.deltaSteps[step]) * buf.masks[step + 1] * gae
+                buf.returns[step] = gae + value_normalizer.denormalize(buf.value_preds[step])
+            else:
+                delta = buf.rewards[step] + np.power(buf.gamma, buf.deltaSteps[step]) * buf.value_preds[step + 1] * buf.masks[step + 1] - \
+                        buf.value_preds[step]
+                gae = delta + np.power(buf.gamma * buf.gae_lambda, buf.deltaSteps[step]) * buf.masks[step + 1] * gae
+                buf.returns[step] = gae + buf.value_preds[step]
+
+    elif buf._use_proper_time_limits:
+        if buf._use_gae:
+            buf.value_preds[last_step] = next_value
+            gae = 0
+            for step in reversed(range(buf.rewards.shape[0])):
+                if buf._use_popart or buf._use_valuenorm:
+                    delta = buf.rewards[step] + buf.gamma * value_normalizer.denormalize(
+                        buf.value_preds[step + 1]) * buf.masks[step + 1] \
+                            - value_normalizer.denormalize(buf.value_preds[step])
+                    gae = delta + buf.gamma * buf.gae_lambda * gae * buf.masks[step + 1]
+                    gae = gae * buf.bad_masks[step + 1]
+                    buf.returns[step] = gae + value_normalizer.denormalize(buf.value_preds[step])
+                else:
+                    delta = buf.rewards[step] + buf.gamma * buf.value_preds[step + 1] * buf.masks[step + 1] - \
+                            buf.value_preds[step]
+                    gae = delta + buf.gamma * buf.gae_lambda * buf.masks[step + 1] * gae
+                    gae = gae * buf.bad_masks[step + 1]
+                    buf.returns[step] = gae + buf.value_preds[step]
+        else:
+            buf.returns[last_step] = next_value
+            for step in reversed(range(buf.rewards.shape[0])):
+                if buf._use_popart or (buf._use_valuenorm and denormalizeTimeLimitValues):
+                    buf.returns[step] = (buf.returns[step + 1] * buf.gamma * buf.masks[step + 1] + buf.rewards[
+                        step]) * buf.bad_masks[step + 1] \
+                                         + (1 - buf.bad_masks[step + 1]) * value_normalizer.denormalize(
+                        buf.value_preds[step])
+                else:
+                    buf.returns[step] = (buf.returns[step + 1] * buf.gamma * buf.masks[step + 1] + buf.rewards[
+                        step]) * buf.bad_masks[step + 1] \
+                                         + (1 - buf.bad_masks[step + 1]) * buf.value_preds[step]
+    else:
+        if buf._use_gae:
+            buf.value_preds[last_step] = next_value
+            gae = 0
+            for step in reversed(range(buf.rewards.shape[0])):
+                if buf._use_popart or buf._use_valuenorm:
+                    delta = buf.rewards[step] + buf.gamma * value_normalizer.denormalize(
+                        buf.value_preds[step + 1]) * buf.masks[step + 1] \
+                            - value_normalizer.denormalize(buf.value_preds[step])
+                    gae = delta + buf.gamma * buf.gae_lambda * buf.masks[step + 1] * gae
+                    buf.returns[step] = gae + value_normalizer.denormalize(buf.value_preds[step])
+                else:
+                    delta = buf.rewards[step] + buf.gamma * buf.value_preds[step + 1] * buf.masks[step + 1] - \
+                            buf.value_preds[step]
+                    gae = delta + buf.gamma * buf.gae_lambda * buf.masks[step + 1] * gae
+                    buf.returns[step] = gae + buf.value_preds[step]
+        else:
+            buf.returns[last_step] = next_value
+            for step in reversed(range(buf.rewards.shape[0])):
+                buf.returns[step] = buf.returns[step + 1] * buf.gamma * buf.masks[step + 1] + buf.rewards[step]
+
+
+class TestComputeReturns(unittest.TestCase):
+    ''' Checks compute_returns() of the separated and shared buffers against the per-step loops it replaced. '''
+
+    EPISODE_LENGTH = 10
+    THREADS = 2
+    AGENTS = 3
+
+    def _args(self, **kwargs):
+        return bufferArgs(n_rollout_threads=self.THREADS, **kwargs)
+
+    def _buffer(self, shared, args, seed=0):
+        ''' Create a buffer holding random transitions. '''
+        obs_space = spaces.Box(-1.0, 1.0, (5,), dtype=np.float32)
+        share_obs_space = spaces.Box(-1.0, 1.0, (7,), dtype=np.float32)
+        act_space = spaces.Discrete(4)
+        if shared:
+            buf = SharedReplayBuffer(args, self.AGENTS, obs_space, share_obs_space, act_space)
+        else:
+            buf = SeparatedReplayBuffer(args, obs_space, share_obs_space, act_space)
+
+        rng = np.random.default_rng(seed)
+        buf.rewards[:] = rng.standard_normal(buf.rewards.shape)
+        buf.value_preds[:] = rng.standard_normal(buf.value_preds.shape)
+        buf.masks[:] = rng.random(buf.masks.shape) < 0.8
+        buf.bad_masks[:] = rng.random(buf.bad_masks.shape) < 0.8
+        buf.deltaSteps[:] = rng.integers(1, 4, buf.deltaSteps.shape)
+        buf.returns[:] = rng.standard_normal(buf.returns.shape)
+        return buf
+
+    def _normalizers(self):
+        values = np.random.default_rng(2).normal(3.0, 2.0, (64, 1)).astype(np.float32)
+        valueNorm = ValueNorm(1)
+        valueNorm.update(values)
+        # PopArt.update() assigns plain tensors to its parameters, which torch rejects, so set the running statistics directly.
+        popArt = PopArt(1, 1)
+        popArt.mean.fill_(-1.0)
+        popArt.mean_sq.fill_(5.0)
+        popArt.debiasing_term.fill_(1.0)
+        return {"valuenorm": valueNorm, "popart": popArt}
+
+    def test_matches_reference(self):
+        normalizers = self._normalizers()
+        for shared, use_gae, use_gae_amadm, use_proper_time_limits, normalizer in product(
+                [False, True], [False, True], [False, True], [False, True], [None, "valuenorm", "popart"]):
+            with self.subTest(shared=shared, use_gae=use_gae, use_gae_amadm=use_gae_amadm,
+                              use_proper_time_limits=use_proper_time_limits, normalizer=normalizer):
+                args = self._args(episode_length=self.EPISODE_LENGTH, use_gae=use_gae, use_gae_amadm=use_gae_amadm,
+                                  use_proper_time_limits=use_proper_time_limits,
+                                  use_valuenorm=normalizer == "valuenorm", use_popart=normalizer == "popart")
+                buf = self._buffer(shared, args)
+                expected = self._buffer(shared, args)
+                next_value = np.random.default_rng(1).standard_normal(buf.value_preds.shape[1:]).astype(np.float32)
+                value_normalizer = normalizers.get(normalizer)
+
+                buf.compute_returns(next_value, value_normalizer)
+                referenceReturns(expected, next_value, value_normalizer, denormalizeTimeLimitValues=shared)
+                np.testing.assert_allclose(buf.returns, expected.returns, rtol=1e-6, atol=1e-6)
+                np.testing.assert_array_equal(buf.value_preds, expected.value_preds)
+
+    def test_last_step(self):
+        # Only the steps before last_step are used, and the later rows are left as they are.
+        normalizers = self._normalizers()
+        lastStep = 6
+        for shared, use_gae, use_gae_amadm, use_proper_time_limits, normalizer in product(
+                [False, True], [False, True], [False, True], [False, True], [None, "valuenorm"]):
+            with self.subTest(shared=shared, use_gae=use_gae, use_gae_amadm=use_gae_amadm,
+                              use_proper_time_limits=use_proper_time_limits, normalizer=normalizer):
+                kwargs = dict(use_gae=use_gae, use_gae_amadm=use_gae_amadm, use_proper_time_limits=use_proper_time_limits,
+                              use_valuenorm=normalizer == "valuenorm")
+                buf = self._buffer(shared, self._args(episode_length=self.EPISODE_LENGTH, **kwargs))
+                expected = self._buffer(shared, self._args(episode_length=lastStep, **kwargs))
+                for key in ["rewards", "value_preds", "masks", "bad_masks", "deltaSteps", "returns"]:
+                    getattr(expected, key)[:] = getattr(buf, key)[:len(getattr(expected, key))]
+                after = {key: getattr(buf, key)[lastStep + 1:].copy() for key in ["returns", "value_preds"]}
+                next_value = np.random.default_rng(1).standard_normal(buf.value_preds.shape[1:]).astype(np.float32)
+                value_normalizer = normalizers.get(normalizer)
+
+                buf.compute_returns(next_value, value_normalizer, last_step=lastStep)
+                referenceReturns(expected, next_value, value_normalizer, denormalizeTimeLimitValues=shared)
+                np.testing.assert_allclose(buf.returns[:lastStep], expected.returns[:lastStep], rtol=1e-6, atol=1e-6)
+                np.testing.assert_array_equal(buf.value_preds[:lastStep + 1], expected.value_preds)
+                for key, rows in after.items():
+                    np.testing.assert_array_equal(getattr(buf, key)[lastStep + 1:], rows)
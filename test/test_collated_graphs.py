@@ -0,0 +1,119 @@
+import random
+import unittest
+
+import numpy as np
+import torch
+from torch_geometric.data import Batch
+from torch_geometric.utils import to_dense_batch
+
+from sdzoo.sdzoo_v0 import SDGraph, parallel_env
+from onpolicy.utils.util import get_graph_obs_space_idx
+from onpolicy.utils.collated_graphs import CollatedGraphs, GraphCollator, CollatedObs, unique_graphs
+
+
+def observations(steps=6, seed=0, **kwargs):
+    ''' Collect the "pyg" observations of a few random steps of a small environment, along with its observation space. '''
+    random.seed(seed)
+    np.random.seed(seed)
+    env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, observe_method="pyg", **kwargs)
+    obs, _ = env.reset(seed=seed)
+    rows = []
+    for _ in range(steps):
+        rows += [obs[agent] for agent in env.agents]
+        actions = {agent: random.choice(np.flatnonzero(env.available_actions[agent]).tolist()) for agent in env.agents}
+        obs, _, _, _, _ = env.step(actions)
+    all_obs = np.empty((len(rows), len(rows[0])), dtype=object)
+    for i, row in enumerate(rows):
+        all_obs[i] = row
+    return env.observation_spaces[env.possible_agents[0]], all_obs
+
+
+class TestCollatedGraphs(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.obs_space, cls.obs = observations(observation_radius=200)
+        cls.graphs = list(cls.obs[:, get_graph_obs_space_idx(cls.obs_space)])
+
+    def _assertBatchesEqual(self, actual, expected):
+        self.assertEqual(actual.num_graphs, expected.num_graphs)
+        for key in expected.keys():
+            if isinstance(expected[key], torch.Tensor):
+                # The graphs are concatenated up front, so an attribute whose dtype differs between graphs (pos, which
+                # SDEnv stores as doubles once agents have moved) is promoted even in batches of graphs that agree.
+                if key in ["x", "edge_index", "edge_attr", "batch", "ptr", "neighbor_idx"]:
+                    self.assertEqual(actual[key].dtype, expected[key].dtype, key)
+                torch.testing.assert_close(actual[key], expected[key], rtol=0, atol=0, check_dtype=False, msg=key)
+            else:
+                self.assertEqual(list(actual[key]), list(expected[key]), key)
+        self.assertEqual(set(actual.keys()), set(expected.keys()))
+
+    def test_batch_matches_from_data_list(self):
+        collated = CollatedGraphs(self.graphs)
+        rng = np.random.default_rng(0)
+        for indices in [np.arange(len(self.graphs)), rng.permutation(len(self.graphs))[:7], np.array([3])]:
+            expected = Batch.from_data_list([self.graphs[i] for i in indices])
+            self._assertBatchesEqual(collated.batch(indices), expected)
+
+    def test_batch_with_repeated_graphs(self):
+        collated = CollatedGraphs(self.graphs)
+        indices = np.array([4, 1, 4, 4, 0, 1])
+        expected = Batch.from_data_list([self.graphs[i] for i in indices])
+        self._assertBatchesEqual(collated.batch(indices), expected)
+
+    def test_graph_collator(self):
+        obs = self.obs.reshape(-1, 3, self.obs.shape[-1]).copy()
+        collator = GraphCollator(self.obs_space)
+        graph_idx = get_graph_obs_space_idx(self.obs_space)
+
+        flat = obs.reshape(-1, obs.shape[-1])
+        indices = np.array([5, 2, 9])
+        wrapped = collator.wrap(obs, flat[indices], indices)
+        self.assertIsInstance(wrapped, CollatedObs)
+        self.assertEqual(wrapped.shape, (3, obs.shape[-1]))
+        self._assertBatchesEqual(wrapped.graphs, Batch.from_data_list(list(flat[indices, graph_idx])))
+
+        # The collated graphs are reused while the same graphs are requested, including when the observation
+        # array is overwritten in place, as the replay buffers do.
+        collated = collator(obs)
+        self.assertIs(collator(obs), collated)
+        obs[0, 0, graph_idx] = self.graphs[-1]
+        self.assertIsNot(collator(obs), collated)
+        self._assertBatchesEqual(collator(obs).batch([0]), Batch.from_data_list([self.graphs[-1]]))
+
+
+class TestUniqueGraphs(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        obs_space, obs = observations(observation_radius=200)
+        cls.graphs = list(obs[:, get_graph_obs_space_idx(obs_space)])
+
+    def test_repeated_graphs(self):
+        g0, g1, g2 = self.graphs[0], self.graphs[4], self.graphs[8]
+        # An equal copy is merged like the same object, while a graph of the same size with one different feature is not.
+        changed = g2.clone()
+        changed.x[0, 2] += 1.0
+        batch = Batch.from_data_list([g0, g1, g0, g2, g1, g0, g2.clone(), changed])
+        unique, inverse = unique_graphs(batch)
+
+        self.assertEqual(inverse.tolist(), [0, 1, 0, 2, 1, 0, 2, 3])
+        expected = Batch.from_data_list([g0, g1, g2, changed])
+        self.assertEqual(unique.num_graphs, expected.num_graphs)
+        for key in ["x", "edge_attr", "edge_index", "batch", "ptr"]:
+            torch.testing.assert_close(unique[key], expected[key], rtol=0, atol=0, msg=key)
+
+        # Expanding the dense node features of the unique graphs gives those of the whole batch.
+        dense, _ = to_dense_batch(unique.x, unique.batch)
+        expectedDense, _ = to_dense_batch(batch.x, batch.batch)
+        torch.testing.assert_close(dense[inverse], expectedDense, rtol=0, atol=0)
+
+    def test_distinct_graphs(self):
+        batch = Batch.from_data_list(self.graphs)
+        unique, inverse = unique_graphs(batch)
+        distinct = len(set((tuple(g.x.flatten().tolist()), tuple(g.edge_attr.flatten().tolist()), tuple(g.edge_index.flatten().tolist())) for g in self.graphs))
+        self.assertEqual(unique.num_graphs, distinct)
+        for i, g in enumerate(self.graphs):
+            u = int(inverse[i])
+            nodes = slice(int(unique.ptr[u]), int(unique.ptr[u + 1]))
+            torch.testing.assert_close(unique.x[nodes], g.x, rtol=0, atol=0)
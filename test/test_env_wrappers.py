@@ -0,0 +1,169 @@
+import unittest
+
+import numpy as np
+from gymnasium import spaces
+
+from onpolicy.envs.env_wrappers import SubprocVecEnv, SharedMemorySubprocVecEnv, MultiEnvSubprocVecEnv
+
+
+class CountingEnv(object):
+    ''' A cheap environment whose observations, rewards and infos identify the environment, episode and step. '''
+
+    def __init__(self, rank, num_agents=2, episode_length=3):
+        self.rank = rank
+        self.num_agents = num_agents
+        self.episode_length = episode_length
+        self.rng = np.random.default_rng(rank)
+        self.episode = -1
+        self.t = 0
+        self.observation_space = [spaces.Box(-np.inf, np.inf, (4,), dtype=np.float32)] * num_agents
+        self.share_observation_space = [spaces.Box(-np.inf, np.inf, (2,), dtype=np.float32)] * num_agents
+        self.action_space = [spaces.Discrete(3)] * num_agents
+
+    def _obs(self):
+        obs = np.zeros((self.num_agents, 4), dtype=np.float32)
+        obs[:, 0] = self.rank
+        obs[:, 1] = self.episode
+        obs[:, 2] = self.t
+        obs[:, 3] = self.rng.random(self.num_agents)
+        share_obs = np.repeat(obs[None, 0, :2], self.num_agents, axis=0)
+        return {"obs": obs, "share_obs": share_obs}
+
+    def reset(self):
+        self.episode += 1
+        self.t = 0
+        return self._obs()
+
+    def step(self, action):
+        self.t += 1
+        action = np.asarray(action)
+        reward = (100 * self.rank + 10 * self.t + action + self.rng.random(self.num_agents)).astype(np.float32)[:, None]
+        done = np.full(self.num_agents, self.t >= self.episode_length)
+        info = {"rank": self.rank, "episode": self.episode, "t": self.t, "action": action.tolist()}
+        return self._obs(), reward, done, info
+
+    def close(self):
+        pass
+
+
+def make_env(rank):
+    def init_env():
+        return CountingEnv(rank)
+    return init_env
+
+
+class TestMultiEnvSubprocVecEnv(unittest.TestCase):
+
+    NUM_ENVS = 5
+
+    def _assertStep(self, results, indices, actions, step):
+        ''' Check the results of stepping the given environments with the given actions for the step-th time. '''
+        episode_length = 3
+        obs, rewards, dones, infos = results
+        self.assertEqual(len(obs), len(indices))
+        for k, (i, action) in enumerate(zip(indices, actions)):
+            episode, t = divmod(step, episode_length)
+            self.assertEqual(infos[k], {"rank": i, "episode": episode, "t": t + 1, "action": action})
+            np.testing.assert_array_equal(rewards[k][:, 0].astype(int), 100 * i + 10 * (t + 1) + np.array(action))
+            done = t + 1 == episode_length
+            np.testing.assert_array_equal(dones[k], [done, done])
+            # A finished environment is reset straight away, so its observation is the first of the next episode.
+            np.testing.assert_array_equal(obs[k]["obs"][:, :3], [[i, episode + done, 0 if done else t + 1]] * 2)
+
+    def test_subsets_waited_in_reverse(self):
+        envs = MultiEnvSubprocVecEnv([make_env(i) for i in range(self.NUM_ENVS)], envs_per_worker=2)
+        try:
+            self.assertEqual(envs.worker_envs, [[0, 1], [2, 3], [4]])
+            obs = envs.reset()
+            for i in range(self.NUM_ENVS):
+                np.testing.assert_array_equal(obs[i]["obs"][:, :3], [[i, 0, 0]] * 2)
+
+            # Both subsets span the first two workers, and the second is waited for first.
+            first, second = [0, 2, 4], [3, 1]
+            for step in range(7):
+                firstActions = [[step % 3, i % 3] for i in first]
+                secondActions = [[(step + 1) % 3, (i + 1) % 3] for i in second]
+                envs.step_async_subset(firstActions, first)
+                envs.step_async_subset(secondActions, second)
+                self._assertStep(envs.step_wait_subset(second), second, secondActions, step)
+                self._assertStep(envs.step_wait_subset(first), first, firstActions, step)
+
+            # Stepping all environments still works after the subsets.
+            actions = [[0, 0]] * self.NUM_ENVS
+            envs.step_async(actions)
+            self._assertStep(envs.step_wait(), list(range(self.NUM_ENVS)), actions, 7)
+        finally:
+            envs.close()
+
+    def test_matches_one_env_per_worker(self):
+        def run(envs_per_worker):
+            envs = MultiEnvSubprocVecEnv([make_env(i) for i in range(self.NUM_ENVS)], envs_per_worker=envs_per_worker)
+            try:
+                out = [envs.reset()]
+                for step in range(5):
+                    out.append(envs.step([[step % 3, (step + i) % 3] for i in range(self.NUM_ENVS)]))
+                return out
+            finally:
+                envs.close()
+
+        expected, actual = run(1), run(3)
+        np.testing.assert_array_equal([o["obs"] for o in actual[0]], [o["obs"] for o in expected[0]])
+        for (obs, rewards, dones, infos), (eObs, eRewards, eDones, eInfos) in zip(actual[1:], expected[1:]):
+            np.testing.assert_array_equal([o["obs"] for o in obs], [o["obs"] for o in eObs])
+            np.testing.assert_array_equal(rewards, eRewards)
+            np.testing.assert_array_equal(dones, eDones)
+            self.assertEqual(infos, eInfos)
+
+
+class TestSharedMemorySubprocVecEnv(unittest.TestCase):
+
+    NUM_ENVS = 4
+
+    def _run(self, cls):
+        envs = cls([make_env(i) for i in range(self.NUM_ENVS)])
+        try:
+            out = [envs.reset()]
+            for step in range(4):
+                out.append(envs.step([[step % 3, (step + i) % 3] for i in range(self.NUM_ENVS)]))
+            for step in range(4):
+                first, second = [1, 3], [2, 0]
+                envs.step_async_subset([[step % 3, i % 3] for i in first], first)
+                envs.step_async_subset([[(step + 1) % 3, i % 3] for i in second], second)
+                out.append(envs.step_wait_subset(first))
+                out.append(envs.step_wait_subset(second))
+            out.append(envs.reset())
+            return out
+        finally:
+            envs.close()
+
+    def _assertObsEqual(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        for a, e in zip(actual, expected):
+            self.assertEqual(a.keys(), e.keys())
+            for k in e:
+                np.testing.assert_array_equal(a[k], e[k])
+                self.assertEqual(a[k].dtype, e[k].dtype)
+
+    def test_matches_subproc_vec_env(self):
+        expected = self._run(SubprocVecEnv)
+        actual = self._run(SharedMemorySubprocVecEnv)
+        self.assertEqual(len(actual), len(expected))
+        self._assertObsEqual(actual[0], expected[0])
+        self._assertObsEqual(actual[-1], expected[-1])
+        for (obs, rewards, dones, infos), (eObs, eRewards, eDones, eInfos) in zip(actual[1:-1], expected[1:-1]):
+            self._assertObsEqual(obs, eObs)
+            np.testing.assert_array_equal(rewards, eRewards)
+            self.assertEqual(rewards.dtype, eRewards.dtype)
+            np.testing.assert_array_equal(dones, eDones)
+            self.assertEqual(list(infos), list(eInfos))
+
+    def test_obs_not_overwritten_by_next_step(self):
+        envs = SharedMemorySubprocVecEnv([make_env(i) for i in range(self.NUM_ENVS)])
+        try:
+            obs = envs.reset()
+            first = [o["obs"].copy() for o in obs]
+            envs.step([[0, 0]] * self.NUM_ENVS)
+            for o, f in zip(obs, first):
+                np.testing.assert_array_equal(o["obs"], f)
+        finally:
+            envs.close()
@@ -0,0 +1,391 @@
+import copy
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from onpolicy.config import get_config
+from onpolicy.scripts.train.train_sd import parse_args
+from onpolicy.envs.patrolling.SDEnv import SDEnv
+from onpolicy.envs.env_wrappers import DummyVecEnv
+from onpolicy.runner.separated.patrolling_runner import PatrollingRunner
+from onpolicy.utils.separated_buffer import SeparatedReplayBuffer
+from onpolicy.utils.shared_buffer import SharedReplayBuffer
+
+
+THREADS = 4
+AGENTS = 2
+
+
+class DeterministicActor(torch.nn.Module):
+    ''' Wraps an actor so that it always takes the mode of its action distribution. '''
+
+    def __init__(self, actor):
+        super().__init__()
+        self.actor = actor
+
+    def forward(self, obs, rnn_states, masks, available_actions=None, deterministic=False):
+        return self.actor(obs, rnn_states, masks, available_actions, True)
+
+
+def makeRunner(**kwargs):
+    ''' Create a runner over a small vectorized environment, with deterministic actors and fixed seeds. '''
+    args = parse_args(["--graph_file", "sdzoo/env/cumberland.graph",
+                       "--num_agents", str(AGENTS),
+                       "--observe_method", "adjacency",
+                       "--observe_method_global", "adjacency",
+                       "--algorithm_name", "mappo",
+                       "--n_rollout_threads", str(THREADS),
+                       "--episode_length", "8"], get_config())
+    args.skip_steps_async = True
+    args.drop_reward = 5.0
+    args.load_reward = 5.0
+    args.step_reward = 10.0
+    args.state_reward = 20.0
+    args.step_penalty = 0.1
+    args.agent_max_capacity = 1
+    args.data_chunk_length = 2
+    args.use_wandb = False
+    for k, v in kwargs.items():
+        setattr(args, k, v)
+
+    def makeEnv(rank):
+        def init():
+            env = SDEnv(args)
+            env.seed(rank)
+            return env
+        return init
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    envs = DummyVecEnv([makeEnv(i) for i in range(THREADS)])
+    runner = PatrollingRunner({
+        "all_args": args,
+        "envs": envs,
+        "eval_envs": None,
+        "num_agents": AGENTS,
+        "device": torch.device("cpu"),
+        "run_dir": Path(tempfile.mkdtemp()),
+    })
+    for po in runner.policy:
+        if not isinstance(po.actor, DeterministicActor):
+            po.actor = DeterministicActor(po.actor)
+    return runner
+
+
+def rollout(runner):
+    ''' Run a single episode and return a copy of the buffer it filled, without training on it. '''
+    filled = []
+    runner.num_env_steps = runner.episode_length * runner.n_rollout_threads
+    runner.compute = lambda: filled.append(copy.deepcopy(runner.buffer))
+    runner.train = lambda: {}
+    runner.save = lambda: None
+    runner.log_interval = np.inf
+    runner.run()
+    return filled[0]
+
+
+class TestPipelinedRollout(unittest.TestCase):
+    ''' Checks that overlapping inference with environment stepping does not change the rollout. '''
+
+    def _assertRolloutsMatch(self, **kwargs):
+        expected = rollout(makeRunner(pipelined_rollout=False, **kwargs))
+        actual = rollout(makeRunner(pipelined_rollout=True, **kwargs))
+
+        np.testing.assert_array_equal(actual.steps, expected.steps)
+        self.assertEqual(actual.critic_step, expected.critic_step)
+        for i in range(THREADS):
+            for agent_id in range(AGENTS):
+                rowsExpected = expected.segments()[i * AGENTS + agent_id]
+                rowsActual = actual.segments()[i * AGENTS + agent_id]
+                for name in ("obs", "share_obs", "actions", "rewards", "masks", "deltaSteps", "available_actions"):
+                    np.testing.assert_array_equal(getattr(actual, name)[rowsActual], getattr(expected, name)[rowsExpected],
+                                                  err_msg=f"{name} of thread {i}, agent {agent_id}")
+                for name in ("value_preds", "action_log_probs", "rnn_states", "rnn_states_critic"):
+                    np.testing.assert_allclose(getattr(actual, name)[rowsActual], getattr(expected, name)[rowsExpected],
+                                               rtol=1e-5, atol=1e-5, err_msg=f"{name} of thread {i}, agent {agent_id}")
+
+        # The agents should have acted at different paces for the comparison to be meaningful.
+        self.assertGreater(len(np.unique(expected.steps)), 1)
+
+    def test_centralized_critic(self):
+        self._assertRolloutsMatch(use_centralized_V=True)
+
+    def test_local_critics(self):
+        self._assertRolloutsMatch(use_centralized_V=False)
+
+
+class TestBatchedCollect(unittest.TestCase):
+    ''' Checks that sampling the shared actor for all ready pairs at once matches sampling each pair on its own. '''
+
+    def _assertCollectMatches(self, **kwargs):
+        runner = makeRunner(**kwargs)
+        # Collect from the state the agents are in at the end of an episode.
+        rollout(runner)
+        runner.ready = np.array([[True, False], [True, True], [False, True], [False, False]])
+
+        runner.all_args.sep_share_policy = True
+        actual = runner.collect(0)
+        runner.all_args.sep_share_policy = False
+        expected = runner.collect(0)
+
+        names = ("values", "actions", "action_log_probs", "rnn_states", "rnn_states_critic")
+        for name, listsExpected, listsActual in zip(names, expected[:-1], actual[:-1]):
+            for i in range(THREADS):
+                for agent_id in range(AGENTS):
+                    e, a = listsExpected[i][agent_id], listsActual[i][agent_id]
+                    if e is None:
+                        self.assertIsNone(a, f"{name} of thread {i}, agent {agent_id}")
+                    else:
+                        np.testing.assert_allclose(a, e, rtol=1e-5, atol=1e-6, err_msg=f"{name} of thread {i}, agent {agent_id}")
+        np.testing.assert_array_equal(actual[-1], expected[-1])
+
+    def test_centralized_critic(self):
+        self._assertCollectMatches(use_centralized_V=True)
+
+    def test_local_critics(self):
+        self._assertCollectMatches(use_centralized_V=False)
+
+
+class PerPairInsert(object):
+    '''
+    The asynchronous insert of the runner before it was vectorized, which looped over the (thread, agent) pairs,
+    inserted into a separated buffer per pair and updated the env infos on every step.
+    '''
+
+    def __init__(self, runner):
+        self.all_args = runner.all_args
+        self.use_centralized_V = runner.use_centralized_V
+        self.n_rollout_threads = runner.n_rollout_threads
+        self.num_agents = runner.num_agents
+        self.recurrent_N = runner.recurrent_N
+        self.hidden_size = runner.hidden_size
+        self.env_infos = {}
+
+        envs = runner.envs
+        self.buffer = [[] for i in range(self.n_rollout_threads)]
+        for i in range(self.n_rollout_threads):
+            for agent_id in range(self.num_agents):
+                share_observation_space = envs.share_observation_space[agent_id] if self.use_centralized_V else envs.observation_space[agent_id]
+                args = copy.deepcopy(self.all_args)
+                args.n_rollout_threads = 1
+                args.episode_length *= self.num_agents * self.n_rollout_threads
+                buf = SeparatedReplayBuffer(args, envs.observation_space[agent_id], share_observation_space, envs.action_space[agent_id])
+
+                # Start from the state the runner was warmed up with.
+                buf.share_obs[0] = runner.buffer.cur_share_obs[i, agent_id]
+                buf.obs[0] = runner.buffer.cur_obs[i, agent_id]
+                buf.available_actions[0] = runner.buffer.cur_available_actions[i, agent_id]
+                self.buffer[i].append(buf)
+
+        if self.use_centralized_V:
+            args = copy.deepcopy(self.all_args)
+            args.episode_length *= self.n_rollout_threads * self.num_agents
+            self.critic_buffer = SharedReplayBuffer(args, self.num_agents, envs.observation_space[0],
+                                                    envs.share_observation_space[0], envs.action_space[0])
+            self.critic_buffer.share_obs[0] = runner.buffer.critic_share_obs
+
+    def insert(self, data, data_critic):
+
+        # Split data.
+        obs, share_obs, rewards, dones, infos, values, actions, action_log_probs, rnn_states, rnn_states_critic, delta_steps, available_actions = data
+
+        if self.use_centralized_V:
+            if data_critic == None:
+                data_critic = data
+
+            c_insert_required = False
+
+            # Split data.
+            c_obs, c_share_obs, c_rewards, c_dones, c_infos, c_values, c_actions, c_action_log_probs, c_rnn_states, c_rnn_states_critic, c_delta_steps, c_available_actions = data_critic
+            c_share_obs = share_obs.copy()
+
+        # Add the total state information to env infos.
+        self.env_infos["total_state"] = [i["total_state"] for i in infos]
+        self.env_infos["agent_count"] = [i["agent_count"] for i in infos]
+
+        # Add the number of nodes visited to env infos.
+        for n in range(len(infos[0]["node_visits"])):
+            self.env_infos[f"node_visits/node_{n}"] = [i["node_visits"][n] for i in infos]
+
+        # Reset RNN and mask arguments for done agents/envs.
+        masks = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
+        for i in range(self.n_rollout_threads):
+            for agent_id in range(self.num_agents):
+                if dones[i, agent_id]:
+                    rnn_states[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
+                    rnn_states_critic[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
+                    masks[i, agent_id] = np.zeros(1, dtype=np.float32)
+
+        for i in range(self.n_rollout_threads):
+            for agent_id in range(self.num_agents):
+                # Only insert if the agent is ready for a new action.
+                if self.ready[i, agent_id]:
+                    if self.use_centralized_V:
+                        s_obs = share_obs[i][agent_id]
+                        c_insert_required = True
+                    else:
+                        s_obs = np.array(list(obs[i, agent_id]))
+
+                    self.buffer[i][agent_id].insert(
+                        share_obs = s_obs,
+                        obs = obs[i, agent_id],
+                        rnn_states = rnn_states[i][agent_id],
+                        rnn_states_critic = rnn_states_critic[i][agent_id],
+                        actions = actions[i][agent_id],
+                        action_log_probs = action_log_probs[i][agent_id],
+                        value_preds = values[i][agent_id],
+                        rewards = rewards[i, agent_id],
+                        masks = masks[i, agent_id],
+                        deltaSteps = delta_steps[i, agent_id],
+                        criticStep = np.array(self.critic_buffer.step) if self.use_centralized_V else np.array(self.buffer[i][agent_id].step),
+                        no_reset = True,
+                        available_actions = available_actions[i, agent_id]
+                    )
+
+                # If we are using a shared critic, update the critic data.
+                if self.use_centralized_V:
+                    # Update these regardless of whether the agent was skipped.
+                    c_obs[i, agent_id] = obs[i, agent_id]
+                    c_share_obs[i, agent_id] = share_obs[i, agent_id]
+                    c_rewards[i, agent_id] = rewards[i, agent_id]
+                    c_values[i][agent_id] = values[i][agent_id]
+                    c_rnn_states_critic[i][agent_id] = rnn_states_critic[i][agent_id]
+
+                    # Only update these if the agent was not skipped.
+                    if actions[i][agent_id] is not None:
+                        c_rnn_states[i][agent_id] = rnn_states[i][agent_id]
+                        c_actions[i][agent_id] = actions[i][agent_id]
+                        c_action_log_probs[i][agent_id] = action_log_probs[i][agent_id]
+
+        # If we are using a shared critic, insert the critic data.
+        if self.use_centralized_V:
+            if c_insert_required:
+                # Reset RNN and mask arguments for done agents/envs.
+                c_masks = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.float32)
+                for i in range(self.n_rollout_threads):
+                    for agent_id in range(self.num_agents):
+                        if dones[i, agent_id]:
+                            c_rnn_states[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
+                            c_rnn_states_critic[i][agent_id] = np.zeros((self.recurrent_N, self.hidden_size), dtype=np.float32)
+                            c_masks[i, agent_id] = np.zeros((1, 1), dtype=np.float32)
+
+                self.critic_buffer.insert(
+                    share_obs=np.array(c_share_obs),
+                    obs=np.array(c_obs),
+                    rnn_states=np.array(c_rnn_states),
+                    rnn_states_critic=np.array(c_rnn_states_critic),
+                    actions=np.array(c_actions),
+                    action_log_probs=np.array(c_action_log_probs),
+                    value_preds=np.array(c_values),
+                    rewards=np.array(c_rewards),
+                    masks=c_masks,
+                    deltaSteps=np.array(c_delta_steps),
+                    no_reset=True
+                )
+
+                c_delta_steps = np.ones((self.n_rollout_threads, self.num_agents, 1), dtype=np.int32)
+
+            # If critic update not required, increment the step counter.
+            else:
+                c_delta_steps += 1
+
+            # Update the previous data.
+            data_critic = c_obs, c_share_obs, c_rewards, c_dones, c_infos, c_values, c_actions, c_action_log_probs, c_rnn_states, c_rnn_states_critic, c_delta_steps, c_available_actions
+
+        return data_critic
+
+
+class TestInsert(unittest.TestCase):
+    ''' Checks the vectorized insert against the per-pair insert it replaced. '''
+
+    STEPS = 12
+
+    def _steps(self, runner, seed=0):
+        ''' Generate step data as the rollout loop passes it to insert(), with mixed done and ready flags. '''
+        rng = np.random.default_rng(seed)
+        pairs = (THREADS, AGENTS)
+        hidden = (runner.recurrent_N, runner.hidden_size)
+        cur = runner.buffer
+
+        def random(*shape):
+            return rng.standard_normal((*pairs, *shape)).astype(np.float32)
+
+        for step in range(self.STEPS):
+            ready = rng.random(pairs) < 0.6
+            # No agent acts on some step, so the critic is not updated.
+            if step == 3:
+                ready[:] = False
+            dones = rng.random(pairs) < 0.25
+            infos = [{"total_state": float(rng.random()),
+                      "agent_count": int(rng.integers(0, 5)),
+                      "node_visits": list(rng.integers(0, 5, 6))} for i in range(THREADS)]
+            data = (
+                rng.random((*pairs, *cur.cur_obs.shape[2:])).astype(np.float32),
+                rng.random((*pairs, *cur.cur_share_obs.shape[2:])).astype(np.float32),
+                random(1),
+                dones,
+                infos,
+                random(1),
+                rng.integers(0, 4, (*pairs, 1)).astype(np.int32),
+                random(1),
+                random(*hidden),
+                random(*hidden),
+                rng.integers(1, 4, (*pairs, 1)).astype(np.int32),
+                (rng.random((*pairs, *cur.cur_available_actions.shape[2:])) < 0.7).astype(np.float32),
+            )
+            yield ready, data
+
+    def _assertInsertMatches(self, **kwargs):
+        runner = makeRunner(**kwargs)
+        runner.warmup()
+        reference = PerPairInsert(runner)
+
+        data_critic = None
+        data_critic_reference = None
+        for ready, data in self._steps(runner):
+            runner.ready = ready
+            reference.ready = ready
+            data_critic = runner.insert(copy.deepcopy(data), data_critic)
+            data_critic_reference = reference.insert(copy.deepcopy(data), data_critic_reference)
+        runner._update_env_infos(data[4])
+
+        # The env infos are only recorded for the last step of the episode.
+        self.assertEqual(dict(runner.env_infos), reference.env_infos)
+
+        buf = runner.buffer
+        self.assertGreater(len(np.unique(buf.steps)), 1)
+        for i in range(THREADS):
+            for agent_id in range(AGENTS):
+                expected = reference.buffer[i][agent_id]
+                rows = buf.segments()[i * AGENTS + agent_id]
+                step = expected.step
+                self.assertEqual(len(rows), step)
+                for name in ("share_obs", "obs", "rnn_states", "rnn_states_critic", "masks", "available_actions"):
+                    # State fields hold the state each transition started from, and the current state after the last.
+                    np.testing.assert_array_equal(getattr(buf, name)[rows], getattr(expected, name)[:step, 0], err_msg=name)
+                    np.testing.assert_array_equal(getattr(buf, "cur_" + name)[i, agent_id], getattr(expected, name)[step, 0], err_msg=name)
+                for name in ("actions", "action_log_probs", "value_preds", "rewards", "deltaSteps", "criticStep"):
+                    np.testing.assert_array_equal(getattr(buf, name)[rows], getattr(expected, name)[:step, 0], err_msg=name)
+
+        if runner.use_centralized_V:
+            critic = reference.critic_buffer
+            self.assertEqual(buf.critic_step, critic.step)
+            np.testing.assert_array_equal(buf.critic_share_obs, critic.share_obs[critic.step])
+            np.testing.assert_array_equal(buf.critic_rnn_states, critic.rnn_states_critic[critic.step])
+            np.testing.assert_array_equal(buf.critic_masks, critic.masks[critic.step])
+            for actual, expected in zip(data_critic, data_critic_reference):
+                if isinstance(expected, np.ndarray):
+                    np.testing.assert_array_equal(np.array(actual), np.array(expected))
+
+    def test_centralized_critic(self):
+        self._assertInsertMatches(use_centralized_V=True)
+
+    def test_local_critics(self):
+        self._assertInsertMatches(use_centralized_V=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
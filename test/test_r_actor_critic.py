@@ -0,0 +1,73 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+from torch_geometric.data import Batch
+
+from onpolicy.utils.util import get_graph_obs_space_idx
+from onpolicy.utils.collated_graphs import CollatedGraphs
+from onpolicy.algorithms.r_mappo.algorithm.r_actor_critic import R_Actor
+from test.test_collated_graphs import observations
+
+
+class TestGatherScores(unittest.TestCase):
+    ''' Checks the batched gather of neighbor and load/drop scores against a loop over the graphs. '''
+
+    MAX_NEIGHBORS = 15
+    MAX_NODES = 50
+
+    def _referenceScores(self, graphs, scores, load_drop_scores):
+        # Per-graph loop that _gatherScores replaced.
+        scores_shifted = torch.zeros((graphs.num_graphs, self.MAX_NEIGHBORS))
+        for i in range(graphs.num_graphs):
+            if graphs.agent_edge[i][0] is not None:
+                nbrs = torch.tensor(graphs.neighbors[i], dtype=torch.long)
+            else:
+                # If the agent is on a node, the first neighbor is the current node, so ignore its score.
+                nbrs = torch.tensor(graphs.neighbors[i][1:], dtype=torch.long)
+            scores_shifted[i, :nbrs.shape[0]] = scores[i, nbrs, 0]
+
+        ld_scores_shifted = torch.zeros((graphs.num_graphs, 2))
+        for i in range(graphs.num_graphs):
+            ld_scores_shifted[i, :] = load_drop_scores[i, graphs.agent_idx[i], :]
+        return scores_shifted, ld_scores_shifted
+
+    def _assertMatches(self, max_neighbors):
+        obs_space, obs = observations(steps=10, observation_radius=200, max_neighbors=max_neighbors)
+        graph_list = list(obs[:, get_graph_obs_space_idx(obs_space)])
+        graphs = Batch.from_data_list(graph_list)
+        self.assertEqual(tuple(graphs.neighbor_idx.shape), (graphs.num_graphs, max_neighbors))
+
+        # Cover agents on nodes and on edges, and rows padded with -1.
+        onEdge = [e[0] is not None for e in graphs.agent_edge]
+        self.assertTrue(any(onEdge) and not all(onEdge))
+        self.assertTrue(torch.any(graphs.neighbor_idx == -1))
+
+        generator = torch.Generator().manual_seed(max_neighbors)
+        scores = torch.randn((graphs.num_graphs, self.MAX_NODES, 1), generator=generator)
+        load_drop_scores = torch.randn((graphs.num_graphs, self.MAX_NODES, 2), generator=generator)
+
+        actor = SimpleNamespace(device=torch.device("cpu"), MAX_NEIGHBORS=self.MAX_NEIGHBORS)
+        scores_shifted, ld_scores_shifted = R_Actor._gatherScores(actor, graphs, scores, load_drop_scores)
+        expected_scores, expected_ld_scores = self._referenceScores(graphs, scores, load_drop_scores)
+
+        self.assertEqual(tuple(scores_shifted.shape), (graphs.num_graphs, self.MAX_NEIGHBORS))
+        torch.testing.assert_close(scores_shifted, expected_scores, rtol=0, atol=0)
+        torch.testing.assert_close(ld_scores_shifted, expected_ld_scores, rtol=0, atol=0)
+
+        # The graphs batched by the replay buffers give the same scores.
+        collated = CollatedGraphs(graph_list).batch(range(len(graph_list)))
+        collated_scores, collated_ld_scores = R_Actor._gatherScores(actor, collated, scores, load_drop_scores)
+        torch.testing.assert_close(collated_scores, scores_shifted, rtol=0, atol=0)
+        torch.testing.assert_close(collated_ld_scores, ld_scores_shifted, rtol=0, atol=0)
+
+        # The padding scores nothing, rather than the node (0) it is clamped to.
+        padded = torch.nn.functional.pad(graphs.neighbor_idx, (0, self.MAX_NEIGHBORS - max_neighbors), value=-1) == -1
+        self.assertTrue(torch.all(scores_shifted[padded] == 0.0))
+
+    def test_full_width_neighbor_idx(self):
+        self._assertMatches(self.MAX_NEIGHBORS)
+
+    def test_narrow_neighbor_idx(self):
+        # Narrower rows are padded with -1 up to MAX_NEIGHBORS.
+        self._assertMatches(5)
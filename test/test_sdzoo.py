@@ -1,6 +1,7 @@
 import unittest
+import numpy as np
 from pettingzoo.test import parallel_api_test
-from sdzoo.sdzoo_v0 import SDGraph, parallel_env
+from sdzoo.sdzoo_v0 import SDGraph, SDBatchEnv, parallel_env
 
 class TestEnvironment(unittest.TestCase):
 
@@ -83,6 +84,429 @@ class TestEnvironment(unittest.TestCase):
         pathLen = env._getAgentPathLength(agent, path)
         self.assertEqual(pathLen, 20.0)
     
+    def test_shortest_path_table(self):
+        import networkx as nx
+        graph = SDGraph("sdzoo/env/cumberland.graph")
+        lengths = dict(nx.all_pairs_dijkstra_path_length(graph.graph, weight="weight"))
+        for i in graph.graph.nodes:
+            for j in graph.graph.nodes:
+                self.assertAlmostEqual(graph.getShortestPathLength(i, j), lengths[i][j])
+                path = graph.getShortestPath(i, j)
+                self.assertEqual(path[0], i)
+                self.assertEqual(path[-1], j)
+                self.assertAlmostEqual(nx.path_weight(graph.graph, path, weight="weight"), lengths[i][j])
+        self.assertAlmostEqual(graph.longestPathLength, max(max(d.values()) for d in lengths.values()))
+    
+    def test_incremental_totals(self):
+        graph = SDGraph("sdzoo/env/9nodes.graph")
+        depot = next(n for n in graph.graph.nodes if graph.isDepot(n) and graph.getNodePayloads(n) > 0)
+        needy = next(n for n in graph.graph.nodes if graph.getNodePeople(n) > 0)
+
+        graph.takePayloads(depot, 1)
+        graph.putPayloads(needy, 1)
+        self.assertEqual(graph.getTotalDeficit(), int(graph.nodeDeficit.sum()))
+        self.assertEqual(graph.getTotalSurplus(), int(graph.nodeSurplus.sum()))
+        self.assertEqual(graph.getTotalDeficit(), sum(max(graph.getNodePeople(n) - graph.getNodePayloads(n), 0) for n in graph.graph.nodes))
+
+        graph.reset()
+        self.assertEqual(graph.getTotalDeficit(), int(graph.nodeDeficit.sum()))
+        self.assertEqual(graph.getTotalSurplus(), int(graph.nodeSurplus.sum()))
+
+    def test_graph_cache(self):
+        import os, shutil, tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cumberland.graph")
+            shutil.copy("sdzoo/env/cumberland.graph", path)
+            parsed = SDGraph(path)
+            self.assertTrue(os.path.exists(path + ".npz"))
+            cached = SDGraph(path)
+
+            self.assertEqual(list(parsed.graph.edges.data()), list(cached.graph.edges.data()))
+            for node in parsed.graph.nodes:
+                self.assertEqual(list(parsed.graph.neighbors(node)), list(cached.graph.neighbors(node)))
+            self.assertTrue(np.array_equal(parsed.shortestPathLengths, cached.shortestPathLengths))
+            self.assertTrue(np.array_equal(parsed.nodePayloads, cached.nodePayloads))
+            self.assertEqual(parsed.getTotalDeficit(), cached.getTotalDeficit())
+
+            # A cache for other file contents or another cache version is rebuilt.
+            with open(path, "a") as file:
+                file.write("\n")
+            np.savez(path + ".npz", version=-1)
+            self.assertEqual(SDGraph(path).graph.number_of_nodes(), parsed.graph.number_of_nodes())
+            self.assertEqual(str(np.load(path + ".npz")["version"]), "1")
+
+    def test_spatial_queries(self):
+        graph = SDGraph("sdzoo/env/cumberland.graph")
+        positions = graph.nodePositions
+        points = [graph.getNodePosition(n) for n in graph.graph.nodes] + [(500.0, 300.0), (0.0, 0.0), (640.5, 250.25)]
+        for pos in points:
+            dist = np.sqrt(np.power(positions[:, 0] - pos[0], 2) + np.power(positions[:, 1] - pos[1], 2))
+            self.assertEqual(graph.getNearestNode(pos), int(np.argmin(dist)))
+            for radius in [0.0, 40.0, 150.0, np.inf]:
+                self.assertTrue((graph.getNodesInRadius(pos, radius) == (dist <= radius)).all())
+        self.assertIsNone(graph.getNearestNode((-1000.0, -1000.0), epsilon=1.0))
+
+    def test_state_beliefs(self):
+        graph = SDGraph("sdzoo/env/cumberland.graph")
+        env = parallel_env(graph, num_agents=2, observation_radius=100.0)
+        env.reset(seed=42)
+        agent = env.agents[0]
+        self.assertEqual(env.stateBeliefs.shape, (2, env.max_nodes, 2))
+        self.assertIs(agent.stateBelief.base, env.stateBeliefs)
+
+        # Only nodes within the observation radius are believed, and they match the true state.
+        visible = env._getVisibleNodes(agent, agent.observationRadius)
+        nodes = [n for n in graph.graph.nodes if visible[n]]
+        for n in graph.graph.nodes:
+            expected = [graph.getNodeDeficit(n), graph.getNodeSurplus(n)] if visible[n] else [-1.0, -1.0]
+            self.assertEqual(agent.stateBelief[n].tolist(), expected)
+
+        # A change to a visible node is picked up on the next observation.
+        node = next(n for n in nodes if graph.getNodePeople(n) > graph.getNodePayloads(n))
+        graph.putPayloads(node, 1)
+        env.observe(agent)
+        self.assertEqual(agent.stateBelief[node].tolist(), [graph.getNodeDeficit(node), graph.getNodeSurplus(node)])
+    
+    def test_pyg_observation(self):
+        graph = SDGraph("sdzoo/env/cumberland.graph")
+        env = parallel_env(graph, num_agents=3, observe_method="pyg")
+        obs, _ = env.reset(seed=42)
+        data = obs[env.agents[0]][-1]
+        numNodes = graph.graph.number_of_nodes()
+
+        numAgents = len(env.agents)
+        self.assertEqual(data.x.shape, (numNodes + numAgents, 8))
+        self.assertEqual(data.edge_attr.shape, (data.edge_index.shape[1], 2))
+
+        # The degree feature matches the out-degree of each node.
+        self.assertTrue((data.x[:, 2].long() == data.edge_index[0].bincount(minlength=numNodes + numAgents)).all())
+
+        # Every edge of the patrol graph is present in both directions.
+        edges = set(map(tuple, data.edge_index.t().tolist()))
+        order = list(graph.graph.nodes)
+        for i, j in graph.graph.edges:
+            self.assertIn((order.index(i), order.index(j)), edges)
+            self.assertIn((order.index(j), order.index(i)), edges)
+
+        # The padded neighbor indices list the scored neighbors, skipping the current node.
+        self.assertEqual(data.neighbor_idx.shape, (1, env.max_neighbors))
+        scored = data.neighbor_idx[0][data.neighbor_idx[0] >= 0].tolist()
+        self.assertEqual(scored, data.neighbors[1:] if data.agent_edge[0] is None else data.neighbors)
+
+    def _referencePygGraph(self, env, agent, agents, vertices):
+        ''' Builds the graph observation as it was built before the topology was cached, by copying the patrol graph,
+            adding the agent nodes and converting it with from_networkx. The node attributes which SDGraph now keeps
+            in arrays are first put back on the copy. '''
+        from copy import deepcopy
+        import networkx as nx
+        from torch_geometric.utils.convert import from_networkx
+        from sdzoo.env.sd_graph import NODE_TYPE
+
+        sdg = env.sdg
+        g = deepcopy(sdg.graph)
+        for node in g.nodes:
+            g.nodes[node].update(pos=sdg.getNodePosition(node), id=sdg.getNodeId(node), nodeType=NODE_TYPE.OBSERVABLE_NODE,
+                                 depot=bool(sdg.nodeDepot[node]), people=int(sdg.nodePeople[node]), payloads=int(sdg.nodePayloads[node]))
+
+        for node in g.nodes:
+            g.nodes[node]["lastNode"] = -1.0
+            g.nodes[node]["currentAction"] = -1.0
+            g.nodes[node]["max_capacity"] = -1.0
+            g.nodes[node]["deficit"] = agent.stateBelief[node][0]
+            g.nodes[node]["surplus"] = agent.stateBelief[node][1]
+            g.nodes[node]["nodeType"] = NODE_TYPE.OBSERVABLE_NODE if node in vertices else NODE_TYPE.UNOBSERVABLE_NODE
+
+        agentsPlusEgo = agents + [agent] if agent not in agents else agents
+        for a in agentsPlusEgo:
+            agent_node_id = f"agent_{a.id}_pos"
+            g.add_node(agent_node_id, pos=a.position, id=-1 - a.id, nodeType=NODE_TYPE.AGENT, people=-1.0, payloads=a.payloads,
+                       max_capacity=a.max_capacity, depot=False, surplus=a.payloads, deficit=-1.0,
+                       lastNode=g.nodes[a.lastNode]["id"] if a.lastNode in g.nodes else -1.0,
+                       currentAction=a.currentAction if a in agents else -1.0)
+            if a.edge is None:
+                g.add_edge(agent_node_id, a.lastNode, weight=0.0)
+                for neighbor in g.neighbors(a.lastNode):
+                    if g.nodes[neighbor]["nodeType"] != NODE_TYPE.AGENT:
+                        g.add_edge(agent_node_id, neighbor, weight=g.edges[(a.lastNode, neighbor)]["weight"])
+            else:
+                node1_id, node2_id = a.edge
+                g.add_edge(agent_node_id, node1_id, weight=env._calculateEdgeWeight(a.position, g.nodes[node1_id]["pos"]))
+                g.add_edge(agent_node_id, node2_id, weight=env._calculateEdgeWeight(a.position, g.nodes[node2_id]["pos"]))
+
+        weights = nx.get_edge_attributes(g, "weight")
+        maxWeight = max(weights.values())
+        minWeight = min(weights.values())
+        for edge in g.edges:
+            g.edges[edge]["weight"] = env._minMaxNormalize(weights[edge], minimum=minWeight, maximum=maxWeight)
+
+        dg = nx.DiGraph(g)
+        if env.action_method == "neighbors":
+            for i in dg.nodes:
+                dg.nodes[i]["degree"] = dg.out_degree(i)
+                idx = 0
+                for j in dg.neighbors(i):
+                    if dg.nodes[j]["nodeType"] == NODE_TYPE.AGENT:
+                        dg.edges[(i, j)]["neighborIndex"] = -1
+                    else:
+                        dg.edges[(i, j)]["neighborIndex"] = idx
+                        idx += 1
+            edge_attrs = ["weight", "neighborIndex"]
+            node_attrs = ["id", "nodeType", "degree", "surplus", "deficit", "max_capacity", "lastNode", "currentAction"]
+        else:
+            edge_attrs = ["weight"]
+            node_attrs = ["id", "nodeType", "lastNode", "currentAction", "surplus", "deficit", "max_capacity"]
+
+        data = from_networkx(dg, group_node_attrs=node_attrs, group_edge_attrs=edge_attrs)
+        data.x = data.x.float()
+        data.edge_attr = data.edge_attr.float()
+
+        nodes = list(g.nodes)
+        ego = agent.lastNode if agent.edge is None else f"agent_{agent.id}_pos"
+        idx = nodes.index(ego)
+        agent_mask = np.zeros(env.max_nodes, dtype=bool)
+        agent_mask[idx] = True
+        data.agent_idx = idx
+        data.agent_mask = agent_mask
+
+        neighbors = [nodes.index(agent.lastNode)] if agent.edge is None else []
+        for neighbor in dg.neighbors(ego):
+            if dg.nodes[neighbor]["nodeType"] != NODE_TYPE.AGENT:
+                neighbors.append(nodes.index(neighbor))
+        nbrMask = np.zeros(env.max_nodes, dtype=bool)
+        nbrMask[neighbors] = True
+        data.neighbors = neighbors
+        data.neighbors_mask = nbrMask
+        data.agent_edge = [agent.edge]
+        return data
+
+    def _assertGraphsEqual(self, data, expected):
+        import torch
+
+        # The padded neighbor indices are the only attribute the reference does not build.
+        self.assertEqual(set(data.keys()), set(expected.keys()) | {"neighbor_idx"})
+        for key in expected.keys():
+            if isinstance(expected[key], torch.Tensor):
+                self.assertEqual(data[key].dtype, expected[key].dtype, key)
+                self.assertTrue(torch.equal(data[key], expected[key]), key)
+            elif isinstance(expected[key], np.ndarray):
+                self.assertTrue(np.array_equal(data[key], expected[key]), key)
+            else:
+                self.assertEqual(data[key], expected[key], key)
+
+    def test_pyg_observation_matches_from_networkx(self):
+        for action_method in ["neighbors", "full"]:
+            env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=20.0, observe_method="pyg",
+                               observation_radius=150.0, action_method=action_method)
+            obs, _ = env.reset(seed=42)
+            chooser = np.random.RandomState(0)
+            onEdge = set()
+            for _ in range(15):
+                for agent in env.agents:
+                    onEdge.add(agent.edge is not None)
+                    agents, vertices = env._observeSurroundings(agent, None, False)
+                    self._assertGraphsEqual(obs[agent][-1], self._referencePygGraph(env, agent, agents, vertices))
+
+                state = env.state_all()
+                for agent in env.possible_agents:
+                    agents, vertices = env._observeSurroundings(agent, np.inf, True)
+                    self._assertGraphsEqual(state[agent][-1], self._referencePygGraph(env, agent, agents, vertices))
+
+                actions = {a: chooser.choice(np.flatnonzero(env.available_actions[a])) for a in env.agents}
+                obs, _, _, _, _ = env.step(actions)
+
+            # The rollout covers agents on nodes and on edges.
+            self.assertEqual(onEdge, {False, True})
+
+    def test_adjacency_observation(self):
+        graph = SDGraph("sdzoo/env/cumberland.graph")
+        env = parallel_env(graph, num_agents=2, observe_method="adjacency")
+        obs, _ = env.reset(seed=42)
+        adjacency = obs[env.agents[0]]["adjacency"]
+
+        self.assertIs(adjacency, obs[env.agents[1]]["adjacency"])
+        self.assertFalse(adjacency.flags.writeable)
+        self.assertTrue((adjacency == adjacency.T).all())
+        self.assertEqual(int((adjacency >= 0.0).sum()), 2 * graph.graph.number_of_edges())
+        self.assertAlmostEqual(float(adjacency.max()), 1.0, places=5)
+
+        # The matrix is only rebuilt when the graph is regenerated.
+        obs, _ = env.reset(seed=43)
+        self.assertIs(obs[env.agents[0]]["adjacency"], adjacency)
+    
+    def test_state_all_shared(self):
+        env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, observe_method="adjacency")
+        env.reset(seed=42)
+        state = env.state_all()
+        shared, ego = env.state_all_shared()
+        for agent in env.possible_agents:
+            self.assertEqual(ego[agent], {"agent_id": agent.id})
+            for k, v in state[agent].items():
+                expected = ego[agent][k] if k in ego[agent] else shared[k]
+                if k == "adjacency":
+                    self.assertTrue(np.array_equal(v, expected))
+                elif isinstance(v, dict):
+                    self.assertEqual(list(v.keys()), list(expected.keys()))
+                    self.assertTrue(all(np.array_equal(v[i], expected[i]) for i in v))
+                else:
+                    self.assertEqual(v, expected)
+
+        pyg = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=2, observe_method="pyg")
+        self.assertRaises(ValueError, pyg.state_all_shared)
+
+    def test_observe_method_none(self):
+        envs = [parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=20.0, observe_method=m) for m in ["pyg", "none"]]
+        results = []
+        for env in envs:
+            obs, _ = env.reset(seed=42)
+            chooser = np.random.RandomState(0)
+            np.random.seed(0)
+            rewards = []
+            for _ in range(50):
+                actions = {a: chooser.choice(np.flatnonzero(env.available_actions[a])) for a in env.possible_agents}
+                obs, reward, done, _, _ = env.step(actions)
+                rewards.append(([reward[a] for a in env.possible_agents], [done[a] for a in env.possible_agents]))
+            results.append((rewards, obs))
+
+        self.assertEqual(results[0][0], results[1][0])
+        self.assertEqual(len(results[0][1]), 3)
+        self.assertEqual(results[1][1], {})
+
+    def test_observe_deferred(self):
+        envs = [parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=20.0, observe_method="pyg", observation_radius=40) for _ in range(2)]
+        for env in envs:
+            env.reset(seed=42)
+        chooser = np.random.RandomState(0)
+
+        for _ in range(20):
+            actions = [chooser.choice(np.flatnonzero(envs[0].available_actions[a])) for a in envs[0].possible_agents]
+            np.random.seed(0)
+            obs, _, _, _, _ = envs[0].step(dict(zip(envs[0].possible_agents, actions)))
+            np.random.seed(0)
+            deferred, _, _, _, _ = envs[1].step(dict(zip(envs[1].possible_agents, actions)), observe=False)
+            self.assertEqual(deferred, {})
+            deferred = envs[1].observeDeferred()
+            for a, b in zip(envs[0].possible_agents, envs[1].possible_agents):
+                self.assertTrue(np.array_equal(obs[a][-1].x, deferred[b][-1].x))
+                self.assertTrue(np.array_equal(obs[a][-1].edge_index, deferred[b][-1].edge_index))
+
+    def test_step_to_next_event(self):
+        env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=5.0, observe_method="pyg", step_penalty=0.1)
+        env.reset(seed=42)
+        np.random.seed(0)
+        for _ in range(5):
+            stepCount = env.step_count
+            actions = {a: np.int64(0) for a in env.agents}
+            obs, rewards, _, _, info = env.stepToNextEvent(actions)
+
+            self.assertEqual(env.step_count - stepCount, info["steps"])
+            self.assertTrue(any(info[a]["ready"] for a in env.agents))
+            self.assertEqual(len(obs), 3)
+            for a in env.possible_agents:
+                self.assertAlmostEqual(rewards[a], -0.1 * info["steps"])
+
+    def _assertSameMoments(self, expected, actual, name):
+        ''' Checks that two samples have the same mean and variance, up to four standard errors. '''
+        n = len(expected)
+        for axis in np.ndindex(expected.shape[1:]):
+            e = expected[(slice(None), *axis)]
+            a = actual[(slice(None), *axis)]
+            se = np.sqrt((e.var() + a.var()) / n) + 1e-9
+            self.assertLess(abs(e.mean() - a.mean()), 4 * se, f"mean of {name}{list(axis)}: {e.mean()} vs {a.mean()}")
+            # The standard error of the variance depends on the fourth central moment.
+            se = np.sqrt((np.mean((e - e.mean()) ** 4) - e.var() ** 2 + np.mean((a - a.mean()) ** 4) - a.var() ** 2) / n) + 1e-9
+            self.assertLess(abs(e.var() - a.var()), 4 * se, f"variance of {name}{list(axis)}: {e.var()} vs {a.var()}")
+
+    def test_step_to_next_event_distribution(self):
+        env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=2.0, observe_method="none")
+        env.reset(seed=42)
+        state = env.get_state()
+        actions = {a: np.int64(0) for a in env.agents}
+
+        def stepUntilReady():
+            steps = 0
+            while True:
+                _, _, done, _, info = env.step(actions, observe=False)
+                steps += 1
+                if any(info[a]["ready"] for a in env.agents) or all(done.values()):
+                    return steps
+
+        def stepToNextEvent():
+            _, _, _, _, info = env.stepToNextEvent(actions, observe=False)
+            return info["steps"]
+
+        # Take the same macro step many times from the same state, with both methods.
+        results = []
+        for method in (stepUntilReady, stepToNextEvent):
+            np.random.seed(0)
+            steps, positions = [], []
+            for _ in range(2000):
+                env.set_state(state, restoreRng=False)
+                steps.append(method())
+                positions.append([a.position for a in env.possible_agents])
+            results.append((np.array(steps, dtype=np.float64)[:, None], np.array(positions)))
+
+        # The agents take many steps to arrive, so a wrong model of the summed per-step noise shows in both.
+        self.assertGreater(results[0][0].mean(), 10)
+        self._assertSameMoments(results[0][0], results[1][0], "steps")
+        self._assertSameMoments(results[0][1], results[1][1], "positions")
+
+    def test_get_set_state(self):
+        env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=20.0, observe_method="pyg", observation_radius=40)
+        env.reset(seed=42)
+
+        def rollout():
+            chooser = np.random.RandomState(0)
+            trace = []
+            for _ in range(20):
+                actions = {a: chooser.choice(np.flatnonzero(env.available_actions[a])) for a in env.agents}
+                obs, rewards, _, _, _ = env.step(actions)
+                trace.append((
+                    [rewards[a] for a in env.possible_agents],
+                    [(a.position, a.edge, a.lastNode, a.payloads) for a in env.possible_agents],
+                    env.sdg.nodePayloads.tolist(),
+                    [obs[a][-1].x.tolist() for a in env.possible_agents]
+                ))
+            return trace
+
+        state = env.get_state()
+        first = rollout()
+        env.set_state(state)
+        self.assertEqual(env.step_count, 0)
+        self.assertEqual(rollout(), first)
+
+    def test_batch_env_matches_parallel_env(self):
+        env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, speed=20.0)
+        batch = SDBatchEnv(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, num_envs=1, speed=20.0, auto_reset=False)
+        env.reset(seed=42)
+        batch.reset(seed=42)
+        chooser = np.random.RandomState(0)
+
+        for _ in range(100):
+            masks = np.stack([env.available_actions[a] for a in env.possible_agents])
+            np.testing.assert_array_equal(masks, batch.available_actions[0])
+            actions = np.array([chooser.choice(np.flatnonzero(m)) for m in masks])
+
+            np.random.seed(0)
+            _, rewards, _, _, _ = env.step({a: actions[i] for i, a in enumerate(env.possible_agents)})
+            np.random.seed(0)
+            _, batchRewards, _, _, _ = batch.step(actions[None])
+
+            np.testing.assert_array_equal([rewards[a] for a in env.possible_agents], batchRewards[0])
+            np.testing.assert_array_equal([a.position for a in env.possible_agents], batch.agentPositions[0])
+            self.assertEqual(env.sdg.getTotalDeficit(), batch.totalDeficit[0])
+    
+    def test_batch_env_auto_reset(self):
+        batch = SDBatchEnv(SDGraph("sdzoo/env/9nodes.graph"), num_agents=2, num_envs=4, max_cycles=5)
+        for step in range(1, 6):
+            actions = np.array([[np.flatnonzero(m)[0] for m in env] for env in batch.available_actions])
+            obs, rewards, dones, truncated, info = batch.step(actions)
+        self.assertTrue(dones.all())
+        self.assertTrue(truncated.all())
+        self.assertEqual(obs["vertex_state"].shape, (4, 2, 9, 2))
+        self.assertTrue((batch.step_count == 0).all())
+        self.assertFalse(batch.dones.any())
+        np.testing.assert_array_equal(batch.totalDeficit, batch.nodeDeficit.sum(axis=1))
+    
     def test_state(self):
         graph = SDGraph("sdzoo/env/4nodes.graph")
         env = parallel_env(graph,
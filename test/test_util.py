@@ -0,0 +1,104 @@
+import random
+import unittest
+
+import numpy as np
+from gymnasium.spaces import flatten
+
+from sdzoo.sdzoo_v0 import SDGraph, parallel_env
+from onpolicy.utils.util import FlattenPlan
+
+
+def step_observations(env, steps=5, seed=0):
+    ''' Yield the observations and global states of a few random steps of the environment. '''
+    random.seed(seed)
+    np.random.seed(seed)
+    obs, _ = env.reset(seed=seed)
+    for _ in range(steps):
+        yield obs, env.state_all()
+        actions = {agent: random.choice(np.flatnonzero(env.available_actions[agent]).tolist()) for agent in env.agents}
+        obs, _, _, _, _ = env.step(actions)
+
+
+class TestFlattenPlan(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.env = parallel_env(SDGraph("sdzoo/env/cumberland.graph"), num_agents=3, observe_method="adjacency", observation_radius=200)
+
+    def _assertFlattens(self, plan, space, x):
+        expected = flatten(space, x)
+        actual = plan(x)
+        self.assertEqual(actual.dtype, expected.dtype)
+        np.testing.assert_array_equal(actual, expected)
+
+    def test_matches_flatten_on_observations(self):
+        agent = self.env.possible_agents[0]
+        obs_plan = FlattenPlan(self.env.observation_spaces[agent])
+        all_obs_plan = FlattenPlan(self.env.observation_spaces)
+        state_plan = FlattenPlan(self.env.state_space)
+        for obs, state in step_observations(self.env):
+            for a in self.env.possible_agents:
+                self._assertFlattens(obs_plan, self.env.observation_spaces[a], obs[a])
+                self._assertFlattens(state_plan, self.env.state_space, state[a])
+            # SDEnv flattens the observations of all agents at once.
+            self._assertFlattens(all_obs_plan, self.env.observation_spaces, obs)
+
+    def test_matches_flatten_on_samples(self):
+        space = self.env.observation_spaces[self.env.possible_agents[0]]
+        space.seed(0)
+        plan = FlattenPlan(space)
+        for _ in range(5):
+            self._assertFlattens(plan, space, space.sample())
+
+    def test_output_row(self):
+        # A plan can write into a row of a larger buffer of a wider dtype, casting each leaf like flatten().
+        space = self.env.state_space
+        buffer = np.zeros((2, FlattenPlan(space).size), dtype=np.float64)
+        plan = FlattenPlan(space, out=buffer[1])
+        state = next(step_observations(self.env))[1][self.env.possible_agents[0]]
+        self.assertIs(plan(state), plan.out)
+        np.testing.assert_array_equal(buffer[1], flatten(space, state).astype(np.float64))
+        np.testing.assert_array_equal(buffer[0], 0.0)
+
+    def test_output_reused_between_calls(self):
+        # The output array is overwritten by the next call, so results that are kept must be copied.
+        agent = self.env.possible_agents[0]
+        space = self.env.observation_spaces[agent]
+        plan = FlattenPlan(space)
+        (first, _), (second, _) = list(step_observations(self.env, steps=2))
+        kept = plan(first[agent]).copy()
+        out = plan(second[agent])
+        self.assertIs(out, plan.out)
+        np.testing.assert_array_equal(kept, flatten(space, first[agent]))
+        np.testing.assert_array_equal(out, flatten(space, second[agent]))
+
+
+class TestSDEnvObservations(unittest.TestCase):
+
+    def test_observations_not_aliased_between_calls(self):
+        # SDEnv flattens into reused buffers, but the observations it returns must stay valid after the next step.
+        from onpolicy.config import get_config
+        from onpolicy.scripts.train.train_sd import parse_args
+        from onpolicy.envs.patrolling.SDEnv import SDEnv
+
+        args = parse_args(["--graph_file", "sdzoo/env/cumberland.graph", "--num_agents", "3",
+                           "--observe_method", "adjacency", "--observe_method_global", "adjacency"], get_config())
+        args.drop_reward = 5.0
+        args.load_reward = 5.0
+        args.step_reward = 10.0
+        args.state_reward = 20.0
+        args.step_penalty = 0.1
+        args.agent_max_capacity = 1
+        random.seed(0)
+        np.random.seed(0)
+        env = SDEnv(args)
+
+        previous = env.reset()
+        for _ in range(3):
+            kept = {k: v.copy() for k, v in previous.items()}
+            actions = [int(np.flatnonzero(m)[0]) for m in previous["available_actions"]]
+            current, _, _, _ = env.step(actions)
+            for k in ["obs", "share_obs"]:
+                self.assertFalse(np.shares_memory(previous[k], current[k]), k)
+                np.testing.assert_array_equal(previous[k], kept[k])
+            previous = current